@@ -0,0 +1,128 @@
+import logging
+import os
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import (
+    Distance,
+    FieldCondition,
+    Filter,
+    FilterSelector,
+    MatchValue,
+    PointStruct,
+    Range,
+    VectorParams,
+)
+
+from metrics import ANSWER_CACHE_LOOKUPS
+from tracing import span, traced
+
+logger = logging.getLogger(__name__)
+
+# Semantic answer cache: (question embedding -> final answer + SQL) per connected
+# database, so paraphrased repeat questions skip the agent loop. An entry only
+# matches while the schema version and the warehouse data fingerprint it was
+# produced under are still current. Follow-up questions carry the conversation's
+# previous question as context and only match answers given after that same question.
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400"))
+EMBEDDING_SIZE = 1536
+
+qdrant = AsyncQdrantClient(host="localhost", port=6333)
+_known_collections = set()
+
+
+def collection_name(db_id: str) -> str:
+    return f"answer_cache_{db_id}"
+
+
+def _version_filter(schema_version: str, data_version: str) -> List[FieldCondition]:
+    return [
+        FieldCondition(key="schema_version", match=MatchValue(value=schema_version)),
+        FieldCondition(key="data_version", match=MatchValue(value=data_version)),
+    ]
+
+
+async def _ensure_collection(name: str) -> None:
+    if name in _known_collections:
+        return
+    if not await qdrant.collection_exists(name):
+        await qdrant.create_collection(
+            collection_name=name,
+            vectors_config=VectorParams(size=EMBEDDING_SIZE, distance=Distance.COSINE),
+        )
+    _known_collections.add(name)
+
+
+async def lookup_answer(db_id: str, question_vector: List[float], schema_version: str, data_version: str,
+                        context: str = "") -> Optional[Dict]:
+    """
+    Return the payload of the closest cached answer above the similarity
+    threshold that is still valid for the current versions and was given in
+    the same context (previous question, "" for a new conversation), or None.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    name = collection_name(db_id)
+    try:
+        with span("vector.answer_cache_lookup", "vector", "client", **{"db.system": "qdrant"}):
+            await _ensure_collection(name)
+            response = await qdrant.query_points(
+                collection_name=name,
+                query=question_vector,
+                query_filter=Filter(must=_version_filter(schema_version, data_version) + [
+                    FieldCondition(key="context", match=MatchValue(value=context)),
+                    FieldCondition(key="created_at", range=Range(gte=time.time() - ANSWER_CACHE_TTL_SECONDS)),
+                ]),
+                score_threshold=ANSWER_CACHE_SIMILARITY,
+                limit=1,
+            )
+    except Exception as e:
+        logger.error(f"Answer cache lookup failed for {name}: {e}")
+        ANSWER_CACHE_LOOKUPS.labels(result="error").inc()
+        return None
+    if not response.points:
+        ANSWER_CACHE_LOOKUPS.labels(result="miss").inc()
+        return None
+    ANSWER_CACHE_LOOKUPS.labels(result="hit").inc()
+    hit = response.points[0]
+    logger.info(f"Answer cache hit for {name} (score {hit.score:.3f})")
+    return {**hit.payload, "score": hit.score}
+
+
+@traced("vector.answer_cache_store", "vector", "client")
+async def store_answer(db_id: str, question: str, question_vector: List[float], answer: str, sql: List[str],
+                       schema_version: str, data_version: str, context: str = "") -> None:
+    """Cache a final answer, dropping entries produced under older versions."""
+    if not ANSWER_CACHE_ENABLED:
+        return
+    name = collection_name(db_id)
+    try:
+        await _ensure_collection(name)
+        await qdrant.delete(
+            collection_name=name,
+            points_selector=FilterSelector(filter=Filter(should=[
+                Filter(must_not=[condition]) for condition in _version_filter(schema_version, data_version)
+            ])),
+        )
+        await qdrant.upsert(
+            collection_name=name,
+            points=[PointStruct(
+                id=str(uuid.uuid4()),
+                vector=question_vector,
+                payload={
+                    "question": question,
+                    "context": context,
+                    "answer": answer,
+                    "sql": sql,
+                    "schema_version": schema_version,
+                    "data_version": data_version,
+                    "created_at": time.time(),
+                },
+            )],
+        )
+    except Exception as e:
+        logger.error(f"Answer cache write failed for {name}: {e}")
@@ -0,0 +1,289 @@
+import asyncio
+import re
+from fastapi import HTTPException
+from bson import ObjectId
+from pymongo import UpdateOne
+from schemas import ConnectDB
+from database import (
+    async_users_collection,
+    async_database_connections,
+    async_db_extracted_schema,
+    async_db_generated_semantics,
+    async_db_authorized_tables_columns_info,
+    async_db_visualizations,
+    async_db_kpis,
+    async_db_table_catalog,
+)
+import kpi_rollup
+from kpi_batch import plan_kpi_batches, run_batch_async
+from metrics import KPI_LATENCY, record_kpi_batches, timed_call
+
+# Async counterparts of the Mongo helpers in models.py, for use from `async def`
+# handlers so a request never holds a threadpool slot while waiting on Mongo.
+
+TENANT_KEYS = ("_id", "user_id", "db_id")
+
+
+async def get_user_by_email(email: str):
+    return await async_users_collection.find_one({"email": email})
+
+
+async def get_user_by_id(user_id: str):
+    try:
+        return await async_users_collection.find_one({"_id": ObjectId(user_id)})
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid user ID format")
+
+
+async def create_user(user_dict: dict):
+    result = await async_users_collection.insert_one(user_dict)
+    return str(result.inserted_id)
+
+
+async def update_password_hash(user_id, hashed_password: str):
+    await async_users_collection.update_one({"_id": user_id}, {"$set": {"hashed_password": hashed_password}})
+
+
+async def create_database_connection(database_connection: ConnectDB, user_id: str):
+    connection_data = database_connection.model_dump()
+    connection_data["user_id"] = user_id
+
+    result = await async_database_connections.insert_one(connection_data)
+    return str(result.inserted_id)
+
+
+async def get_databases(user_id: str):
+    db_connections = async_database_connections.find(
+        {"user_id": user_id}, {"database": 1, "db_type": 1}
+    )
+    return [
+        {
+            "database": conn["database"],
+            "db_type": conn["db_type"],
+            "db_id": str(conn["_id"])
+        }
+        async for conn in db_connections
+    ]
+
+
+async def get_database_connection(user_id: str, db_id: str):
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    try:
+        data_connection = await async_database_connections.find_one(
+            {"user_id": user_id, "_id": ObjectId(db_id)}, {"user_id": 0, "_id": 0}
+        )
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid user ID format")
+
+    if not data_connection:
+        raise HTTPException(status_code=404, detail="Connection not found")
+    data_connection["db_id"] = db_id
+    return data_connection
+
+
+async def update_statement_timeout(user_id: str, db_id: str, statement_timeout_ms):
+    try:
+        result = await async_database_connections.update_one(
+            {"user_id": user_id, "_id": ObjectId(db_id)},
+            {"$set": {"statement_timeout_ms": statement_timeout_ms}}
+        )
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid user ID format")
+    if not result.matched_count:
+        raise HTTPException(status_code=404, detail="Connection not found")
+    return statement_timeout_ms
+
+
+async def save_table_catalog(user_id: str, db_id: str, tables: dict):
+    """
+    Persist a table listing, one document per table, replacing any previous listing.
+    Upserts per table rather than delete-then-insert, so concurrent saves don't collide
+    on the unique index or leave the listing empty in between.
+    """
+    if tables:
+        await async_db_table_catalog.bulk_write([
+            UpdateOne(
+                {"user_id": user_id, "db_id": db_id, "table_name": table_name},
+                {"$set": {"columns": columns}},
+                upsert=True,
+            )
+            for table_name, columns in tables.items()
+        ], ordered=False)
+    await async_db_table_catalog.delete_many(
+        {"user_id": user_id, "db_id": db_id, "table_name": {"$nin": list(tables or {})}}
+    )
+
+
+async def has_table_catalog(user_id: str, db_id: str) -> bool:
+    return await async_db_table_catalog.find_one({"user_id": user_id, "db_id": db_id}, {"_id": 1}) is not None
+
+
+async def get_table_catalog(user_id: str, db_id: str):
+    cursor = async_db_table_catalog.find(
+        {"user_id": user_id, "db_id": db_id}, {"_id": 0, "table_name": 1, "columns": 1}
+    ).sort("table_name", 1)
+    return {document["table_name"]: document["columns"] async for document in cursor}
+
+
+def _name_filter(q: str, match: str) -> dict:
+    pattern = re.escape(q)
+    return {"$regex": f"^{pattern}" if match == "prefix" else pattern, "$options": "i"}
+
+
+async def search_table_catalog(user_id: str, db_id: str, q: str = None, match: str = "substring",
+                               search_columns: bool = False, cursor: str = None, limit: int = 50):
+    """
+    One page of the saved table listing, ordered by table name.
+
+    Returns:
+        (tables, next_cursor): tables carry name and column count only; next_cursor
+        is the last table name of a full page, or None on the last page.
+    """
+    query = {"user_id": user_id, "db_id": db_id}
+    if q:
+        name_filter = _name_filter(q, match)
+        if search_columns:
+            query["$or"] = [{"table_name": name_filter}, {"columns": name_filter}]
+        else:
+            query["table_name"] = name_filter
+    if cursor:
+        query["table_name"] = {**query.get("table_name", {}), "$gt": cursor}
+
+    documents = async_db_table_catalog.find(
+        query, {"_id": 0, "table_name": 1, "column_count": {"$size": "$columns"}}
+    ).sort("table_name", 1).limit(limit)
+    tables = [document async for document in documents]
+    next_cursor = tables[-1]["table_name"] if len(tables) == limit else None
+    return tables, next_cursor
+
+
+async def get_table_columns(user_id: str, db_id: str, table_name: str, q: str = None, match: str = "substring"):
+    document = await async_db_table_catalog.find_one(
+        {"user_id": user_id, "db_id": db_id, "table_name": table_name}, {"_id": 0, "columns": 1}
+    )
+    if document is None:
+        raise HTTPException(status_code=404, detail="Table not found")
+    columns = document["columns"]
+    if q:
+        pattern = re.compile(f"^{re.escape(q)}" if match == "prefix" else re.escape(q), re.IGNORECASE)
+        columns = [column for column in columns if pattern.search(column)]
+    return columns
+
+
+async def _insert_tenant_document(collection, document, user_id, db_id):
+    tenant_document = document.copy()
+    tenant_document["user_id"] = user_id
+    tenant_document["db_id"] = db_id
+    result = await collection.insert_one(tenant_document)
+    return {"inserted_id": str(result.inserted_id)}
+
+
+async def _merge_tenant_documents(collection, user_id, db_id):
+    result = {}
+    async for document in collection.find({"user_id": user_id, "db_id": db_id}):
+        for key, value in document.items():
+            if key not in TENANT_KEYS:
+                result[key] = value
+    return result
+
+
+async def add_extracted_schema(response_schema, user_id, db_id):
+    return await _insert_tenant_document(async_db_extracted_schema, response_schema, user_id, db_id)
+
+
+async def get_extracted_schema(user_id: str, db_id: str):
+    try:
+        return await _merge_tenant_documents(async_db_extracted_schema, user_id, db_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error retrieving extracted schemas: {str(e)}")
+
+
+async def save_authorized_tables_columns_info(authorized_tables_columns_info, user_id, db_id):
+    return await _insert_tenant_document(
+        async_db_authorized_tables_columns_info, authorized_tables_columns_info, user_id, db_id
+    )
+
+
+async def get_authorized_tables_columns_info(user_id, db_id):
+    try:
+        return await _merge_tenant_documents(async_db_authorized_tables_columns_info, user_id, db_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error retrieving extracted schemas: {str(e)}")
+
+
+async def add_generated_semantics(semantic_response, user_id, db_id):
+    return await _insert_tenant_document(async_db_generated_semantics, semantic_response, user_id, db_id)
+
+
+async def get_semantic_data(user_id: str, db_id):
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    try:
+        semantic_data_extracted = await async_db_generated_semantics.find_one(
+            {"user_id": user_id, "db_id": db_id}, {"user_id": 0, "db_id": 0, "_id": 0}
+        )
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid user ID format")
+    if not semantic_data_extracted:
+        raise HTTPException(status_code=404, detail="Connection not found")
+    return semantic_data_extracted
+
+
+async def get_schema_version(user_id: str, db_id: str) -> str:
+    """Identifies the latest extracted schema + semantics; changes whenever the db is re-onboarded."""
+    versions = []
+    for collection in (async_db_extracted_schema, async_db_generated_semantics):
+        document = await collection.find_one(
+            {"user_id": user_id, "db_id": db_id}, {"_id": 1}, sort=[("_id", -1)]
+        )
+        versions.append(str(document["_id"]) if document else "none")
+    return ":".join(versions)
+
+
+async def get_visualizations(user_id: str, db_id: str):
+    echart_response = await async_db_visualizations.find_one(
+        {"user_id": user_id, "db_id": db_id}, {"user_id": 0, "db_id": 0}
+    )
+    if echart_response:
+        echart_response["_id"] = str(echart_response["_id"])
+    return echart_response
+
+
+async def pin_visualization(user_id: str, db_id: str, chart_id: str):
+    result = await async_db_visualizations.update_one(
+        {"user_id": user_id, "db_id": db_id},
+        {"$set": {"charts.$[chart].pinned": True}},
+        array_filters=[{"chart.chart_id": chart_id}]
+    )
+    return result.modified_count
+
+
+@timed_call(KPI_LATENCY)
+async def kpi_executor_on_db_async(user_id: str, db_id: str):
+    kpis_list_db_response = await async_db_kpis.find_one(
+        {"user_id": user_id, "db_id": db_id}, {"user_id": 0, "_id": 0, "db_id": 0}
+    )
+    if not kpis_list_db_response:
+        return None
+
+    data_connection = await get_database_connection(user_id, db_id)
+    kpis = kpis_list_db_response["kpis"]
+    results = [None] * len(kpis)
+    # Materialized KPIs read their rollup; the rest share scans where their formulas allow it.
+    materialized = [index for index, kpi in enumerate(kpis) if kpi.get("materialize")]
+    live = [index for index, kpi in enumerate(kpis) if not kpi.get("materialize")]
+    live_kpis = [kpis[index] for index in live]
+    batches = plan_kpi_batches(live_kpis, data_connection["db_type"])
+    record_kpi_batches(len(kpis), batches, rollups=len(materialized))
+    outputs = await asyncio.gather(
+        *(run_batch_async(data_connection, live_kpis, batch) for batch in batches),
+        *(kpi_rollup.read_kpi(data_connection, user_id, db_id, kpis[index]) for index in materialized),
+    )
+    for batch, batch_results in zip(batches, outputs):
+        for position, result in zip(batch["kpis"], batch_results):
+            results[live[position]] = result
+    for index, result in zip(materialized, outputs[len(batches):]):
+        results[index] = result
+    return [{"name": kpi["name"], "result": result} for kpi, result in zip(kpis, results)]
@@ -4,6 +4,9 @@ from jose import jwt,JWTError
 from fastapi.security import OAuth2PasswordBearer
 import os 
 from dotenv import load_dotenv
+import async_models
+from schemas import Principal
+from ttl_cache import TTLCache
 load_dotenv()
 
 SECRET_KEY=os.getenv("SECRET_KEY")
@@ -11,6 +14,13 @@ ALGORITHM=os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES=int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Verified tokens are remembered until they expire, so repeat requests skip the
+# signature check; profiles are only cached briefly so edits show up quickly.
+TOKEN_CACHE_SIZE=int(os.getenv("TOKEN_CACHE_SIZE","10000"))
+USER_PROFILE_CACHE_SECONDS=int(os.getenv("USER_PROFILE_CACHE_SECONDS","60"))
+verified_tokens=TTLCache(TOKEN_CACHE_SIZE,ACCESS_TOKEN_EXPIRE_MINUTES*60,name="verified_tokens")
+user_profiles=TTLCache(TOKEN_CACHE_SIZE,USER_PROFILE_CACHE_SECONDS,name="user_profiles")
+
 def create_access_token(data:dict):
     to_encode=data.copy()
     expire=datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -18,12 +28,34 @@ def create_access_token(data:dict):
     return jwt.encode(to_encode,SECRET_KEY,algorithm=ALGORITHM)
 
 
-def get_current_user_id(token: str = Depends(oauth2_scheme)) -> str:
-    try:
-        payload = jwt.decode(token, os.getenv("SECRET_KEY"), algorithms=[os.getenv("ALGORITHM")])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid token - user ID missing")
+def verify_token(token: str) -> str:
+    user_id=verified_tokens.get(token)
+    if user_id is not None:
         return user_id
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
\ No newline at end of file
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    user_id: str = payload.get("sub")
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Invalid token - user ID missing")
+    remaining=payload.get("exp",0)-datetime.now(timezone.utc).timestamp()
+    if remaining>0:
+        verified_tokens.set(token,user_id,ttl_seconds=remaining)
+    return user_id
+
+
+async def get_current_user_id(token: str = Depends(oauth2_scheme)) -> str:
+    return verify_token(token)
+
+
+async def get_current_principal(user_id: str = Depends(get_current_user_id)) -> Principal:
+    principal=user_profiles.get(user_id)
+    if principal is not None:
+        return principal
+    user=await async_models.get_user_by_id(user_id)
+    if not user:
+        raise HTTPException(status_code=404,detail="User not found")
+    principal=Principal(user_id=str(user["_id"]),username=user["username"],email=user["email"])
+    user_profiles.set(user_id,principal)
+    return principal
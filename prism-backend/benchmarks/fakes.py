@@ -0,0 +1,366 @@
+import asyncio
+import hashlib
+import json
+import re
+import time
+import uuid
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+# Deterministic stand-ins for the external services the app talks to. They are
+# installed by patching the client classes *before* the app modules import
+# them, so the code under test is the code that ships.
+
+EMBEDDING_SIZE = 1536
+# Provider prompt caching as documented for Azure OpenAI: prefixes of at least
+# 1024 tokens, matched in 128-token steps.
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_STEP_TOKENS = 128
+
+MONTH_EXPRESSIONS = {
+    "sqlite": "strftime('%Y-%m', o.order_date)",
+    "postgresql": "to_char(o.order_date, 'YYYY-MM')",
+}
+
+REVENUE = "SUM(oi.quantity * oi.unit_price)"
+
+
+def chart_queries(dialect: str) -> List[Dict]:
+    """What the fake LLM answers to visualizations.get_sql_queries."""
+    month = MONTH_EXPRESSIONS[dialect]
+    return [
+        {
+            "chart_type": "Line",
+            "description": "Revenue by month",
+            "sql": f"SELECT {month} AS month, {REVENUE} AS revenue FROM orders o "
+                   f"JOIN order_items oi ON oi.order_id = o.order_id GROUP BY {month} ORDER BY month",
+        },
+        {
+            "chart_type": "Bar",
+            "description": "Revenue by product category",
+            "sql": f"SELECT p.category, {REVENUE} AS revenue FROM order_items oi "
+                   "JOIN products p ON p.product_id = oi.product_id GROUP BY p.category ORDER BY revenue DESC",
+        },
+        {
+            "chart_type": "Pie",
+            "description": "Orders by status",
+            "sql": "SELECT status, COUNT(*) AS orders FROM orders GROUP BY status",
+        },
+        {
+            "chart_type": "Bar",
+            "description": "Customers by region",
+            "sql": "SELECT region, COUNT(*) AS customers FROM customers GROUP BY region ORDER BY customers DESC",
+        },
+    ]
+
+
+# (question, SQL the fake agent runs for it)
+CHAT_QUESTIONS = [
+    ("Which product categories bring in the most revenue?",
+     f"SELECT p.category, {REVENUE} AS revenue FROM order_items oi "
+     "JOIN products p ON p.product_id = oi.product_id GROUP BY p.category ORDER BY revenue DESC"),
+    ("How many orders were returned or cancelled?",
+     "SELECT status, COUNT(*) AS orders FROM orders WHERE status IN ('returned', 'cancelled') GROUP BY status"),
+    ("Which regions have the highest order value?",
+     f"SELECT c.region, {REVENUE} AS revenue FROM customers c JOIN orders o ON o.customer_id = c.customer_id "
+     "JOIN order_items oi ON oi.order_id = o.order_id GROUP BY c.region ORDER BY revenue DESC"),
+    ("What is the average basket size?",
+     "SELECT AVG(items) AS avg_items FROM (SELECT order_id, SUM(quantity) AS items FROM order_items GROUP BY order_id) baskets"),
+    ("What is the total revenue?",
+     "SELECT SUM(quantity * unit_price) AS total_revenue FROM order_items"),
+]
+# Answer templates the fake fast-path planner returns; other questions are declined to the agent.
+FAST_PATH_ANSWERS = {
+    "What is the average basket size?": "<b>Final Answer:</b> An average basket holds {avg_items} items.",
+    "What is the total revenue?": "<b>Final Answer:</b> Total revenue is {total_revenue}.",
+}
+
+KPIS = [
+    {"name": "total_revenue", "description": "Gross revenue",
+     "formula": "SELECT SUM(quantity * unit_price) AS total_revenue FROM order_items"},
+    {"name": "units_sold", "description": "Units sold",
+     "formula": "SELECT SUM(quantity) AS units_sold FROM order_items"},
+    {"name": "order_count", "description": "Orders placed",
+     "formula": "SELECT COUNT(*) AS order_count FROM orders"},
+    {"name": "orders_by_status", "description": "Orders per status",
+     "formula": "SELECT status, COUNT(*) AS orders FROM orders GROUP BY status"},
+    {"name": "revenue_by_region", "description": "Revenue per customer region",
+     "formula": "SELECT c.region, SUM(oi.quantity * oi.unit_price) AS revenue FROM customers c "
+                "JOIN orders o ON o.customer_id = c.customer_id JOIN order_items oi ON oi.order_id = o.order_id "
+                "GROUP BY c.region"},
+]
+
+FINAL_ANSWER = "<b>Final Answer:</b> Garden and tools lead, with steady growth through the period."
+
+
+def approximate_tokens(text: str) -> int:
+    return max(len(text) // 4, 1)
+
+
+class FakeLatency:
+    """Simulated service latency, in milliseconds, shared by all fakes."""
+    llm_ms = 0.0
+    embedding_ms = 0.0
+
+
+def _seeded_unit_vector(text: str) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(EMBEDDING_SIZE)
+    return vector / np.linalg.norm(vector)
+
+
+_word_vector = lru_cache(maxsize=4096)(_seeded_unit_vector)
+
+
+def fake_embedding(text: str) -> List[float]:
+    """
+    Half bag-of-words, half exact-text vector: texts sharing words score
+    above the vector-search threshold, identical texts score 1.0, and
+    rewordings stay well below the answer cache's similarity cut-off.
+    """
+    words = [word.rstrip("s") for word in re.findall(r"[a-z]+", text.lower()) if len(word) > 2]
+    vector = _seeded_unit_vector(text)
+    if words:
+        bag = np.sum([_word_vector(word) for word in words], axis=0)
+        vector = vector + bag / np.linalg.norm(bag)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+_cached_prefixes = set()
+
+
+def cached_tokens(prompt: str) -> int:
+    """Tokens of `prompt` a provider prefix cache would serve, given every prompt seen before."""
+    step = PROMPT_CACHE_STEP_TOKENS * 4
+    cached = 0
+    for end in range(step, len(prompt) + 1, step):
+        digest = hashlib.sha1(prompt[:end].encode("utf-8")).digest()
+        if digest in _cached_prefixes:
+            cached = end // 4
+        else:
+            _cached_prefixes.add(digest)
+    return cached if cached >= PROMPT_CACHE_MIN_TOKENS else 0
+
+
+def _usage(prompt: str, completion: str) -> SimpleNamespace:
+    prompt_tokens, completion_tokens = approximate_tokens(prompt), approximate_tokens(completion)
+    return SimpleNamespace(
+        prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens,
+        prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens(prompt)),
+    )
+
+
+def _fast_path_plan(question: str) -> Dict:
+    for known, sql in CHAT_QUESTIONS:
+        if question.startswith(known) and known in FAST_PATH_ANSWERS:
+            return {"simple": True, "sql": sql, "answer": FAST_PATH_ANSWERS[known]}
+    return {"simple": False}
+
+
+class _Completions:
+    def __init__(self, dialect: str):
+        self.dialect = dialect
+
+    def create(self, model: str, messages: List[Dict], **kwargs) -> SimpleNamespace:
+        time.sleep(FakeLatency.llm_ms / 1000)
+        prompt = "\n".join(message["content"] for message in messages)
+        if "You plan answers to business questions" in prompt:
+            content = json.dumps(_fast_path_plan(prompt.rsplit("Question: ", 1)[-1]))
+        elif "generate a list of SQL queries" in prompt:
+            content = json.dumps(chart_queries(self.dialect))
+        elif "KPI" in prompt:
+            content = json.dumps({"sql": KPIS[0]["formula"], "group_by": [], "error": None})
+        else:
+            # Column, table and database prompts name their subject in backticks.
+            subject = re.search(r"`([^`]+)`", prompt)
+            name = subject.group(1).replace("_", " ") if subject else "data"
+            content = f"Holds {name}; {name} figures used for {name} reporting."
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=_usage(prompt, content),
+        )
+
+
+class _Embeddings:
+    def create(self, model: str, input, **kwargs) -> SimpleNamespace:
+        time.sleep(FakeLatency.embedding_ms / 1000)
+        texts = [input] if isinstance(input, str) else list(input)
+        return SimpleNamespace(
+            data=[SimpleNamespace(embedding=fake_embedding(text), index=index) for index, text in enumerate(texts)],
+            usage=SimpleNamespace(prompt_tokens=sum(approximate_tokens(text) for text in texts), total_tokens=0),
+        )
+
+
+class FakeAzureOpenAI:
+    """Drop-in for openai.AzureOpenAI: chat completions and embeddings."""
+
+    dialect = "sqlite"
+
+    def __init__(self, *args, **kwargs):
+        self.chat = SimpleNamespace(completions=_Completions(self.dialect))
+        self.embeddings = _Embeddings()
+
+
+class FakeAzureChatOpenAI(BaseChatModel):
+    """
+    Drop-in for langchain_openai.AzureChatOpenAI. With tools bound it plays a
+    fixed agent turn: vector search, one SQL query, digest the result, answer.
+    Unbound it returns a short explanation.
+    """
+
+    azure_deployment: str = ""
+    api_version: str = ""
+    temperature: float = 0.0
+    tools_bound: bool = False
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-azure-chat"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.model_copy(update={"tools_bound": True})
+
+    def _respond(self, messages) -> ChatResult:
+        if not self.tools_bound:
+            message = AIMessage(content=FINAL_ANSWER)
+        else:
+            turn_start = max(index for index, message in enumerate(messages) if isinstance(message, HumanMessage))
+            question = messages[turn_start].content
+            tool_results = [message for message in messages[turn_start:] if isinstance(message, ToolMessage)]
+            sql = next((sql for text, sql in CHAT_QUESTIONS if question.startswith(text)), CHAT_QUESTIONS[0][1])
+            steps = [
+                ("extract_revelent_info_from_vector_db", lambda: {"question": question}),
+                ("run_sql_query", lambda: {"query": sql}),
+                ("explain_sql_result", lambda: {"question": question, "result_handle": _result_handle(tool_results[-1].content)}),
+            ]
+            if len(tool_results) < len(steps):
+                name, args = steps[len(tool_results)]
+                message = AIMessage(content="", tool_calls=[
+                    {"name": name, "args": args(), "id": f"call_{uuid.uuid4().hex[:12]}", "type": "tool_call"}
+                ])
+            else:
+                message = AIMessage(content=FINAL_ANSWER)
+
+        prompt = "\n".join(str(message.content) for message in messages)
+        usage = _usage(prompt, str(message.content) + json.dumps(message.tool_calls))
+        return ChatResult(
+            generations=[ChatGeneration(message=message)],
+            llm_output={"token_usage": {
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": usage.prompt_tokens_details.cached_tokens},
+            }},
+        )
+
+    def _generate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(FakeLatency.llm_ms / 1000)
+        return self._respond(messages)
+
+    async def _agenerate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(FakeLatency.llm_ms / 1000)
+        return self._respond(messages)
+
+
+def _result_handle(content: str) -> str:
+    """The result_handle of a run_sql_query result, as the explain tool accepts it."""
+    try:
+        return json.loads(content).get("result_handle") or ""
+    except (ValueError, AttributeError):
+        return ""
+
+
+class AsyncCursor:
+    """Awaitable-style wrapper over a mongomock cursor, for the AsyncMongoClient call sites."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, *args):
+        self._cursor = self._cursor.limit(*args)
+        return self
+
+    def skip(self, *args):
+        self._cursor = self._cursor.skip(*args)
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self._cursor:
+            yield document
+
+    async def to_list(self, length: Optional[int] = None):
+        documents = list(self._cursor)
+        return documents if length is None else documents[:length]
+
+
+class AsyncCollection:
+    """pymongo AsyncCollection surface over a mongomock collection."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs) -> AsyncCursor:
+        return AsyncCursor(self._collection.find(*args, **kwargs))
+
+    async def bulk_write(self, requests, ordered: bool = True):
+        # mongomock's bulk builder predates the `sort` argument current pymongo passes for UpdateOne.
+        for request in requests:
+            self._collection.update_one(request._filter, request._doc, upsert=request._upsert)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if not callable(attribute):
+            return attribute
+
+        async def call(*args, **kwargs):
+            return attribute(*args, **kwargs)
+        return call
+
+
+def install_mongomock() -> None:
+    """Point every collection handle in database.py at one shared in-memory mongomock store."""
+    import mongomock
+    from pymongo.asynchronous.collection import AsyncCollection as PyMongoAsyncCollection
+    from pymongo.collection import Collection
+
+    import database
+
+    client = mongomock.MongoClient()
+    for name, value in list(vars(database).items()):
+        if isinstance(value, Collection):
+            setattr(database, name, client[value.database.name][value.name])
+        elif isinstance(value, PyMongoAsyncCollection):
+            setattr(database, name, AsyncCollection(client[value.database.name][value.name]))
+
+
+def install_qdrant() -> None:
+    """Every QdrantClient/AsyncQdrantClient the app creates becomes a shared in-memory instance."""
+    import qdrant_client
+
+    memory = qdrant_client.QdrantClient(location=":memory:")
+    async_memory = qdrant_client.AsyncQdrantClient(location=":memory:")
+    qdrant_client.QdrantClient = lambda *args, **kwargs: memory
+    qdrant_client.AsyncQdrantClient = lambda *args, **kwargs: async_memory
+
+
+def install_openai(dialect: str, llm_ms: float, embedding_ms: float) -> None:
+    import langchain_openai
+    import openai
+
+    FakeLatency.llm_ms = llm_ms
+    FakeLatency.embedding_ms = embedding_ms
+    FakeAzureOpenAI.dialect = dialect
+    openai.AzureOpenAI = FakeAzureOpenAI
+    langchain_openai.AzureChatOpenAI = FakeAzureChatOpenAI
@@ -0,0 +1,357 @@
+"""
+Offline benchmarks for onboarding, KPI evaluation, chart generation and chat turns.
+
+Azure OpenAI chat and embeddings are deterministic fakes with a fixed latency,
+Qdrant runs in memory, Mongo is mongomock (or a scratch server via --mongo-uri)
+and the warehouse is a generated SQLite file (or a scratch Postgres database via
+--warehouse-url). Requests go through the FastAPI app in-process, so middleware,
+auth, caches and the agent graph are all on the measured path.
+
+Run from prism-backend/:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --orders 200000 --iterations 50 --concurrency 8 --json bench.json
+    python -m benchmarks.run --scenarios kpi,chat,chat-agent --llm-latency-ms 400
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from bson import ObjectId
+
+from benchmarks import fakes, synthetic_warehouse
+
+SCENARIOS = ("onboarding", "kpi", "charts", "chat", "chat-agent", "chat-cached")
+SYNTHETIC_HOST = "synthetic-warehouse"
+
+# Answer-cache fingerprint for the SQLite warehouse (the stock query reads information_schema statistics).
+SQLITE_DATA_VERSION = "SELECT (SELECT COUNT(*) FROM orders) || ':' || (SELECT COUNT(*) FROM order_items)"
+
+_sqlite_engines = {}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--iterations", type=int, default=20, help="measured runs per scenario")
+    parser.add_argument("--onboarding-iterations", type=int, default=3, help="measured onboarding runs")
+    parser.add_argument("--warmup", type=int, default=2, help="unmeasured runs before each scenario")
+    parser.add_argument("--concurrency", type=int, default=1, help="runs in flight at once, one tenant each")
+    parser.add_argument("--orders", type=int, default=20000, help="synthetic warehouse size, in orders")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0)
+    parser.add_argument("--embedding-latency-ms", type=float, default=10.0)
+    parser.add_argument("--warehouse-url",
+                        help="scratch Postgres database to fill instead of SQLite (its demo tables are dropped)")
+    parser.add_argument("--mongo-uri", help="scratch Mongo server to use instead of mongomock")
+    parser.add_argument("--workdir", help="where the warehouse file and app side files go (default: a temp dir)")
+    parser.add_argument("--json", dest="json_path", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show application logs")
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.json_path:
+        args.json_path = os.path.abspath(args.json_path)
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def configure_environment(args, workdir: str) -> None:
+    # Placeholders for settings the app reads at import; the fakes never use the Azure ones.
+    defaults = {
+        "AZURE_OPENAI_API_KEY": "benchmark",
+        "AZURE_OPENAI_ENDPOINT": "https://benchmark.invalid",
+        "OPENAI_API_VERSION": "2024-12-01-preview",
+        "SECRET_KEY": "benchmark-secret",
+        "ALGORITHM": "HS256",
+        "ACCESS_TOKEN_EXPIRE_MINUTES": "120",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    os.environ["KPI_ROLLUP_PATH"] = os.path.join(workdir, "kpi_rollups.sqlite3")
+    os.environ["TRACE_EXPORT_PATH"] = os.path.join(workdir, "traces.jsonl")
+    os.environ["RESULT_STORE_DIR"] = os.path.join(workdir, "results")
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+
+
+def prepare_warehouse(args, workdir: str) -> Dict:
+    """Build the synthetic warehouse and return the connection the app will store for it."""
+    import warehouse
+    from sqlalchemy import create_engine
+    from sqlalchemy.engine import make_url
+
+    if args.warehouse_url:
+        url = make_url(args.warehouse_url)
+        engine = create_engine(url.set(drivername="postgresql+psycopg2"))
+        try:
+            counts = synthetic_warehouse.populate(engine, args.orders, args.seed)
+        finally:
+            engine.dispose()
+        connection = {
+            "db_type": "postgresql", "database": url.database, "username": url.username or "",
+            "password": url.password or "", "host": url.host or "localhost", "port": url.port or 5432,
+        }
+    else:
+        path = os.path.join(workdir, "warehouse.sqlite3")
+        counts = synthetic_warehouse.build_sqlite(path, args.orders, args.seed)
+        # The app only speaks Postgres/MySQL. The SQLite file is registered as a MySQL connection
+        # (SQLite accepts MySQL-style quoting), and SYNTHETIC_HOST is served from the file.
+        engines = _sqlite_engines
+        engines["sync"] = synthetic_warehouse.sqlite_engine(path, warehouse.POOL_SIZE, warehouse.MAX_OVERFLOW)
+        engines["async"] = synthetic_warehouse.sqlite_async_engine(path, warehouse.POOL_SIZE, warehouse.MAX_OVERFLOW)
+        get_engine, get_async_engine = warehouse.get_engine, warehouse.get_async_engine
+        warehouse.get_engine = lambda data_connection: (
+            engines["sync"] if data_connection.get("host") == SYNTHETIC_HOST else get_engine(data_connection)
+        )
+        warehouse.get_async_engine = lambda data_connection: (
+            engines["async"] if data_connection.get("host") == SYNTHETIC_HOST else get_async_engine(data_connection)
+        )
+        warehouse.DATA_VERSION_QUERIES = {**warehouse.DATA_VERSION_QUERIES, "mysql": SQLITE_DATA_VERSION}
+        connection = {
+            "db_type": "mysql", "database": "synthetic", "username": "benchmark",
+            "password": "benchmark", "host": SYNTHETIC_HOST, "port": 3306,
+        }
+    print("warehouse rows: " + ", ".join(f"{table}={count}" for table, count in counts.items()))
+    return connection
+
+
+def summarize(name: str, latencies: List[float], wall_seconds: Optional[float]) -> Dict:
+    values = np.array(latencies) * 1000
+    return {
+        "scenario": name,
+        "count": len(latencies),
+        "throughput_per_s": round(len(latencies) / wall_seconds, 3) if wall_seconds else None,
+        "mean_ms": round(float(values.mean()), 2),
+        "p50_ms": round(float(np.percentile(values, 50)), 2),
+        "p99_ms": round(float(np.percentile(values, 99)), 2),
+        "max_ms": round(float(values.max()), 2),
+    }
+
+
+async def measure(iterations: int, warmup: int, concurrency: int, run: Callable) -> tuple:
+    """
+    Call `run(index, worker)` warmup + iterations times, `concurrency` at a
+    time. Returns (latencies of the measured runs, wall seconds).
+    """
+    for index in range(warmup):
+        await run(index, 0)
+    indexes = itertools.count(warmup)
+    last = warmup + iterations
+    latencies = []
+
+    async def worker(number):
+        for index in indexes:
+            if index >= last:
+                return
+            started = time.perf_counter()
+            await run(index, number)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(number) for number in range(concurrency)))
+    return latencies, time.perf_counter() - started
+
+
+class Bench:
+    """In-process HTTP client for the app, acting as one tenant (user + connection) per worker."""
+
+    def __init__(self, client, connection: Dict):
+        self.client = client
+        self.connection = connection
+        self.tenants: List[tuple] = []
+        self.stage_latencies: Dict[str, List[float]] = {}
+
+    async def post(self, path: str, payload: Dict, user_id: str) -> Dict:
+        import auth
+
+        headers = {"Authorization": f"Bearer {auth.create_access_token({'sub': user_id})}"}
+        response = await self.client.post(path, json=payload, headers=headers)
+        if response.status_code >= 400:
+            raise RuntimeError(f"POST {path} returned {response.status_code}: {response.text[:500]}")
+        return response.json()
+
+    async def onboard(self, user_id: str) -> str:
+        """The four onboarding calls the frontend makes for a new connection; returns its db_id."""
+        async def stage(name, path, payload):
+            started = time.perf_counter()
+            result = await self.post(path, payload, user_id)
+            self.stage_latencies.setdefault(f"onboarding:{name}", []).append(time.perf_counter() - started)
+            return result
+
+        connected = await stage("connect-db", "/connect-db", self.connection)
+        db_id = connected["db_id"]
+        await stage("extract-schemas", "/extract-schemas", {"db_id": db_id, "selected_tables": connected["db_tables"]})
+        await stage("semantic-extraction", "/semantic-extraction", {"db_id": db_id})
+        await stage("vector-data-insert", "/vector-data-insert", {"db_id": db_id})
+        return db_id
+
+    async def add_tenant(self) -> None:
+        """Onboard a fresh user and register the demo KPIs on their connection."""
+        user_id = str(ObjectId())
+        db_id = await self.onboard(user_id)
+        for kpi in fakes.KPIS:
+            await self.post("/kpi", {"db_id": db_id, "kpiData": {**kpi, "formula_type": "sql"}}, user_id)
+        self.tenants.append((user_id, db_id))
+
+
+async def _run_scenarios(args, connection: Dict) -> List[Dict]:
+    import httpx
+
+    import conversationa_business_intelligence
+    import fast_path
+    import main
+    import visualizations
+
+    results = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://benchmark",
+                                 timeout=None) as client:
+        bench = Bench(client, connection)
+
+        # Workers act as separate tenants: agent memory is per user and connection,
+        # so concurrent turns from one tenant would interleave in one conversation.
+        print(f"onboarding {args.concurrency} tenant(s) ...")
+        for _ in range(args.concurrency):
+            await bench.add_tenant()
+        # The agent reads the semantic descriptions once at import; pick up the fresh ones as a restart would.
+        with open("semantic_database_description.json", encoding="utf-8") as f:
+            conversationa_business_intelligence.semantic_understanding_json.update(json.load(f))
+
+        def chat(repeat: bool, label: str = "run"):
+            async def run(index, worker):
+                user_id, db_id = bench.tenants[worker]
+                question, _ = fakes.CHAT_QUESTIONS[0 if repeat else index % len(fakes.CHAT_QUESTIONS)]
+                if not repeat:
+                    # A distinct wording per run keeps the semantic answer cache out of the measurement.
+                    question = f"{question} ({label} {index})"
+                await bench.post("/conversational-bi", {"db_id": db_id, "user_input": question}, user_id)
+            return run
+
+        async def kpi(index, worker):
+            user_id, db_id = bench.tenants[worker]
+            await bench.post("/get-kpi", {"db_id": db_id}, user_id)
+
+        async def charts(index, worker):
+            result = await visualizations.visualization_generator(*bench.tenants[worker])
+            if result["status"] != "success":
+                raise RuntimeError(f"visualization_generator failed: {result['message']}")
+
+        async def onboarding(index, worker):
+            await bench.onboard(bench.tenants[worker][0])
+
+        scenarios = {
+            "onboarding": onboarding,
+            "kpi": kpi,
+            "charts": charts,
+            "chat": chat(repeat=False),
+            "chat-agent": chat(repeat=False, label="agent run"),
+            "chat-cached": chat(repeat=True),
+        }
+        for name in args.scenarios:
+            print(f"running {name} ...")
+            if name == "onboarding":
+                bench.stage_latencies.clear()
+                latencies, wall = await measure(args.onboarding_iterations, 0, args.concurrency, onboarding)
+                results.append(summarize(name, latencies, wall))
+                for stage, stage_latencies in bench.stage_latencies.items():
+                    results.append(summarize(stage, stage_latencies, None))
+            else:
+                # chat-agent is the chat workload with every turn going through the full agent loop.
+                fast_path.FAST_PATH_ENABLED = name != "chat-agent"
+                latencies, wall = await measure(args.iterations, args.warmup, args.concurrency, scenarios[name])
+                results.append(summarize(name, latencies, wall))
+    return results
+
+
+async def run_benchmarks(args, connection: Dict) -> List[Dict]:
+    import warehouse
+
+    try:
+        return await _run_scenarios(args, connection)
+    finally:
+        # aiosqlite/asyncpg connections must be closed on the loop that opened them.
+        await warehouse.dispose_engines()
+        if _sqlite_engines:
+            _sqlite_engines["sync"].dispose()
+            await _sqlite_engines["async"].dispose()
+
+
+def print_results(results: List[Dict]) -> None:
+    header = f"{'scenario':<34}{'n':>5}{'per s':>9}{'mean ms':>11}{'p50 ms':>11}{'p99 ms':>11}{'max ms':>11}"
+    print(header)
+    print("-" * len(header))
+    for row in results:
+        throughput = f"{row['throughput_per_s']:.2f}" if row["throughput_per_s"] is not None else "-"
+        print(f"{row['scenario']:<34}{row['count']:>5}{throughput:>9}{row['mean_ms']:>11.1f}"
+              f"{row['p50_ms']:>11.1f}{row['p99_ms']:>11.1f}{row['max_ms']:>11.1f}")
+
+
+def prompt_cache_stats() -> List[Dict]:
+    """Mean share of prompt tokens served from the (simulated) provider cache, per prompt kind."""
+    import metrics
+
+    totals = {}
+    for family in metrics.LLM_PROMPT_CACHE_RATIO.collect():
+        for sample in family.samples:
+            if sample.name.endswith(("_sum", "_count")):
+                key = sample.name.rsplit("_", 1)[1]
+                totals.setdefault(sample.labels["prompt"], {})[key] = sample.value
+    return [
+        {"prompt": prompt, "calls": int(values["count"]), "mean_cached_ratio": values["sum"] / values["count"]}
+        for prompt, values in sorted(totals.items()) if values.get("count")
+    ]
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="prism-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    configure_environment(args, workdir)
+
+    # Patch the service clients before any app module imports them.
+    fakes.install_openai("postgresql" if args.warehouse_url else "sqlite", args.llm_latency_ms, args.embedding_latency_ms)
+    fakes.install_qdrant()
+    if not args.mongo_uri:
+        fakes.install_mongomock()
+    connection = prepare_warehouse(args, workdir)
+
+    import main as app_main  # noqa: F401  (imports the whole app; some modules read files relative to prism-backend/)
+    import tracing
+
+    # Files the app writes at runtime (semantic descriptions, KPI registry) go to the work dir.
+    os.chdir(workdir)
+    try:
+        results = asyncio.run(run_benchmarks(args, connection))
+    finally:
+        tracing.shutdown()
+
+    print_results(results)
+    cache_stats = prompt_cache_stats()
+    for row in cache_stats:
+        print(f"prompt cache {row['prompt']:<20}{row['calls']:>6} calls {row['mean_cached_ratio']:>7.1%} cached")
+    if args.json_path:
+        report = {
+            "config": {key: value for key, value in vars(args).items() if key not in ("json_path", "verbose")},
+            "results": results,
+            "prompt_cache": cache_stats,
+        }
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    print(f"work dir: {workdir}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
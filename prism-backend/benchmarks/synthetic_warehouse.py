@@ -0,0 +1,183 @@
+import os
+import random
+import sqlite3
+from datetime import date, timedelta
+from typing import Dict
+
+from sqlalchemy import (
+    Column, Date, Float, ForeignKey, Integer, MetaData, String, Table, create_engine, event,
+)
+from sqlalchemy.ext.asyncio import create_async_engine
+
+# A small retail star schema (customers, products, orders, order_items) filled
+# with seeded random rows. Sizes scale with the number of orders.
+
+REGIONS = ["north", "south", "east", "west", "central"]
+SEGMENTS = ["consumer", "corporate", "small_business"]
+CATEGORIES = ["garden", "tools", "outdoor", "kitchen", "lighting", "storage", "pets", "paint"]
+STATUSES = ["placed", "shipped", "delivered", "returned", "cancelled"]
+START_DATE = date(2022, 1, 1)
+
+metadata = MetaData()
+
+customers = Table(
+    "customers", metadata,
+    Column("customer_id", Integer, primary_key=True),
+    Column("name", String(80), nullable=False),
+    Column("region", String(20), nullable=False),
+    Column("segment", String(20), nullable=False),
+    Column("signup_date", Date, nullable=False),
+)
+products = Table(
+    "products", metadata,
+    Column("product_id", Integer, primary_key=True),
+    Column("name", String(80), nullable=False),
+    Column("category", String(20), nullable=False),
+    Column("list_price", Float, nullable=False),
+)
+orders = Table(
+    "orders", metadata,
+    Column("order_id", Integer, primary_key=True),
+    Column("customer_id", Integer, ForeignKey("customers.customer_id"), nullable=False),
+    Column("order_date", Date, nullable=False),
+    Column("status", String(20), nullable=False),
+)
+order_items = Table(
+    "order_items", metadata,
+    Column("item_id", Integer, primary_key=True),
+    Column("order_id", Integer, ForeignKey("orders.order_id"), nullable=False),
+    Column("product_id", Integer, ForeignKey("products.product_id"), nullable=False),
+    Column("quantity", Integer, nullable=False),
+    Column("unit_price", Float, nullable=False),
+)
+
+# Same shape as the information_schema views read by tables_extractor.
+INFORMATION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tables (table_schema TEXT, table_name TEXT, table_type TEXT, table_rows INTEGER);
+CREATE TABLE IF NOT EXISTS columns (table_schema TEXT, table_name TEXT, column_name TEXT, ordinal_position INTEGER);
+DELETE FROM tables;
+DELETE FROM columns;
+"""
+
+
+def _rows(order_count: int, seed: int) -> Dict[Table, list]:
+    rng = random.Random(seed)
+    customer_count = max(order_count // 10, 10)
+    product_count = 200
+    days = 3 * 365
+
+    data = {
+        customers: [
+            {
+                "customer_id": index,
+                "name": f"Customer {index}",
+                "region": rng.choice(REGIONS),
+                "segment": rng.choice(SEGMENTS),
+                "signup_date": START_DATE + timedelta(days=rng.randrange(days)),
+            }
+            for index in range(1, customer_count + 1)
+        ],
+        products: [
+            {
+                "product_id": index,
+                "name": f"Product {index}",
+                "category": rng.choice(CATEGORIES),
+                "list_price": round(rng.uniform(2, 400), 2),
+            }
+            for index in range(1, product_count + 1)
+        ],
+        orders: [],
+        order_items: [],
+    }
+    item_id = 1
+    for order_id in range(1, order_count + 1):
+        data[orders].append({
+            "order_id": order_id,
+            "customer_id": rng.randint(1, customer_count),
+            "order_date": START_DATE + timedelta(days=rng.randrange(days)),
+            "status": rng.choice(STATUSES),
+        })
+        for _ in range(rng.randint(1, 5)):
+            data[order_items].append({
+                "item_id": item_id,
+                "order_id": order_id,
+                "product_id": rng.randint(1, product_count),
+                "quantity": rng.randint(1, 8),
+                "unit_price": round(rng.uniform(2, 400), 2),
+            })
+            item_id += 1
+    return data
+
+
+def populate(engine, order_count: int, seed: int = 7) -> Dict[str, int]:
+    """(Re)create the synthetic tables on `engine` and fill them. Returns row counts per table."""
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    data = _rows(order_count, seed)
+    with engine.begin() as connection:
+        for table in metadata.sorted_tables:
+            rows = data[table]
+            for start in range(0, len(rows), 10000):
+                connection.execute(table.insert(), rows[start:start + 10000])
+    return {table.name: len(rows) for table, rows in data.items()}
+
+
+def information_schema_path(path: str) -> str:
+    return f"{path}.information_schema"
+
+
+def write_information_schema(path: str) -> None:
+    """Catalog sidecar for a SQLite warehouse, attached to every session as `information_schema`."""
+    with sqlite3.connect(path) as source, sqlite3.connect(information_schema_path(path)) as catalog:
+        catalog.executescript(INFORMATION_SCHEMA)
+        table_names = [row[0] for row in source.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        )]
+        for table_name in table_names:
+            row_count = source.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+            catalog.execute("INSERT INTO tables VALUES ('main', ?, 'BASE TABLE', ?)", (table_name, row_count))
+            for column in source.execute(f"PRAGMA table_info('{table_name}')"):
+                catalog.execute("INSERT INTO columns VALUES ('main', ?, ?, ?)", (table_name, column[1], column[0] + 1))
+
+
+def _install_catalog(sync_engine, path: str) -> None:
+    @event.listens_for(sync_engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        # The app connects with db_type "mysql"; its catalog query filters on DATABASE().
+        dbapi_connection.create_function("DATABASE", 0, lambda: "main")
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f"ATTACH DATABASE '{information_schema_path(path)}' AS information_schema")
+        finally:
+            cursor.close()
+
+
+def sqlite_engine(path: str, pool_size: int, max_overflow: int):
+    engine = create_engine(
+        f"sqlite:///{path}",
+        connect_args={"check_same_thread": False},
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+    )
+    _install_catalog(engine, path)
+    return engine
+
+
+def sqlite_async_engine(path: str, pool_size: int, max_overflow: int):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}", pool_size=pool_size, max_overflow=max_overflow)
+    _install_catalog(engine.sync_engine, path)
+    return engine
+
+
+def build_sqlite(path: str, order_count: int, seed: int = 7) -> Dict[str, int]:
+    """Create a SQLite warehouse file (plus its catalog sidecar) with `order_count` orders."""
+    for stale in (path, information_schema_path(path)):
+        if os.path.exists(stale):
+            os.remove(stale)
+    engine = create_engine(f"sqlite:///{path}")
+    try:
+        counts = populate(engine, order_count, seed)
+    finally:
+        engine.dispose()
+    write_information_schema(path)
+    return counts
@@ -1,18 +1,21 @@
 import os
+import re
 import json
 import uuid
+import asyncio
+import logging
 from datetime import datetime
 from dotenv import load_dotenv
 # from langchain_openai import ChatOpenAI
 # from langchain_community.chat_models import AzureChatOpenAI
 from langchain_openai import AzureChatOpenAI
 
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import AIMessage, HumanMessage
 from langchain_core.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
 from langgraph.checkpoint.memory import MemorySaver
 from langchain_core.tools import tool
 from langgraph.prebuilt import create_react_agent
-from sqlalchemy import create_engine, text
+from contextvars import ContextVar
 from qdrant_client import QdrantClient
 import openai
 
@@ -20,13 +23,29 @@ from decimal import Decimal
 from datetime import datetime, date
 from sqlalchemy.engine import RowMapping
 from json import JSONEncoder
-from models import get_database_connection
+import async_models
+import fast_path
+import result_store
 from database import db_visualizations
+from warehouse import fetch_all_async, data_version_async
+from query_cache import get_cached_rows, store_rows
+from answer_cache import lookup_answer, store_answer
+from result_digest import digest_rows
+from metrics import FAST_PATH_TURNS, LLM_ERRORS, LLM_LATENCY, TOOL_LATENCY, LangChainMetrics, record_tokens, timed_call
+from tracing import LangChainTracer, span, traced
 # Load environment variables
 load_dotenv()
 
+# (user_id, db_id) of the conversation being served. A context variable rather than a
+# module global so concurrent requests on the event loop never see each other's tenant.
+current_tenant = ContextVar("current_tenant", default=("default", "default"))
+# What the tools did during the current turn: SQL they ran and whether a chart was saved.
+current_turn = ContextVar("current_turn", default=None)
+
+NO_ACCESS_ANSWER = "<b>Final Answer:</b> Sorry, I don't have access to answer your question."
+logger = logging.getLogger(__name__)
+
 # System Prompt Template
-user_id_array=["default","default"]
 memory = MemorySaver()
 system_prompt = f"""
 # Role
@@ -85,11 +104,19 @@ prompt = ChatPromptTemplate.from_messages([
     HumanMessagePromptTemplate.from_template("{input}")
 ])
 
+# Appended to the digest explain_sql_result returns; the agent writes the answer itself.
+explanation_guide = (
+    "Answer the user's question from this digest in one or two plain, business-friendly sentences, "
+    "as <b>Final Answer:</b> followed by your explanation. Use only the figures above, do not infer "
+    "missing or filtered values, and never mention tables, columns, schemas, SQL or queries."
+)
+
 # Model
 model = AzureChatOpenAI(    
     azure_deployment="gpt-4o",
     api_version="2024-12-01-preview",
-    temperature=0)
+    temperature=0,
+    callbacks=[LangChainTracer(), LangChainMetrics("gpt-4o", "agent")])
 
 # Load JSON files
 with open("semantic_database_description.json", encoding="utf-8") as f1:
@@ -113,6 +140,8 @@ class CustomJSONEncoder(json.JSONEncoder):
         return super().default(obj)
 
 # Embedding function
+@traced("embedding", "embedding", "client")
+@timed_call(LLM_LATENCY, LLM_ERRORS, operation="embedding", model="text-embedding-3-small")
 def embed_text(text):
     response = openai.AzureOpenAI(    
         azure_deployment="text-embedding-3-small",
@@ -120,6 +149,7 @@ def embed_text(text):
         model="text-embedding-3-small",
         input=text
     )
+    record_tokens("text-embedding-3-small", response.usage)
     return response.data[0].embedding
 
 def generate_echarts_from_data(chart_definitions: list):
@@ -273,27 +303,41 @@ def generate_echarts_from_data(chart_definitions: list):
     return results
 
 @tool
-def create_analytical_chart(data_json: str, chart_type: str, title: str, x_field: str, y_field: str, description: str = "") -> str:
+@traced("tool.create_analytical_chart", "tool")
+@timed_call(TOOL_LATENCY, tool="create_analytical_chart")
+def create_analytical_chart(chart_type: str, title: str, x_field: str, y_field: str, description: str = "", result_handle: str = "", data_json: str = "") -> str:
     """
     Create and save an ECharts visualization from SQL data using an array-based storage approach.
     
     Args:
-        data_json: JSON string containing the data from SQL query
         chart_type: Type of chart ('Bar', 'Line', 'Pie', 'Scatter', 'Radar')
         title: Title for the chart
         x_field: Field name for x-axis (categories)
         y_field: Field name for y-axis (values)
         description: Optional description of what the chart shows
+        result_handle: `result_handle` of a run_sql_query result to chart; leave empty for the latest one
+        data_json: Optional small JSON array of rows to chart instead of a stored result
     
     Returns:
         String with the operation status
     """
     try:
-        # Parse the data
-        data = json.loads(data_json)
+        # Load the stored result, parse inline data, or take the rows of the latest query
+        if result_handle and result_handle.strip():
+            data = result_store.get(current_tenant.get()[1], result_handle.strip())
+            if data is None:
+                return "❌ Result not found or expired; run the query again"
+        elif data_json and data_json.strip():
+            data = json.loads(data_json)
+        else:
+            data = (current_turn.get() or {}).get("rows")
         
         if not data:
             return "❌ No data provided for chart creation"
+
+        # Chart the requested fields when the result has more columns than the chart needs
+        if x_field in data[0] and y_field in data[0]:
+            data = [{x_field: row[x_field], y_field: row[y_field]} for row in data]
         
         # Generate unique chart ID
         chart_id = str(uuid.uuid4())[:8]
@@ -330,12 +374,16 @@ def create_analytical_chart(data_json: str, chart_type: str, title: str, x_field
             "created_at": datetime.now().isoformat()
         })
         
+        turn = current_turn.get()
+        if turn is not None:
+            turn["charted"] = True
+
         # Update MongoDB
         try:
             result = db_visualizations.update_one(
                 {
-                    "user_id": user_id_array[0], 
-                    "db_id": user_id_array[1]
+                    "user_id": current_tenant.get()[0], 
+                    "db_id": current_tenant.get()[1]
                 },
                 {
                     "$push": {
@@ -358,156 +406,129 @@ def create_analytical_chart(data_json: str, chart_type: str, title: str, x_field
     except Exception as e:
         return f"❌ Error creating chart: {str(e)}"
 @tool
-def run_sql_query(query: str) -> str:
-    """Execute SQL query and return results as JSON."""
+@traced("tool.run_sql_query", "tool")
+@timed_call(TOOL_LATENCY, tool="run_sql_query")
+async def run_sql_query(query: str) -> str:
+    """
+    Execute SQL query and return a fixed-size digest of the result as JSON: row count, per-column
+    summaries, top groups, trend over time, outliers and the first rows (all rows when `complete`).
+    `result_handle` refers to the full result for create_analytical_chart and explain_sql_result.
+    `cache_hit` is true when the rows came from the result cache.
+    """
     try:
-        data_connection = get_database_connection(user_id_array[0],user_id_array[1])
-        if data_connection["db_type"] == "postgresql":
-            # schema="alpl_prod"
-            # DATABASE_URL = f"postgresql+psycopg2://{data_connection['username']}:{data_connection['password']}@{data_connection['host']}:{data_connection['port']}/{data_connection['database']}?connect_timeout=10&options=-csearch_path%3D{schema}"
-            DATABASE_URL = f"postgresql+psycopg2://{data_connection['username']}:{data_connection['password']}@{data_connection['host']}:{data_connection['port']}/{data_connection['database']}?connect_timeout=10"
-
-        elif data_connection["db_type"] == "mysql":
-            DATABASE_URL = f"mysql+pymysql://{data_connection['username']}:{data_connection['password']}@{data_connection['host']}:{data_connection['port']}/{data_connection['database']}?connect_timeout=10"
-        else:
-            raise ValueError("Unsupported database type. Use 'postgresql' or 'mysql'.")
-        
-        engine = create_engine(DATABASE_URL)
-        with engine.connect() as conn:
-            result = conn.execute(text(query)).fetchall()
-            data = [dict(row._mapping) for row in result]
-        return json.dumps(data, indent=2, cls=CustomJSONEncoder)
+        data, cache_hit = await _query_rows(query)
+        digest, handle = await asyncio.gather(
+            asyncio.to_thread(digest_rows, data), asyncio.to_thread(_store_result, data)
+        )
+        turn = current_turn.get()
+        if turn is not None:
+            turn["digest"] = digest
+        return json.dumps({"cache_hit": cache_hit, "result_handle": handle, **digest}, cls=CustomJSONEncoder)
     except Exception as e:
         return f"❌ Error executing SQL: {str(e)}"
 
 
-def execute_sql_queries(queries, user_id,db_id):
-    """
-    Executes SQL queries and returns results for each query using the provided database_info.
-    """
-    database_info = get_database_connection(user_id,db_id)
-    # print(queries)
-    # Construct DB connection URL
-    db_type = database_info.get("db_type")
-    if db_type == "postgresql":
-        # schema="alpl_prod"
-        # db_url = f"postgresql+psycopg2://{database_info['username']}:{database_info['password']}@{database_info['host']}:{database_info['port']}/{database_info['database']}?connect_timeout=10&options=-csearch_path%3D{schema}"
-        db_url = f"postgresql+psycopg2://{database_info['username']}:{database_info['password']}@{database_info['host']}:{database_info['port']}/{database_info['database']}?connect_timeout=10"
-    elif db_type == "mysql":
-        db_url = f"mysql+pymysql://{database_info['username']}:{database_info['password']}@{database_info['host']}:{database_info['port']}/{database_info['database']}?connect_timeout=10"
-    else:
-        print("❌ Unsupported database type. Only 'postgresql' and 'mysql' are supported.")
-        return
-    
-    # Execute queries
-    results = []
+def _store_result(rows):
+    """Handle of the rows in the result store, or None when they could not be stored."""
     try:
-        engine = create_engine(db_url)
-        with engine.connect() as connection:
-            for item in queries:
-                chart_type = item.get("chart_type")
-                description = item.get("description")
-                sql = item.get("sql")
-                try:
-                    result = connection.execute(text(sql))
-                    rows = result.mappings().all()  # Convert each row to dict
-                    results.append({
-                        "chart_type": chart_type,
-                        "description": description,
-                        "sql": sql,
-                        "data": [dict(row) for row in rows]  # Ensure proper dict conversion
-                    })
-                except Exception as query_error:
-                    print(f"❌ Error executing SQL for '{description}': {query_error}")
-                    results.append({
-                        "chart_type": chart_type,
-                        "description": description,
-                        "sql": sql,
-                        "error": str(query_error)
-                    })
-    except Exception as conn_error:
-        print(f"❌ Database connection error: {conn_error}")
-        return []
-    
-    return results
-
-def sanitize_response(output: str) -> str:
-    forbidden_keywords = [
-        "table", "column", "schema", "sql", "query", "database", 
-        "field", "structure", "filtered", "bike_rider", "bike_rides"
-    ]
-    lower_output = output.lower()
-    if any(word in lower_output for word in forbidden_keywords):
-        return "<b>Final Answer:</b> Sorry, I don't have access to answer your question."
+        return result_store.put(current_tenant.get()[1], rows)
+    except Exception as e:
+        logger.error(f"Result store write failed: {e}")
+        return None
+
+
+async def _query_rows(query):
+    """Rows of `query` on the current tenant's warehouse, through the result cache; recorded on the turn."""
+    user_id, db_id = current_tenant.get()
+    turn = current_turn.get()
+    if turn is not None:
+        turn["sql"].append(query)
+    data = await get_cached_rows(db_id, query)
+    cache_hit = data is not None
+    if not cache_hit:
+        data_connection = await async_models.get_database_connection(user_id, db_id)
+        data = await fetch_all_async(data_connection, query)
+        await store_rows(db_id, query, data, encoder=CustomJSONEncoder)
+    if turn is not None:
+        turn["rows"], turn["digest"] = data, None
+        if turn["outcome"] is None:
+            turn["outcome"] = "answered"
+    return data, cache_hit
+
+
+def _refuse(turn):
+    """The no-access answer, marking the turn so it isn't cached."""
+    if turn is not None:
+        turn["outcome"] = "refused"
+    return NO_ACCESS_ANSWER
+
+
+# Words that give away the data model. Whole words only, so "stable", "profitable" or
+# "infrastructure" pass; lower case only, so a "Tables" product category does too.
+SCHEMA_WORDS = re.compile(r"\b(tables?|columns?|schemas?|fields?|query|queries|databases?|bike_riders?|bike_rides?)\b")
+SQL_WORD = re.compile(r"\bsql\b", re.IGNORECASE)
+
+
+def sanitize_response(output: str, identifiers=()) -> str:
+    """The answer, or NO_ACCESS_ANSWER if it names the data model or one of the snake_case `identifiers`."""
+    if SCHEMA_WORDS.search(output) or SQL_WORD.search(output):
+        return NO_ACCESS_ANSWER
+    for name in identifiers:
+        if "_" in str(name) and re.search(rf"\b{re.escape(str(name))}\b", output, re.IGNORECASE):
+            return NO_ACCESS_ANSWER
     return output
 
 # Tool: Explain SQL result
 @tool
-def explain_sql_result(context: str, question: str) -> str:
-    """Explain SQL query results to a non-technical user."""
-
-    # If context is empty or has no valid data, don't allow explanation
-    if not context or context.strip() in ["[]", "{}", "null"]:
-        return "<b>Final Answer:</b> Sorry, I don't have access to answer your question."
+@traced("tool.explain_sql_result", "tool")
+@timed_call(TOOL_LATENCY, tool="explain_sql_result")
+def explain_sql_result(question: str, context: str = "", result_handle: str = "") -> str:
+    """
+    Summarize SQL query results for explaining them to a non-technical user: row count,
+    totals, top items with their shares and any trend over time. Pass the `result_handle`
+    of a run_sql_query result, or leave both it and `context` empty to use the latest one.
+    """
+    turn = current_turn.get()
+    if result_handle and result_handle.strip():
+        rows = result_store.get(current_tenant.get()[1], result_handle.strip())
+    elif not context or not context.strip():
+        rows = (turn or {}).get("rows")
+    else:
+        try:
+            parsed = json.loads(context)
+        except Exception:
+            return _refuse(turn)
+        # A run_sql_query digest stands for the rows kept on the turn.
+        rows = parsed.get("data", (turn or {}).get("rows")) if isinstance(parsed, dict) else parsed
 
-    try:
-        parsed = json.loads(context)
-        if isinstance(parsed, list) and len(parsed) == 0:
-            return "<b>Final Answer:</b> Sorry, I don't have access to answer your question."
-        if isinstance(parsed, dict) and not parsed:
-            return "<b>Final Answer:</b> Sorry, I don't have access to answer your question."
-    except Exception:
-        return "<b>Final Answer:</b> Sorry, I don't have access to answer your question."
-
-    exp_prompt = f"""
-# Role
-You are a concise and helpful data analyst assistant who explains SQL query results in plain English, without exposing any technical metadata unless explicitly required.
-
-# Objective
-You are given:
-- A SQL result as context
-- A user question
-
-Your task is to:
-1. Understand the user question.
-2. Interpret the SQL result in clear, business-friendly language.
-3. Do not mention table names, column names, values like "bike_rider", or SQL structures.
-4. Do not infer missing or filtered values.
-5. If the context is ambiguous or you are unsure, reply with:
-   <b>Final Answer:</b> Sorry, I don't have access to answer your question.
-
-# Output Rules
-- Always respond using HTML tags.
-- Wrap your explanation like this: <b>Final Answer:</b> Your explanation.
-- Never use technical terms like "column", "schema", "table", "SQL", or "query".
-- Never assume or fabricate a filtered value (e.g., "account_type is bike_rider").
-
-# Input
-Explain this SQL result:
-{context}
-Based on the user question:
-{question}
-"""
+    # If there is no data, don't allow explanation
+    if not rows or not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        return _refuse(turn)
 
-    formatted = prompt.format_messages(input=exp_prompt)
-    raw_output = model.invoke(formatted).content
-    return sanitize_response(raw_output)
+    # Reuse the digest run_sql_query already computed for these rows.
+    latest = turn or {}
+    digest = latest["digest"] if rows is latest.get("rows") and latest.get("digest") else digest_rows(rows)
+    return f"Result digest for \"{question}\":\n{json.dumps(digest, cls=CustomJSONEncoder)}\n{explanation_guide}"
 
 # Tool: Extract relevant info from vector DB
 @tool
+@traced("tool.extract_revelent_info_from_vector_db", "tool")
+@timed_call(TOOL_LATENCY, tool="extract_revelent_info_from_vector_db")
 def extract_revelent_info_from_vector_db(question: str) -> str:
     """Retrieve relevant information from vector DB based on the question."""
     score_threshold = 0.15
     search_limit = 50
     qdrant = QdrantClient(host="localhost", port=6333)
     query_vector = embed_text(question)
+    user_id, db_id = current_tenant.get()
 
-    results = qdrant.search(
-        collection_name=user_id_array[0],
-        query_vector=query_vector,
-        limit=search_limit,
-        score_threshold=score_threshold
-    )
+    with span("vector.search", "vector", "client", **{"db.system": "qdrant"}):
+        results = qdrant.search(
+            collection_name=user_id + db_id,  # as named by vectordb_insertion
+            query_vector=query_vector,
+            limit=search_limit,
+            score_threshold=score_threshold
+        )
 
     llm_context = {
         "query_related_tables": [],
@@ -541,18 +562,100 @@ def extract_revelent_info_from_vector_db(question: str) -> str:
 
     return str(llm_context)
 
-def conversational_agent(user_input, user_id,db_id):
-    user_id_array[0] = user_id
-    user_id_array[1]=db_id
+# Agent setup
+tools = [run_sql_query, explain_sql_result, extract_revelent_info_from_vector_db, create_analytical_chart]
+agent_executor = create_react_agent(model, tools, checkpointer=memory)
 
-    print(user_id_array)
-    # Agent setup
-    tools = [run_sql_query, explain_sql_result, extract_revelent_info_from_vector_db, create_analytical_chart]
-    agent_executor = create_react_agent(model, tools, checkpointer=memory)
 
-    # Agent loop
+async def _answer_cache_context(user_input, user_id, db_id):
+    """(question vector, schema version, data version) for the answer cache, or None if unavailable."""
+    try:
+        data_connection = await async_models.get_database_connection(user_id, db_id)
+        return await asyncio.gather(
+            asyncio.to_thread(embed_text, user_input),
+            async_models.get_schema_version(user_id, db_id),
+            data_version_async(data_connection),
+        )
+    except Exception as e:
+        logger.error(f"Answer cache unavailable for this turn: {e}")
+        return None
+
+
+@traced("chat.fast_path", "fast_path")
+async def _fast_path_answer(user_input, user_id, db_id, previous_question=""):
+    """Answer a direct metric question with one planning call and one query, or None to use the agent."""
+    if not fast_path.is_candidate(user_input):
+        FAST_PATH_TURNS.labels(outcome="skipped").inc()
+        return None
+    turn = current_turn.get()
+    try:
+        data_connection = await async_models.get_database_connection(user_id, db_id)
+        planned = await fast_path.plan(user_input, user_id, db_id, data_connection, previous_question)
+        if planned is None:
+            FAST_PATH_TURNS.labels(outcome="declined").inc()
+            return None
+        rows, _ = await _query_rows(planned["sql"])
+        answer = fast_path.render_answer(planned["answer"], rows)
+        if answer is not None and sanitize_response(answer) == answer:
+            FAST_PATH_TURNS.labels(outcome="answered").inc()
+            return answer
+    except Exception as e:
+        logger.error(f"Fast path failed, using the agent: {e}")
+    # The agent starts over; SQL and rows from the abandoned attempt aren't part of its answer.
+    turn["sql"].clear()
+    turn["rows"] = turn["digest"] = None
+    turn["outcome"] = None
+    FAST_PATH_TURNS.labels(outcome="fallback").inc()
+    return None
+
+
+async def _previous_question(config):
+    """The thread's last user question, or "" when this turn starts the conversation."""
+    state = await agent_executor.aget_state(config)
+    messages = state.values.get("messages", []) if state is not None else []
+    return next((message.content for message in reversed(messages) if isinstance(message, HumanMessage)), "")
+
+
+async def _remember_exchange(config, user_input, answer):
+    """Record a turn answered outside the agent, so follow-up questions that do go through it keep their context."""
+    await agent_executor.aupdate_state(
+        config, {"messages": [HumanMessage(content=user_input), AIMessage(content=answer)]}, as_node="agent"
+    )
+
+
+async def conversational_agent(user_input, user_id,db_id):
+    current_tenant.set((user_id, db_id))
+    # outcome: "answered" once rows back the answer, "refused" when a tool or the answer says no access.
+    turn = {"sql": [], "rows": None, "digest": None, "charted": False, "outcome": None}
+    current_turn.set(turn)
     config = {"configurable": {"thread_id": f"{user_id+db_id}"}}
-    
-    result = agent_executor.invoke({"messages": [HumanMessage(content=user_input)]}, config=config)
+    previous_question = await _previous_question(config)
+
+    cache_context = await _answer_cache_context(user_input, user_id, db_id)
+    if cache_context:
+        cached = await lookup_answer(db_id, *cache_context, context=previous_question)
+        if cached:
+            await _remember_exchange(config, user_input, cached["answer"])
+            return cached["answer"]
 
-    return result["messages"][-1].content
\ No newline at end of file
+    # Agent loop
+    answer = await _fast_path_answer(user_input, user_id, db_id, previous_question)
+    if answer is not None:
+        await _remember_exchange(config, user_input, answer)
+    else:
+        result = await agent_executor.ainvoke({"messages": [HumanMessage(content=user_input)]}, config=config)
+        # The agent writes its answer from the digest, which names columns; keep them out of what the user sees.
+        columns = list(turn["rows"][0]) if turn["rows"] and isinstance(turn["rows"][0], dict) else []
+        answer = sanitize_response(result["messages"][-1].content, columns)
+        if answer.strip() == NO_ACCESS_ANSWER:
+            turn["outcome"] = "refused"
+
+    # Only answers derived from data are reusable; charts are a side effect the next asker still needs.
+    if cache_context and turn["sql"] and not turn["charted"] and turn["outcome"] == "answered":
+        question_vector, schema_version, data_version = cache_context
+        await store_answer(
+            db_id, user_input, question_vector, answer, turn["sql"], schema_version, data_version,
+            context=previous_question,
+        )
+
+    return answer
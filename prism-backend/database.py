@@ -1,10 +1,14 @@
-from pymongo import MongoClient 
+from pymongo import MongoClient, AsyncMongoClient
 import os 
 from dotenv import load_dotenv
+from tracing import MongoCommandTracer
 
 load_dotenv()
 
-client=MongoClient(os.getenv("MONGO_URI"))
+# Every command from either client shows up as a span in the request's trace
+mongo_tracer=MongoCommandTracer()
+
+client=MongoClient(os.getenv("MONGO_URI"),event_listeners=[mongo_tracer])
 
 db=client["prism-test"]
 users_collection=db["users"]
@@ -20,4 +24,30 @@ db_generated_semantics=db["db_generated_semantics"]
 db_kpis=db["db_kpis"]
 
 db_visualizations=db["visualizations"]
-# db_pined_visualizations=db["pined_visualizations"]
\ No newline at end of file
+
+db_query_cache=db["query_cache"]
+
+db_table_catalog=db["table_catalog"]
+# db_pined_visualizations=db["pined_visualizations"]
+
+# Async handles over the same collections, used by the async request handlers.
+async_client=AsyncMongoClient(os.getenv("MONGO_URI"),event_listeners=[mongo_tracer])
+
+async_db=async_client["prism-test"]
+async_users_collection=async_db["users"]
+
+async_database_connections=async_db["database_connections"]
+
+async_db_authorized_tables_columns_info=async_db["authorized_tables_columns_info"]
+
+async_db_extracted_schema=async_db["db_extracted_schema"]
+
+async_db_generated_semantics=async_db["db_generated_semantics"]
+
+async_db_kpis=async_db["db_kpis"]
+
+async_db_visualizations=async_db["visualizations"]
+
+async_db_query_cache=async_db["query_cache"]
+
+async_db_table_catalog=async_db["table_catalog"]
@@ -0,0 +1,119 @@
+import logging
+import sys
+from typing import Dict, List, Tuple
+
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel
+
+from database import (
+    users_collection,
+    database_connections,
+    db_authorized_tables_columns_info,
+    db_extracted_schema,
+    db_generated_semantics,
+    db_kpis,
+    db_visualizations,
+    db_query_cache,
+    db_table_catalog,
+)
+
+logger = logging.getLogger(__name__)
+
+# Every collection keyed by the (user_id, db_id) pair gets the same compound index.
+_TENANT_KEYS = [("user_id", ASCENDING), ("db_id", ASCENDING)]
+
+INDEXES: List[Tuple[object, List[IndexModel]]] = [
+    (users_collection, [IndexModel([("email", ASCENDING)], name="email_unique", unique=True)]),
+    (database_connections, [IndexModel([("user_id", ASCENDING)], name="user_id")]),
+    (db_authorized_tables_columns_info, [IndexModel(_TENANT_KEYS, name="user_db")]),
+    (db_extracted_schema, [IndexModel(_TENANT_KEYS, name="user_db")]),
+    (db_generated_semantics, [IndexModel(_TENANT_KEYS, name="user_db")]),
+    (db_kpis, [IndexModel(_TENANT_KEYS, name="user_db")]),
+    (db_visualizations, [IndexModel(_TENANT_KEYS, name="user_db")]),
+    (db_query_cache, [
+        IndexModel([("key", ASCENDING)], name="key_unique", unique=True),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ]),
+    (db_table_catalog, [
+        IndexModel(_TENANT_KEYS + [("table_name", ASCENDING)], name="user_db_table_unique", unique=True),
+    ]),
+]
+
+# Query shapes issued on hot request paths (models.py / main.py). Values are
+# placeholders; only the shape matters to the planner.
+HOT_QUERY_SHAPES: List[Tuple[object, Dict]] = [
+    (users_collection, {"email": "probe@example.com"}),
+    (users_collection, {"_id": ObjectId()}),
+    (database_connections, {"user_id": "probe"}),
+    (database_connections, {"user_id": "probe", "_id": ObjectId()}),
+    (db_authorized_tables_columns_info, {"user_id": "probe", "db_id": "probe"}),
+    (db_extracted_schema, {"user_id": "probe", "db_id": "probe"}),
+    (db_generated_semantics, {"user_id": "probe", "db_id": "probe"}),
+    (db_kpis, {"user_id": "probe", "db_id": "probe"}),
+    (db_visualizations, {"user_id": "probe", "db_id": "probe"}),
+    (db_table_catalog, {"user_id": "probe", "db_id": "probe"}),
+]
+
+
+def ensure_indexes() -> List[str]:
+    """
+    Create the indexes backing the hot query shapes. Safe to call on every
+    startup; Mongo treats re-creating an identical index as a no-op.
+
+    Returns:
+        Names of the collections whose indexes could not be created.
+    """
+    failed = []
+    for collection, indexes in INDEXES:
+        try:
+            created = collection.create_indexes(indexes)
+            logger.info(f"Ensured indexes on {collection.name}: {created}")
+        except Exception as e:
+            logger.error(f"Failed to ensure indexes on {collection.name}: {e}")
+            failed.append(collection.name)
+    return failed
+
+
+def _winning_stages(plan: Dict) -> List[str]:
+    stages = [plan.get("stage")]
+    if "inputStage" in plan:
+        stages += _winning_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        stages += _winning_stages(child)
+    return [stage for stage in stages if stage]
+
+
+def audit_query_shapes() -> List[Dict]:
+    """
+    Run `explain` for every hot query shape and report the ones whose winning
+    plan falls back to a collection scan.
+
+    Returns:
+        List of {"collection", "filter", "stages"} for every COLLSCAN found.
+    """
+    offenders = []
+    for collection, query in HOT_QUERY_SHAPES:
+        explain = collection.find(query).explain()
+        plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+        # Newer servers nest the classic plan under queryPlan.
+        stages = _winning_stages(plan.get("queryPlan", plan))
+        if "COLLSCAN" in stages:
+            offenders.append({
+                "collection": collection.name,
+                "filter": {key: type(value).__name__ for key, value in query.items()},
+                "stages": stages,
+            })
+    return offenders
+
+
+if __name__ == "__main__":
+    # python db_indexes.py [--no-create] -> exits non-zero when a hot query shape does a COLLSCAN
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if "--no-create" not in sys.argv and ensure_indexes():
+        sys.exit(1)
+    collscans = audit_query_shapes()
+    for offender in collscans:
+        logger.error(f"COLLSCAN on {offender['collection']} for {offender['filter']}: {offender['stages']}")
+    if collscans:
+        sys.exit(1)
+    logger.info("All hot query shapes are index-backed.")
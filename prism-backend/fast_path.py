@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import os
+import re
+from datetime import date, datetime
+from decimal import Decimal
+from string import Formatter
+from typing import Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from openai import AzureOpenAI
+
+import async_models
+from formula_validator import SchemaIndex, validate_sql
+from metrics import LLM_ERRORS, LLM_LATENCY, record_tokens, timed
+from prompt_budget import count_tokens, pack_schema
+from tracing import set_llm_usage, span
+from ttl_cache import TTLCache
+from warehouse import table_row_estimates
+
+logger = logging.getLogger(__name__)
+
+# Direct metric questions ("total revenue last month") are planned with one
+# structured LLM call (SQL + answer template), run once, and formatted here;
+# anything else, or any failure along the way, goes to the full agent.
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "true").lower() in ("1", "true", "yes")
+FAST_PATH_PROMPT_TOKEN_BUDGET = int(os.getenv("FAST_PATH_PROMPT_TOKEN_BUDGET", "4000"))
+FAST_PATH_CONTEXT_CACHE_SECONDS = int(os.getenv("FAST_PATH_CONTEXT_CACHE_SECONDS", "900"))
+
+# Charts are a side effect only the agent's tool produces.
+CHART_WORDS = re.compile(r"\b(chart|graph|plot|visuali[sz]e|visuali[sz]ation)\b", re.IGNORECASE)
+
+FAST_PATH_INSTRUCTIONS = """
+You plan answers to business questions over a SQL database in a single step.
+Decide whether the question is simple: answerable by ONE read-only SELECT that returns exactly one row,
+with no chart, no explanation of causes and no follow-up context from an earlier conversation.
+When the previous question of the conversation is given, the question is not simple if it only makes sense
+together with it ("and last month?", "break that down by region", "why?").
+
+Return ONLY a JSON object:
+{"simple": true, "sql": "SELECT ...", "answer": "<b>Final Answer:</b> ..."}
+or, when the question is not simple or the schema cannot answer it:
+{"simple": false}
+
+Rules for "sql":
+- A single SELECT in the given SQL dialect, using only the tables and columns in the schema digest.
+- Give every selected expression a short snake_case alias.
+
+Rules for "answer":
+- One business-friendly HTML sentence starting with <b>Final Answer:</b>.
+- Put each value as {alias} of a selected expression; the values are filled in after the query runs.
+- Use no other curly braces.
+- Never say "table", "column", "schema", "field", "query", "SQL" or "database".
+
+The schema digest lists each table as `name [fact|dimension, ~rows]: what it holds`, followed by its columns as
+`column TYPE`, `PK` for primary keys, `-> table.column` for foreign keys, and a value range or sample values.
+"""
+
+client = AzureOpenAI(
+    azure_deployment="gpt-4o",
+    api_version="2024-12-01-preview",
+)
+
+_contexts = TTLCache(256, FAST_PATH_CONTEXT_CACHE_SECONDS, name="fast_path_contexts")
+
+
+def is_candidate(question: str) -> bool:
+    return FAST_PATH_ENABLED and not CHART_WORDS.search(question)
+
+
+async def _tenant_context(user_id: str, db_id: str, data_connection: Dict) -> Dict:
+    """Schema digest and validation index for a connection, rebuilt when it is re-onboarded."""
+    version = await async_models.get_schema_version(user_id, db_id)
+    cached = _contexts.get((user_id, db_id))
+    if cached is not None and cached["version"] == version:
+        return cached
+
+    semantics, schema, row_estimates = await asyncio.gather(
+        async_models.get_semantic_data(user_id, db_id),
+        async_models.get_extracted_schema(user_id, db_id),
+        run_in_threadpool(table_row_estimates, data_connection),
+    )
+    db_name = next(iter(semantics))
+    semantic_tables = {
+        name: table for name, table in semantics[db_name].items() if name != "database_description"
+    }
+    budget = FAST_PATH_PROMPT_TOKEN_BUDGET - count_tokens(FAST_PATH_INSTRUCTIONS)
+    digests = pack_schema(semantic_tables, schema, row_estimates, budget, 1)
+    context = {
+        "version": version,
+        "digest": digests[0] if digests else "",
+        "index": SchemaIndex({name: list(table.get("columns", {})) for name, table in semantic_tables.items()}),
+    }
+    _contexts.set((user_id, db_id), context)
+    return context
+
+
+def _ask_planner(digest: str, db_type: str, question: str, previous_question: str) -> Dict:
+    prompt = f"SQL dialect: {db_type}\n\nSchema digest:\n{digest}\n\n"
+    if previous_question:
+        prompt += f"Previous question: {previous_question}\n\n"
+    with span("llm.chat", "llm", "client", **{"gen_ai.request.model": "gpt-4o"}) as llm_span, \
+            timed(LLM_LATENCY, LLM_ERRORS, operation="chat", model="gpt-4o"):
+        response = client.chat.completions.create(
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": FAST_PATH_INSTRUCTIONS},
+                {"role": "user", "content": prompt + f"Question: {question}"},
+            ],
+            response_format={"type": "json_object"},
+            temperature=0,
+        )
+        set_llm_usage(llm_span, response.usage)
+    record_tokens("gpt-4o", response.usage, "fast_path")
+    return json.loads(response.choices[0].message.content)
+
+
+async def plan(question: str, user_id: str, db_id: str, data_connection: Dict, previous_question: str = "") -> Optional[Dict]:
+    """
+    One structured LLM call deciding whether `question` is a direct metric question.
+    `previous_question` is the thread's last question, so follow-ups are left to the agent.
+
+    Returns:
+        {"sql": ..., "answer": template} for a simple question whose SQL
+        validates against the connection's schema, otherwise None.
+    """
+    context = await _tenant_context(user_id, db_id, data_connection)
+    planned = await asyncio.to_thread(
+        _ask_planner, context["digest"], data_connection["db_type"], question, previous_question
+    )
+    if not planned.get("simple") or not planned.get("sql") or not planned.get("answer"):
+        return None
+    errors = [d for d in validate_sql(planned["sql"], context["index"]) if d.severity == "error"]
+    if errors:
+        logger.info(f"Fast path SQL rejected for {db_id}: {errors[0].message}")
+        return None
+    return {"sql": planned["sql"], "answer": planned["answer"]}
+
+
+def _format_value(value) -> str:
+    if isinstance(value, bool):
+        return "yes" if value else "no"
+    if isinstance(value, int):
+        return f"{value:,}"
+    if isinstance(value, (float, Decimal)):
+        return f"{value:,.0f}" if value == int(value) else f"{value:,.2f}"
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def render_answer(template: str, rows: List[Dict]) -> Optional[str]:
+    """
+    Fill the planner's answer template from a single result row. None when
+    the result isn't one row or a placeholder has no (non-null) value.
+    """
+    if len(rows) != 1:
+        return None
+    row = {str(key).lower(): value for key, value in rows[0].items()}
+    values = {}
+    try:
+        for _, field, spec, conversion in Formatter().parse(template):
+            if field is None:
+                continue
+            if spec or conversion or row.get(field.lower()) is None:
+                return None
+            values[field] = _format_value(row[field.lower()])
+        return template.format(**values)
+    except (ValueError, IndexError, KeyError):
+        return None
@@ -0,0 +1,465 @@
+from typing import Dict, List, Optional, Set
+
+import sqlparse
+from pydantic import BaseModel
+from sqlparse import sql as ast
+from sqlparse import tokens as T
+
+# Validates KPI SQL on the sqlparse token tree instead of regexes over the raw
+# string: every table and column reference is resolved against a hash index of
+# the schema, so a formula is checked in one pass over its tokens.
+
+AGGREGATES = {
+    "SUM", "AVG", "COUNT", "MAX", "MIN", "STDDEV", "STDDEV_POP", "STDDEV_SAMP",
+    "VARIANCE", "VAR_POP", "VAR_SAMP", "ARRAY_AGG", "STRING_AGG", "GROUP_CONCAT",
+    "BOOL_AND", "BOOL_OR", "PERCENTILE_CONT", "PERCENTILE_DISC", "MEDIAN",
+}
+# Type names that prefix literals (INTERVAL '1 day') and parse as plain names.
+TYPED_LITERALS = {"interval", "date", "time", "timestamp"}
+
+
+class FormulaDiagnostic(BaseModel):
+    severity: str  # "error" or "warning"
+    code: str
+    message: str
+    reference: Optional[str] = None
+
+
+class SchemaIndex:
+    """Case-insensitive table -> columns and column -> tables lookups over a schema dict."""
+
+    def __init__(self, schema: Dict[str, List[str]]):
+        self.tables: Dict[str, str] = {}
+        self.columns: Dict[str, Set[str]] = {}
+        self.column_tables: Dict[str, Set[str]] = {}
+        for table, columns in schema.items():
+            key = table.lower()
+            self.tables[key] = table
+            self.columns[key] = {column.lower() for column in columns}
+            for column in self.columns[key]:
+                self.column_tables.setdefault(column, set()).add(key)
+
+    def has_column(self, table: str, column: str) -> bool:
+        return column in self.columns.get(table, ())
+
+
+class _Scan:
+    """References collected while walking one SELECT; subqueries get child scans."""
+
+    def __init__(self, parent: Optional["_Scan"] = None):
+        self.parent = parent
+        self.children = []
+        self.tables = []            # (name, alias)
+        self.derived = set()        # aliases of subqueries and CTE names
+        self.columns = []           # (qualifier, name)
+        self.output_aliases = set()
+        self.select_items = []      # {"alias": ..., "columns": [...]} for the top-level SELECT list
+        self.group_by = set()
+        self.group_positions = set()
+        self.has_aggregate = False
+        self.clause = None
+        self.item = None
+        self.aggregate_depth = 0
+
+
+def _is_skippable(token) -> bool:
+    return token.is_whitespace or token.ttype in T.Comment or isinstance(token, ast.Comment)
+
+
+def _is_subquery(parenthesis) -> bool:
+    first = parenthesis.token_next(0)[1]
+    return first is not None and first.ttype is T.DML
+
+
+def _column_chain(identifier: ast.Identifier) -> bool:
+    first = identifier.token_first(skip_cm=True)
+    return first is not None and (first.ttype in T.Name or first.ttype is T.String.Symbol)
+
+
+def _is_filter(token) -> bool:
+    """A `FILTER (WHERE ...)` clause, which sqlparse leaves beside its aggregate rather than inside it."""
+    if isinstance(token, ast.Identifier):
+        token = token.token_first(skip_cm=True)
+    return isinstance(token, ast.Function) and (token.get_name() or "").upper() == "FILTER"
+
+
+def _alias(token) -> Optional[str]:
+    """Alias of a select item, including names sqlparse lexes as builtins after AS (`... AS date`)."""
+    if not isinstance(token, ast.Identifier):
+        return None
+    alias = token.get_alias()
+    if alias:
+        return alias
+    after_as = False
+    for part in token.tokens:
+        if part.is_whitespace:
+            continue
+        if after_as:
+            return part.value.strip('"`')
+        after_as = part.ttype in T.Keyword and part.normalized == "AS"
+    return None
+
+
+def _group_alias(token, scan: _Scan) -> Optional[str]:
+    """A GROUP BY item naming a select-list alias that sqlparse lexes as a keyword (month, year, date)."""
+    if token.ttype in T.Keyword or token.ttype in T.Name.Builtin:
+        name = token.value.lower()
+        if any(item["alias"] == name for item in scan.select_items):
+            return name
+    return None
+
+
+def _walk(tokens, scan: _Scan, top: bool, in_function: bool = False) -> None:
+    expect = None
+    for token in tokens.tokens:
+        if _is_skippable(token) or token.ttype is T.Punctuation:
+            continue
+        if top and scan.clause == "GROUP BY" and _group_alias(token, scan):
+            scan.group_by.add(_group_alias(token, scan))
+            continue
+        if token.ttype in T.Keyword:
+            keyword = token.normalized
+            if keyword == "WITH":
+                expect = "cte"
+            elif not in_function and (keyword == "FROM" or keyword.endswith("JOIN")):
+                expect = "table"
+            else:
+                expect = None
+            if top:
+                scan.clause = keyword
+            continue
+
+        if expect is not None:
+            items = token.get_identifiers() if isinstance(token, ast.IdentifierList) else [token]
+            for item in items:
+                if expect == "cte":
+                    _add_cte(item, scan)
+                else:
+                    _add_table(item, scan)
+            expect = None
+            continue
+
+        if top and scan.clause == "SELECT":
+            items = token.get_identifiers() if isinstance(token, ast.IdentifierList) else [token]
+            for item in items:
+                alias = _alias(item)
+                if _is_filter(item) and scan.select_items:
+                    scan.item = scan.select_items[-1]
+                    scan.item["alias"] = alias.lower() if alias else scan.item["alias"]
+                else:
+                    scan.item = {"alias": alias.lower() if alias else None, "columns": []}
+                    scan.select_items.append(scan.item)
+                _visit(item, scan, top, in_function)
+            scan.item = None
+        elif top and scan.clause == "GROUP BY":
+            items = token.get_identifiers() if isinstance(token, ast.IdentifierList) else [token]
+            for item in items:
+                if item.ttype in T.Number.Integer:
+                    scan.group_positions.add(int(item.value))
+                elif _group_alias(item, scan):
+                    scan.group_by.add(_group_alias(item, scan))
+                else:
+                    grouped = _Scan(scan)
+                    _visit(item, grouped, False, in_function)
+                    scan.group_by.update(name for _, name in grouped.columns)
+                    scan.columns.extend(grouped.columns)
+                    scan.children.extend(grouped.children)
+        else:
+            _visit(token, scan, top, in_function)
+
+
+def _visit(token, scan: _Scan, top: bool, in_function: bool) -> None:
+    if isinstance(token, ast.Function):
+        name = (token.get_name() or "").upper()
+        windowed = any(isinstance(part, ast.Over) for part in token.tokens)
+        # Window functions keep their rows, so they need no GROUP BY; columns inside them or
+        # a FILTER clause are not bare select-list columns either.
+        aggregate = name in AGGREGATES and not windowed
+        nested = aggregate or windowed or name == "FILTER"
+        if aggregate:
+            scan.has_aggregate = True
+        if nested:
+            scan.aggregate_depth += 1
+        for part in token.tokens[1:]:
+            _visit(part, scan, False, True)
+        if nested:
+            scan.aggregate_depth -= 1
+    elif isinstance(token, ast.Identifier):
+        if _column_chain(token):
+            if token.tokens[-1].ttype is T.Wildcard or any(t.ttype is T.Wildcard for t in token.tokens):
+                scan.columns.append((token.get_parent_name().lower(), "*"))
+            else:
+                _add_column(token.get_parent_name(), token.get_real_name(), scan)
+        else:
+            first = token.token_first(skip_cm=True)
+            if first is not None:
+                _visit(first, scan, top, in_function)
+            for part in token.tokens[1:]:
+                if _is_filter(part):
+                    _visit(part, scan, top, in_function)
+        alias = _alias(token)
+        if alias:
+            scan.output_aliases.add(alias.lower())
+    elif isinstance(token, ast.Parenthesis):
+        if _is_subquery(token):
+            _walk(token, _child(scan), False)
+        else:
+            _walk(token, scan, False, in_function)
+    elif token.is_group:
+        _walk(token, scan, top and isinstance(token, ast.Where), in_function)
+    elif token.ttype in T.Name:
+        _add_column(None, token.value, scan)
+
+
+def _child(scan: _Scan) -> _Scan:
+    child = _Scan(scan)
+    scan.children.append(child)
+    return child
+
+
+def _add_column(qualifier: Optional[str], name: str, scan: _Scan) -> None:
+    reference = (qualifier.lower() if qualifier else None, name.lower())
+    scan.columns.append(reference)
+    if scan.item is not None and scan.aggregate_depth == 0:
+        scan.item["columns"].append(reference)
+
+
+def _add_table(item, scan: _Scan) -> None:
+    if isinstance(item, ast.Identifier):
+        first = item.token_first(skip_cm=True)
+        if isinstance(first, (ast.Parenthesis, ast.Function)):
+            _visit(first, scan, False, False)
+            if item.get_alias():
+                scan.derived.add(item.get_alias().lower())
+            return
+        scan.tables.append((item.get_real_name().lower(), (item.get_alias() or "").lower() or None))
+    elif isinstance(item, (ast.Parenthesis, ast.Function)):
+        _visit(item, scan, False, False)
+    elif item.ttype in T.Name:
+        scan.tables.append((item.value.lower(), None))
+
+
+def _add_cte(item, scan: _Scan) -> None:
+    if not isinstance(item, ast.Identifier):
+        return
+    scan.derived.add(item.token_first(skip_cm=True).value.lower())
+    for part in item.tokens:
+        if isinstance(part, ast.Parenthesis):
+            _walk(part, _child(scan), False)
+
+
+class _Scope:
+    """Tables visible to one scan, falling back to the enclosing query for correlated references."""
+
+    def __init__(self, scan: _Scan, index: SchemaIndex, parent: Optional["_Scope"], diagnostics: List[FormulaDiagnostic]):
+        self.parent = parent
+        self.derived = set(scan.derived)
+        self.aliases: Dict[str, Optional[str]] = {name: None for name in scan.derived}
+        self.tables: Set[str] = set()
+        for name, alias in scan.tables:
+            if self.is_derived(name):
+                self.aliases[alias or name] = None
+                continue
+            if name not in index.tables:
+                diagnostics.append(FormulaDiagnostic(
+                    severity="error", code="unknown_table", reference=name,
+                    message=f"Table '{name}' not found in database schema.",
+                ))
+                # Resolve its columns opaquely rather than reporting each one.
+                self.aliases[alias or name] = None
+                continue
+            self.tables.add(name)
+            self.aliases[name] = name
+            if alias:
+                self.aliases[alias] = name
+        self.opaque = any(table is None for table in self.aliases.values())
+
+    def is_derived(self, name: str) -> bool:
+        return name in self.derived or (self.parent is not None and self.parent.is_derived(name))
+
+    def qualifier(self, name: str):
+        """(found, table) for a table name or alias, searching enclosing scopes."""
+        if name in self.aliases:
+            return True, self.aliases[name]
+        return self.parent.qualifier(name) if self.parent else (False, None)
+
+    def owners(self, column: str, index: SchemaIndex):
+        """(tables owning the column at the nearest level that has it, whether an opaque table could own it)."""
+        owners = index.column_tables.get(column, set()) & self.tables
+        if owners or self.opaque:
+            return owners, self.opaque
+        return self.parent.owners(column, index) if self.parent else (set(), False)
+
+
+def _resolve(scan: _Scan, index: SchemaIndex, parent: Optional[_Scope], diagnostics: List[FormulaDiagnostic]) -> None:
+    scope = _Scope(scan, index, parent, diagnostics)
+    for child in scan.children:
+        _resolve(child, index, scope, diagnostics)
+
+    for qualifier, name in scan.columns:
+        reference = f"{qualifier}.{name}" if qualifier else name
+        if qualifier is not None:
+            found, table = scope.qualifier(qualifier)
+            if not found:
+                diagnostics.append(FormulaDiagnostic(
+                    severity="error", code="unknown_qualifier", reference=reference,
+                    message=f"'{qualifier}' in '{reference}' is not a table or alias in the FROM clause.",
+                ))
+            elif table is not None and name != "*" and not index.has_column(table, name):
+                diagnostics.append(FormulaDiagnostic(
+                    severity="error", code="unknown_column", reference=reference,
+                    message=f"Column '{name}' not found in table '{index.tables[table]}'.",
+                ))
+            continue
+        if name in scan.output_aliases:
+            continue
+        owners, opaque = scope.owners(name, index)
+        if len(owners) > 1:
+            diagnostics.append(FormulaDiagnostic(
+                severity="error", code="ambiguous_column", reference=reference,
+                message=f"Column '{name}' exists in several joined tables: {sorted(owners)}. Qualify it.",
+            ))
+        elif not owners and not opaque and name not in TYPED_LITERALS:
+            diagnostics.append(FormulaDiagnostic(
+                severity="error", code="unknown_column", reference=reference,
+                message=f"Column '{name}' not found in the tables used by the formula.",
+            ))
+
+    if scan.has_aggregate:
+        for position, item in enumerate(scan.select_items, start=1):
+            if position in scan.group_positions or (item["alias"] and item["alias"] in scan.group_by):
+                continue
+            for qualifier, name in item["columns"]:
+                if name != "*" and name not in scan.group_by:
+                    diagnostics.append(FormulaDiagnostic(
+                        severity="error", code="missing_group_by", reference=name,
+                        message=f"Column '{name}' is selected next to an aggregate but is not in GROUP BY.",
+                    ))
+
+
+def validate_sql(formula: str, index: SchemaIndex) -> List[FormulaDiagnostic]:
+    """
+    Check a KPI SQL formula against the schema index.
+
+    Args:
+        formula: SQL formula.
+        index: SchemaIndex of the connected database.
+
+    Returns:
+        Diagnostics; the formula is valid when none has severity "error".
+    """
+    statements = [statement for statement in sqlparse.parse(formula) if statement.token_first(skip_cm=True)]
+    if not statements:
+        return [FormulaDiagnostic(severity="error", code="syntax", message="Formula is not valid SQL syntax.")]
+    if len(statements) > 1:
+        return [FormulaDiagnostic(severity="error", code="multiple_statements", message="Formula must be a single SQL statement.")]
+    statement = statements[0]
+    if statement.get_type() != "SELECT":
+        return [FormulaDiagnostic(
+            severity="error", code="not_select",
+            message=f"Formula must be a SELECT query, got {statement.get_type()}.",
+        )]
+
+    scan = _Scan()
+    _walk(statement, scan, True)
+    if not scan.tables and not scan.derived:
+        return [FormulaDiagnostic(severity="error", code="no_table", message="No table found in formula.")]
+
+    diagnostics: List[FormulaDiagnostic] = []
+    _resolve(scan, index, None, diagnostics)
+    unique = {}
+    for diagnostic in diagnostics:
+        unique.setdefault((diagnostic.code, diagnostic.reference), diagnostic)
+    return list(unique.values())
+
+
+# Top-level clauses split_select recognises after the SELECT list.
+SELECT_CLAUSES = {"FROM": "from", "GROUP BY": "group_by", "HAVING": "having", "ORDER BY": "order_by", "LIMIT": "limit"}
+SET_OPERATORS = {"UNION", "UNION ALL", "INTERSECT", "EXCEPT"}
+
+
+def _select_item(token) -> Dict:
+    expression = token
+    alias = None
+    if _alias(token):
+        alias = _alias(token)
+        kept = []
+        for part in token.tokens:
+            if part.is_whitespace or (part.ttype in T.Keyword and part.normalized == "AS"):
+                break
+            kept.append(part)
+        expression = kept[0] if len(kept) == 1 else ast.TokenList(kept)
+    function = None
+    distinct = False
+    if isinstance(expression, ast.Function):
+        function = (expression.get_name() or "").upper()
+        arguments = next((part for part in expression.tokens if isinstance(part, ast.Parenthesis)), None)
+        first = arguments.token_next(0)[1] if arguments is not None else None
+        distinct = first is not None and first.ttype in T.Keyword and first.normalized == "DISTINCT"
+    return {"sql": str(expression).strip(), "alias": alias, "function": function, "distinct": distinct}
+
+
+def output_name(item: Dict, db_type: str) -> str:
+    """Column name the warehouse gives a split_select item when the query runs."""
+    if item["alias"]:
+        return item["alias"]
+    if db_type == "mysql":
+        return item["sql"]
+    if item["function"]:
+        return item["function"].lower()
+    return item["sql"].split(".")[-1].strip('"')
+
+
+def split_select(formula: str) -> Optional[Dict]:
+    """
+    Split a single plain SELECT into its top-level clauses.
+
+    Args:
+        formula: SQL formula.
+
+    Returns:
+        Dict with "select" (items with "sql", "alias", "function", "distinct"),
+        "distinct", "from", "where", "group_by" (expression strings), "having",
+        "order_by" and "limit"; absent clauses are None. Returns None for
+        statements it cannot represent (CTEs, set operations, several statements).
+    """
+    statements = [statement for statement in sqlparse.parse(formula) if statement.token_first(skip_cm=True)]
+    if len(statements) != 1 or statements[0].get_type() != "SELECT":
+        return None
+
+    clauses: Dict[str, list] = {}
+    parts = {"distinct": False, "where": None}
+    clause = None
+    for token in statements[0].tokens:
+        if _is_skippable(token) or (token.ttype is T.Punctuation and token.value == ";"):
+            continue
+        if token.ttype is T.Keyword.CTE or (token.ttype in T.Keyword and token.normalized in SET_OPERATORS):
+            return None
+        if token.ttype is T.DML:
+            clause = "select"
+            continue
+        if isinstance(token, ast.Where):
+            parts["where"] = str(ast.TokenList(token.tokens[1:])).strip() or None
+            continue
+        if token.ttype in T.Keyword and token.normalized in SELECT_CLAUSES:
+            clause = SELECT_CLAUSES[token.normalized]
+            continue
+        if clause == "select" and token.ttype in T.Keyword and token.normalized == "DISTINCT":
+            parts["distinct"] = True
+            continue
+        if clause is None:
+            return None
+        clauses.setdefault(clause, []).append(token)
+
+    def items(tokens: list) -> list:
+        flattened = []
+        for token in tokens:
+            flattened.extend(token.get_identifiers() if isinstance(token, ast.IdentifierList) else [token])
+        return flattened
+
+    parts["select"] = [_select_item(token) for token in items(clauses.get("select", []))]
+    parts["group_by"] = [str(token).strip() for token in items(clauses.get("group_by", []))] or None
+    for name in ("from", "having", "order_by", "limit"):
+        tokens = clauses.get(name)
+        parts[name] = " ".join(str(token).strip() for token in tokens) if tokens else None
+    return parts
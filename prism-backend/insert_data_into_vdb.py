@@ -6,6 +6,8 @@ from qdrant_client.models import VectorParams, Distance, PointStruct
 import openai
 from dotenv import load_dotenv
 from models import get_semantic_data
+from metrics import LLM_ERRORS, LLM_LATENCY, record_tokens, timed_call
+from tracing import traced
 
 # ====== LOAD ENVIRONMENT VARIABLES ======
 load_dotenv()
@@ -16,11 +18,14 @@ openai_client = openai.AzureOpenAI(
 
 
 # ====== EMBEDDING FUNCTION ======
+@traced("embedding", "embedding", "client")
+@timed_call(LLM_LATENCY, LLM_ERRORS, operation="embedding", model="text-embedding-3-small")
 def embed_text(text):
     response = openai_client.embeddings.create(
         model="text-embedding-3-small",
         input=text,
     )
+    record_tokens("text-embedding-3-small", response.usage)
     return response.data[0].embedding  # correct object access
 
 
@@ -0,0 +1,94 @@
+import logging
+import os
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from database import db_extracted_schema
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+JOIN_GRAPH_CACHE_SECONDS = int(os.getenv("JOIN_GRAPH_CACHE_SECONDS", "600"))
+
+# (left table, right table, [(left column, right column), ...])
+Join = Tuple[str, str, List[Tuple[str, str]]]
+
+_graphs = TTLCache(256, JOIN_GRAPH_CACHE_SECONDS, name="join_graphs")
+
+
+class JoinGraph:
+    """
+    Undirected graph of tables connected by the foreign keys captured by
+    schema_extractor. Plans joins over real FK edges, deterministically.
+    """
+
+    def __init__(self, relationships: List[Dict]):
+        self.edges: Dict[str, Dict[str, List[Tuple[str, str]]]] = {}
+        for rel in relationships:
+            pairs = list(zip(rel["from_columns"], rel["to_columns"]))
+            self._add_edge(rel["from_table"], rel["to_table"], pairs)
+            self._add_edge(rel["to_table"], rel["from_table"], [(right, left) for left, right in pairs])
+
+    def _add_edge(self, table1: str, table2: str, pairs: List[Tuple[str, str]]):
+        # Keep the first FK seen between two tables so planning stays deterministic.
+        self.edges.setdefault(table1, {}).setdefault(table2, pairs)
+
+    def __contains__(self, table: str) -> bool:
+        return table in self.edges
+
+    def _nearest(self, sources: set, targets: set) -> Optional[List[str]]:
+        """BFS from every source at once; returns the table path to the closest target."""
+        parents = {source: None for source in sources}
+        queue = deque(sorted(sources))
+        while queue:
+            table = queue.popleft()
+            if table in targets:
+                path = [table]
+                while parents[path[-1]] is not None:
+                    path.append(parents[path[-1]])
+                return path[::-1]
+            for neighbour in sorted(self.edges.get(table, {})):
+                if neighbour not in parents:
+                    parents[neighbour] = table
+                    queue.append(neighbour)
+        return None
+
+    def plan(self, tables: List[str]) -> Optional[List[Join]]:
+        """
+        Approximate Steiner tree over the FK graph connecting all `tables`,
+        rooted at tables[0]: repeatedly attach the terminal closest to the tree
+        built so far along its shortest path. Intermediate tables are included.
+
+        Returns:
+            Joins in an order where each left table is already joined, or None
+            when the tables are not connected by foreign keys.
+        """
+        root = tables[0]
+        tree = {root}
+        remaining = set(tables[1:]) - tree
+        joins: List[Join] = []
+        while remaining:
+            path = self._nearest(tree, remaining)
+            if path is None:
+                return None
+            for table1, table2 in zip(path, path[1:]):
+                joins.append((table1, table2, self.edges[table1][table2]))
+                tree.add(table2)
+            remaining -= tree
+        return joins
+
+
+def get_join_graph(user_id: str, db_id: str) -> JoinGraph:
+    """Join graph for a connected db, rebuilt only when a newer extracted schema is stored."""
+    latest = db_extracted_schema.find_one({"user_id": user_id, "db_id": db_id}, {"_id": 1}, sort=[("_id", -1)])
+    version = str(latest["_id"]) if latest else None
+    cached = _graphs.get((user_id, db_id))
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    document = db_extracted_schema.find_one({"_id": latest["_id"]}, {"relationships": 1}) if latest else None
+    relationships = (document or {}).get("relationships", [])
+    graph = JoinGraph(relationships)
+    logger.info(f"Built join graph for {db_id}: {len(graph.edges)} tables, {len(relationships)} foreign keys")
+    _graphs.set((user_id, db_id), (version, graph))
+    return graph
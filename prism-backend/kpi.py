@@ -2,17 +2,20 @@ import argparse
 import json
 import logging
 import re
-import sqlparse
 from datetime import datetime
 from pathlib import Path
 from typing import List, Optional, Dict, Tuple
-import psycopg2
-from psycopg2 import sql as psql
 from pydantic import BaseModel
 import openai
 import os
-from models import get_database_connection
-from database import db_kpis
+from models import get_database_connection, get_authorized_tables_columns_info
+from database import db_kpis, db_extracted_schema
+from tables_extractor import get_tables_and_columns
+from join_graph import JoinGraph, get_join_graph
+from formula_validator import FormulaDiagnostic, SchemaIndex, validate_sql
+from kpi_rollup import plan_rollup, refresh_sql
+from metrics import LLM_ERRORS, LLM_LATENCY, record_tokens, timed
+from tracing import set_llm_usage, span
 
 # Configure logging
 logging.basicConfig(
@@ -55,6 +58,9 @@ class KPIDefinition(BaseModel):
     formula: str
     formula_type: str = "sql"  # sql or general
     group_by: Optional[List[str]] = None  # Columns for GROUP BY in general formulas
+    materialize: bool = False  # Maintain an incremental rollup (see kpi_rollup)
+    time_column: Optional[str] = None  # Watermark column for materialized KPIs
+    time_grain: Optional[str] = None  # day, week, month or year
 
 class KPIResponse(KPIDefinition):
     created_at: datetime
@@ -67,43 +73,40 @@ class DBStatusResponse(BaseModel):
 # Custom Exceptions
 class FormulaValidationError(Exception):
     """Exception raised for invalid KPI formulas."""
-    pass
+
+    def __init__(self, message: str, diagnostics: Optional[List[FormulaDiagnostic]] = None):
+        super().__init__(message)
+        self.diagnostics = diagnostics or []
 
 class KPIError(Exception):
     """Exception raised for KPI-related errors."""
     pass
 
-# PostgreSQL Client Initialization
-def init_postgres_client(config: PostgreSQLConfig):
-    try:
-        # Connect to PostgreSQL
-        conn = psycopg2.connect(
-            host=config["host"],
-            port=config["port"],
-            dbname=config["database"],
-            user=config["username"],
-            password=config["password"]
-        )
-        conn.autocommit = True
-
-        # Test connection
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT 1")  # Simple test query
-            logger.info(f"Successfully connected to PostgreSQL database: {config["database"]}")
-
-        return conn
-
-    except Exception as e:
-        logger.error(f"PostgreSQL connection failed: {e}")
-        raise
-
 # Utility Functions
-def load_db_schema(client):
+def authorized_schema(schema: Dict[str, List[str]], authorized: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """Restrict a table listing to the authorized tables and columns; an empty `authorized` keeps everything."""
+    if not authorized:
+        return schema
+    allowed = {table: set(columns) for table, columns in authorized.items()}
+    return {
+        table: [column for column in columns if column in allowed[table]]
+        for table, columns in schema.items() if table in allowed
+    }
+
+def load_db_schema(data_connection: Dict, user_id: Optional[str] = None, db_id: Optional[str] = None) -> Dict[str, List[str]]:
     """
-    Fetch schema (tables and columns) from PostgreSQL database.
+    Fetch schema (tables and columns) for a connected database.
+
+    The latest extracted schema is used while it is the connection's current
+    schema version (until the database is re-onboarded); without one, a single
+    catalog query runs on the shared pooled engine (and is itself cached per
+    connection). Either way the result is limited to the tables and columns
+    the user authorized for the connection.
     
     Args:
-        client: PostgreSQL connection instance.
+        data_connection: Stored connection document.
+        user_id: Owner of the connection, used to look up the extracted schema.
+        db_id: Connection id, used to look up the extracted schema.
     
     Returns:
         Dictionary mapping table names to lists of column names.
@@ -112,30 +115,34 @@ def load_db_schema(client):
         RuntimeError: If schema loading fails.
     """
     try:
-        schema = {}
-        with client.cursor() as cursor:
-            # Get all tables in the current schema
-            cursor.execute("""
-                SELECT table_name 
-                FROM information_schema.tables 
-                WHERE table_schema = 'public'
-            """)
-            tables = [row[0] for row in cursor.fetchall()]
-            
-            logger.info(f"Connected to PostgreSQL database. Available tables:")
-            for table in tables:
-                # Get columns for each table
-                cursor.execute("""
-                    SELECT column_name 
-                    FROM information_schema.columns 
-                    WHERE table_schema = 'public' AND table_name = %s
-                """, (table,))
-                columns = [row[0] for row in cursor.fetchall()]
-                schema[table] = columns
-                logger.info(f"- {table}: {columns}")
-                
-        if not tables:
+        authorized = {}
+        if user_id and db_id:
+            authorized = get_authorized_tables_columns_info(user_id, db_id)
+            # The newest extraction is the schema version (see async_models.get_schema_version).
+            latest = db_extracted_schema.find_one(
+                {"user_id": user_id, "db_id": db_id}, {"tables": 1}, sort=[("_id", -1)]
+            )
+            if latest and latest.get("tables"):
+                schema = {table: list(info.get("columns", {})) for table, info in latest["tables"].items()}
+                schema = authorized_schema(schema, authorized)
+                logger.info(f"Using extracted schema for {db_id}: {len(schema)} tables")
+                return schema
+
+        schema = get_tables_and_columns(
+            db_type=data_connection["db_type"],
+            database=data_connection["database"],
+            username=data_connection["username"],
+            password=data_connection["password"],
+            host=data_connection["host"],
+            port=data_connection["port"],
+            statement_timeout_ms=data_connection.get("statement_timeout_ms"),
+        )
+        schema = authorized_schema(schema, authorized)
+        if not schema:
             logger.info("No tables found in the database.")
+        else:
+            logger.info(f"Loaded schema for {data_connection['database']}: {len(schema)} tables")
+            logger.debug(f"Schema: {schema}")
         return schema
     except Exception as e:
         logger.error(f"Failed to load database schema: {e}")
@@ -159,26 +166,37 @@ def find_join_keys(table1: str, table2: str, schema: Dict[str, List[str]]) -> Op
             return key
     return common_columns.pop() if common_columns else None
 
-def build_join_path(tables: List[str], schema: Dict[str, List[str]]) -> List[Tuple[str, str, str]]:
+def build_join_path(tables: List[str], schema: Dict[str, List[str]], join_graph: Optional[JoinGraph] = None) -> List[Tuple[str, str, List[Tuple[str, str]]]]:
     """
     Build a list of JOIN operations to connect all required tables.
+
+    Joins follow the extracted foreign keys when a join graph is available,
+    which may pull in intermediate tables; otherwise tables are joined on
+    shared column names.
     
     Args:
-        tables: List of table names to join.
+        tables: List of table names to join; the first one is the FROM table.
         schema: Database schema.
+        join_graph: Foreign-key graph of the database, if known.
     
     Returns:
-        List of tuples (table1, table2, join_key) representing JOIN operations.
+        List of tuples (table1, table2, [(table1_column, table2_column), ...]) representing JOIN operations.
     
     Raises:
         FormulaValidationError: If no valid join path is found.
     """
     if len(tables) <= 1:
         return []
+
+    if join_graph is not None and all(table in join_graph for table in tables):
+        joins = join_graph.plan(tables)
+        if joins is not None:
+            return joins
+        logger.warning(f"No foreign-key path connects {tables}; falling back to shared column names.")
     
     joins = []
-    visited = {tables[0]}
-    remaining = set(tables[1:])
+    visited = [tables[0]]
+    remaining = sorted(set(tables[1:]))
 
     while remaining:
         found = False
@@ -186,8 +204,8 @@ def build_join_path(tables: List[str], schema: Dict[str, List[str]]) -> List[Tup
             for table2 in remaining:
                 join_key = find_join_keys(table1, table2, schema)
                 if join_key:
-                    joins.append((table1, table2, join_key))
-                    visited.add(table2)
+                    joins.append((table1, table2, [(join_key, join_key)]))
+                    visited.append(table2)
                     remaining.remove(table2)
                     found = True
                     break
@@ -198,6 +216,18 @@ def build_join_path(tables: List[str], schema: Dict[str, List[str]]) -> List[Tup
 
     return joins
 
+def table_aliases_for(tables: List[str]) -> Dict[str, str]:
+    """Short alias per table (first letter, numbered on collision)."""
+    aliases = {}
+    for table in tables:
+        alias = base = table[0].lower()
+        suffix = 2
+        while alias in aliases.values():
+            alias = f"{base}{suffix}"
+            suffix += 1
+        aliases[table] = alias
+    return aliases
+
 def parse_natural_formula(formula: str, schema: Dict[str, List[str]], openai_client, max_retries: int = 1) -> tuple[str, Optional[List[str]]]:
     """
     Parse a natural language formula using OpenAI LLM to generate SQL and extract grouping.
@@ -215,11 +245,10 @@ def parse_natural_formula(formula: str, schema: Dict[str, List[str]], openai_cli
         FormulaValidationError: If LLM fails to generate valid SQL.
     """
     schema_str = "\n".join([f"Table {table}: {', '.join(cols)}" for table, cols in schema.items()])
+    # Static instructions, then this tenant's schema, then the formula: repeated
+    # calls share the longest possible prefix for the provider's prompt cache.
     prompt = f"""
-Given the following PostgreSQL database schema:
-{schema_str}
-
-Convert the natural language query "{formula}" into a valid PostgreSQL SQL query. The query should:
+Convert the natural language query given at the end into a valid PostgreSQL SQL query over the schema below. The query should:
 - Handle aggregations (e.g., average → AVG, total → SUM).
 - Identify metrics and map them to schema columns (e.g., 'quantity sold' → 'quantity_sold').
 - Handle time-based groupings (e.g., 'each 3 months' → GROUP BY date_trunc('quarter', date)).
@@ -231,18 +260,27 @@ Convert the natural language query "{formula}" into a valid PostgreSQL SQL query
 
 Ensure the SQL is valid and compatible with PostgreSQL. If the query cannot be generated, return:
   {{"sql": "", "group_by": [], "error": "Reason for failure"}}
+
+Schema:
+{schema_str}
+
+Natural language query: "{formula}"
 """
     
     for attempt in range(max_retries + 1):
         try:
-            response = openai_client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are a SQL query generator for PostgreSQL, specializing in KPI formulas."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.2
-            )
+            with span("llm.chat", "llm", "client", **{"gen_ai.request.model": "gpt-4o"}) as llm_span, \
+                    timed(LLM_LATENCY, LLM_ERRORS, operation="chat", model="gpt-4o"):
+                response = openai_client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=[
+                        {"role": "system", "content": "You are a SQL query generator for PostgreSQL, specializing in KPI formulas."},
+                        {"role": "user", "content": prompt}
+                    ],
+                    temperature=0.2
+                )
+                set_llm_usage(llm_span, response.usage)
+            record_tokens("gpt-4o", response.usage, "kpi_formula")
             raw_content = response.choices[0].message.content
             logger.debug(f"Raw LLM response (attempt {attempt + 1}): {raw_content}")
             
@@ -275,7 +313,7 @@ Ensure the SQL is valid and compatible with PostgreSQL. If the query cannot be g
                     return fallback_sql, ["date_trunc('quarter', s.date)"]
                 raise FormulaValidationError(f"LLM returned invalid response format after {max_retries + 1} attempts: {e}")
 
-def convert_general_to_sql(formula: str, schema: Dict[str, List[str]], group_by: Optional[List[str]] = None, openai_client=None) -> str:
+def convert_general_to_sql(formula: str, schema: Dict[str, List[str]], group_by: Optional[List[str]] = None, openai_client=None, join_graph: Optional[JoinGraph] = None) -> str:
     """
     Convert general formula to SQL query, supporting aggregations and GROUP BY.
     
@@ -284,6 +322,7 @@ def convert_general_to_sql(formula: str, schema: Dict[str, List[str]], group_by:
         schema: Database schema.
         group_by: Optional list of columns to group by.
         openai_client: OpenAI client for natural language parsing.
+        join_graph: Foreign-key graph used to plan joins.
     
     Returns:
         SQL query string.
@@ -334,12 +373,14 @@ def convert_general_to_sql(formula: str, schema: Dict[str, List[str]], group_by:
                 raise FormulaValidationError(f"Group by column '{col_name}' not found in schema.")
 
     # Get unique tables
-    used_tables = list(set(column_to_table.values()))
+    used_tables = sorted(set(column_to_table.values()))
     if not used_tables:
         raise FormulaValidationError("No tables contain the referenced columns.")
 
+    joins = build_join_path(used_tables, schema, join_graph)
+
     # Qualify columns with table aliases
-    table_aliases = {table: table[0].lower() for table in used_tables}
+    table_aliases = table_aliases_for(used_tables[:1] + [table2 for _, table2, _ in joins])
     qualified_formula = formula
     for col in all_columns:
         if col in column_to_table:
@@ -351,14 +392,12 @@ def convert_general_to_sql(formula: str, schema: Dict[str, List[str]], group_by:
     if len(used_tables) == 1:
         query = f"SELECT {qualified_formula} FROM {used_tables[0]} AS {table_aliases[used_tables[0]]}"
     else:
-        joins = build_join_path(used_tables, schema)
-        if not joins:
-            raise FormulaValidationError(f"No valid join path found for tables: {used_tables}")
         first_table = used_tables[0]
         query = f"SELECT {qualified_formula} FROM {first_table} AS {table_aliases[first_table]}"
-        for table1, table2, join_key in joins:
+        for table1, table2, key_pairs in joins:
             alias1, alias2 = table_aliases[table1], table_aliases[table2]
-            query += f" JOIN {table2} AS {alias2} ON {alias1}.{join_key} = {alias2}.{join_key}"
+            condition = " AND ".join(f"{alias1}.{col1} = {alias2}.{col2}" for col1, col2 in key_pairs)
+            query += f" JOIN {table2} AS {alias2} ON {condition}"
 
     # Add GROUP BY if needed
     if agg_matches or group_by:
@@ -370,7 +409,7 @@ def convert_general_to_sql(formula: str, schema: Dict[str, List[str]], group_by:
 
     return query
 
-def validate_formula(formula: str, schema: Dict[str, List[str]], formula_type: str, group_by: Optional[List[str]] = None) -> str:
+def validate_formula(formula: str, schema: Dict[str, List[str]], formula_type: str, group_by: Optional[List[str]] = None, join_graph: Optional[JoinGraph] = None) -> str:
     """
     Validate KPI formula against database schema.
     
@@ -379,6 +418,7 @@ def validate_formula(formula: str, schema: Dict[str, List[str]], formula_type: s
         schema: Database schema (tables and columns).
         formula_type: Type of formula ('sql' or 'general').
         group_by: Optional list of columns to group by (for general formulas).
+        join_graph: Foreign-key graph used to plan joins.
     
     Returns:
         Validated (and possibly converted) SQL formula.
@@ -389,50 +429,37 @@ def validate_formula(formula: str, schema: Dict[str, List[str]], formula_type: s
     if formula_type == "general":
         try:
             openai_client = init_openai_client()
-            formula = convert_general_to_sql(formula, schema, group_by, openai_client)
+            formula = convert_general_to_sql(formula, schema, group_by, openai_client, join_graph)
         except FormulaValidationError as e:
             raise FormulaValidationError(f"Invalid general formula: {e}")
     
-    try:
-        parsed = sqlparse.parse(formula)
-        if not parsed or not parsed[0].tokens:
-            raise FormulaValidationError("Formula is not valid SQL syntax.")
-    except Exception as e:
-        raise FormulaValidationError(f"SQL syntax error: {e}")
+    diagnostics = validate_sql(formula, SchemaIndex(schema))
+    for diagnostic in diagnostics:
+        if diagnostic.severity == "warning":
+            logger.warning(f"KPI formula: {diagnostic.message}")
+    errors = [diagnostic for diagnostic in diagnostics if diagnostic.severity == "error"]
+    if errors:
+        raise FormulaValidationError(" ".join(error.message for error in errors), errors)
 
-    table_pattern = re.compile(r'from\s+([a-zA-Z_][a-zA-Z0-9_]*)', re.IGNORECASE)
-    tables = set(table_pattern.findall(formula))
-    if not tables:
-        raise FormulaValidationError("No table found in formula.")
+    return formula
 
-    for table in tables:
-        if table not in schema:
-            raise FormulaValidationError(f"Table '{table}' not found in database schema. Available tables: {list(schema.keys())}")
-        if not any(col in formula for col in schema[table]):
-            raise FormulaValidationError(f"No valid columns from table '{table}' used in formula. Available columns: {schema[table]}")
-
-    if "JOIN" in formula.upper():
-        join_pattern = re.compile(r'join\s+([a-zA-Z_][a-zA-Z0-9_]*)', re.IGNORECASE)
-        join_tables = set(join_pattern.findall(formula))
-        for table in join_tables:
-            if table not in schema:
-                raise FormulaValidationError(f"Join table '{table}' not found in schema. Available tables: {list(schema.keys())}")
-
-    # Validate GROUP BY for SQL formulas with aggregations
-    if formula_type == "sql" and any(agg in formula.upper() for agg in ["SUM", "AVG", "COUNT", "MAX", "MIN"]):
-        non_agg_columns = re.findall(r'\b(?!(SUM|AVG|COUNT|MAX|MIN)\()[a-zA-Z_][a-zA-Z0-9_]*(?!\))\b', formula, re.IGNORECASE)
-        group_by_pattern = re.compile(r'group\s+by\s+(.+?)(?:\s*(?:having|order\s+by|$))', re.IGNORECASE)
-        group_by_match = group_by_pattern.search(formula)
-        if non_agg_columns and not group_by_match:
-            raise FormulaValidationError("SQL formula with aggregations must include GROUP BY for non-aggregated columns.")
-        if group_by_match:
-            group_by_cols = [col.strip() for col in group_by_match.group(1).split(",")]
-            for col in group_by_cols:
-                col_name = col.split(".")[-1] if "." in col else col
-                if col_name not in sum(col for table in schema.values() for col in table) and not col_name.startswith("date_trunc"):
-                    raise FormulaValidationError(f"Group by column '{col_name}' not found in schema.")
+def validate_materialization(kpi: KPIDefinition, schema: Dict[str, List[str]], db_type: str) -> None:
+    """
+    Check that a validated KPI formula can be kept as an incremental rollup.
 
-    return formula
+    Raises:
+        FormulaValidationError: If the formula or its time column cannot be materialized.
+    """
+    try:
+        plan = plan_rollup(kpi.formula, kpi.time_column, kpi.time_grain, db_type)
+    except ValueError as e:
+        raise FormulaValidationError(str(e), [
+            FormulaDiagnostic(severity="error", code="not_materializable", message=str(e), reference=kpi.time_column)
+        ])
+    # The bucketed refresh query must itself resolve, which also checks the time column.
+    errors = [d for d in validate_sql(refresh_sql(plan, None), SchemaIndex(schema)) if d.severity == "error"]
+    if errors:
+        raise FormulaValidationError(" ".join(error.message for error in errors), errors)
 
 # KPI Repository
 class KPIJsonRepository:
@@ -496,7 +523,8 @@ class KPIJsonRepository:
     #     return None
 
 # Command Handlers
-def create_kpi(name: str, formula: str, description: Optional[str], formula_type: str, group_by: Optional[List[str]], client, repo: KPIJsonRepository) -> None:
+def create_kpi(name: str, formula: str, description: Optional[str], formula_type: str, group_by: Optional[List[str]], data_connection: Dict, repo: KPIJsonRepository, join_graph: Optional[JoinGraph] = None,
+               materialize: bool = False, time_column: Optional[str] = None, time_grain: Optional[str] = None) -> None:
     """
     Create a new KPI.
     
@@ -506,13 +534,20 @@ def create_kpi(name: str, formula: str, description: Optional[str], formula_type
         description: Optional KPI description.
         formula_type: Type of formula ('sql' or 'general').
         group_by: Optional list of columns to group by (for general formulas).
-        client: PostgreSQL connection.
+        data_connection: Stored connection document.
         repo: KPI repository.
+        join_graph: Foreign-key graph used to plan joins.
+        materialize: Keep an incremental rollup for this KPI.
+        time_column: Column the rollup is bucketed and refreshed on.
+        time_grain: Rollup bucket size ('day', 'week', 'month' or 'year').
     """
     try:
-        kpi = KPIDefinition(name=name, formula=formula, description=description, formula_type=formula_type, group_by=group_by)
-        schema = load_db_schema(client)
-        kpi.formula = validate_formula(kpi.formula, schema, formula_type, group_by)
+        kpi = KPIDefinition(name=name, formula=formula, description=description, formula_type=formula_type, group_by=group_by,
+                            materialize=materialize, time_column=time_column, time_grain=time_grain)
+        schema = load_db_schema(data_connection, repo.user_id, repo.db_id)
+        kpi.formula = validate_formula(kpi.formula, schema, formula_type, group_by, join_graph)
+        if kpi.materialize:
+            validate_materialization(kpi, schema, data_connection["db_type"])
         result = repo.add_kpi(kpi)
         logger.info(f"Created KPI: {result.name}")
         # print(json.dumps(result.dict(), indent=2, default=str))
@@ -540,10 +575,10 @@ def get_kpi(name: str, repo: KPIJsonRepository) -> None:
     logger.info(f"Retrieved KPI: {name}")
     # print(json.dumps(kpi.dict(), indent=2, default=str))
 
-def check_db_status(client) -> None:
+def check_db_status(data_connection: Dict) -> None:
     """Check PostgreSQL database connection and list tables."""
     try:
-        schema = load_db_schema(client)
+        schema = load_db_schema(data_connection)
         response = DBStatusResponse(
             connected=True,
             tables=schema,
@@ -565,14 +600,10 @@ def kpi_main(kpi,user_id,db_id):
     # Initialize dependencies
     config = get_database_connection(user_id,db_id)
     # print(config)
-    try:
-        client = init_postgres_client(config)
-    except RuntimeError as e:
-        logger.error(f"Failed to start: {e}")
-        exit(1)
 
     repo = KPIJsonRepository(Path("kpi_registry.json"),user_id,db_id)
-    create_kpi(kpi.name, kpi.formula, kpi.description, kpi.formula_type, kpi.group_by, client, repo)
+    create_kpi(kpi.name, kpi.formula, kpi.description, kpi.formula_type, kpi.group_by, config, repo, get_join_graph(user_id, db_id),
+               kpi.materialize, kpi.time_column, kpi.time_grain)
 
 if __name__ == "__main__":
     kpi_main()
\ No newline at end of file
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from formula_validator import output_name, split_select
+from query_cache import normalize_sql
+from warehouse import fetch_all, fetch_all_async
+
+logger = logging.getLogger(__name__)
+
+# Dashboards often hold several KPIs over the same rows (SUM(order_value) and
+# COUNT(*) on orders, say). KPIs whose FROM/JOIN, WHERE, GROUP BY and HAVING
+# match are evaluated as one multi-aggregate query, and its rows are split
+# back per KPI, so the warehouse scans those rows once.
+
+
+def _batch_shape(formula: str, db_type: str) -> Optional[Dict]:
+    """Signature and select-list mapping of a formula, or None if it must run on its own."""
+    parts = split_select(formula)
+    if parts is None or parts["distinct"] or parts["order_by"] or parts["limit"]:
+        return None
+
+    select = parts["select"]
+    by_alias = {item["alias"].lower(): item["sql"] for item in select if item["alias"]}
+    raw_dims = []
+    for expression in parts["group_by"] or []:
+        if expression.isdigit() and 0 < int(expression) <= len(select):
+            expression = select[int(expression) - 1]["sql"]
+        raw_dims.append(by_alias.get(expression.lower(), expression))
+    # Normalized text is only used to compare formulas; queries keep the original spelling.
+    # normalize_sql keeps string literals verbatim, so filters on different values never merge.
+    dims = [normalize_sql(dim) for dim in raw_dims]
+
+    columns = []
+    for item in select:
+        expression = normalize_sql(item["sql"])
+        if item["function"] is None and expression in dims:
+            columns.append({"name": output_name(item, db_type), "dim": dims.index(expression)})
+        elif item["function"] is not None:
+            columns.append({"name": output_name(item, db_type), "measure": expression, "sql": item["sql"]})
+        else:
+            # A bare column outside GROUP BY only works ungrouped on some engines; leave it alone.
+            return None
+
+    signature = (
+        normalize_sql(parts["from"] or ""),
+        normalize_sql(parts["where"] or ""),
+        tuple(dims),
+        normalize_sql(parts["having"] or ""),
+    )
+    return {"signature": signature, "parts": parts, "dims": raw_dims, "columns": columns}
+
+
+def plan_kpi_batches(kpis: List[Dict], db_type: str) -> List[Dict]:
+    """
+    Group KPIs that read the same rows into shared queries.
+
+    Args:
+        kpis: KPI documents with a "formula".
+        db_type: 'postgresql' or 'mysql'.
+
+    Returns:
+        Batches with "kpis" (indexes into `kpis`) and "sql". Merged batches also
+        carry "columns": for each KPI, its output columns mapped to the merged
+        query's columns.
+    """
+    groups: Dict[tuple, List[tuple]] = {}
+    batches = []
+    for index, kpi in enumerate(kpis):
+        shape = _batch_shape(kpi["formula"], db_type)
+        if shape is None:
+            batches.append({"kpis": [index], "sql": kpi["formula"]})
+        else:
+            groups.setdefault(shape["signature"], []).append((index, shape))
+
+    for members in groups.values():
+        if len(members) == 1:
+            index = members[0][0]
+            batches.append({"kpis": [index], "sql": kpis[index]["formula"]})
+            continue
+
+        first = members[0][1]
+        dims = first["dims"]
+        select = [f"{dim} AS kpi_dim_{position}" for position, dim in enumerate(dims)]
+        measures: Dict[str, str] = {}
+        for _, shape in members:
+            for column in shape["columns"]:
+                if "measure" in column and column["measure"] not in measures:
+                    measures[column["measure"]] = f"kpi_measure_{len(measures)}"
+                    select.append(f"{column['sql']} AS {measures[column['measure']]}")
+
+        from_clause = first["parts"]["from"]
+        sql = f"SELECT {', '.join(select)} FROM {from_clause}"
+        if first["parts"]["where"]:
+            sql += f" WHERE {first['parts']['where']}"
+        if dims:
+            sql += f" GROUP BY {', '.join(dims)}"
+        if first["parts"]["having"]:
+            sql += f" HAVING {first['parts']['having']}"
+
+        batches.append({
+            "kpis": [index for index, _ in members],
+            "sql": sql,
+            "columns": [
+                [(column["name"], f"kpi_dim_{column['dim']}" if "dim" in column else measures[column["measure"]])
+                 for column in shape["columns"]]
+                for _, shape in members
+            ],
+        })
+        logger.info(f"Merged {len(members)} KPIs into one query over {from_clause}")
+    return batches
+
+
+def split_batch_rows(batch: Dict, rows: List[Dict]) -> List[List[Dict]]:
+    """Per-KPI result rows for a batch, in the order of batch["kpis"]."""
+    if "columns" not in batch:
+        return [rows]
+    return [[{name: row[source] for name, source in columns} for row in rows] for columns in batch["columns"]]
+
+
+def _individual_batches(kpis: List[Dict], batch: Dict) -> List[Dict]:
+    return [{"kpis": [index], "sql": kpis[index]["formula"]} for index in batch["kpis"]]
+
+
+def run_batch(data_connection: Dict, kpis: List[Dict], batch: Dict) -> List[List[Dict]]:
+    """Run a batch; if a merged query fails, each KPI runs on its own so one bad formula stays contained."""
+    try:
+        return split_batch_rows(batch, fetch_all(data_connection, batch["sql"]))
+    except Exception as e:
+        if "columns" not in batch:
+            raise
+        logger.error(f"Merged KPI query failed, running its KPIs one by one: {e}")
+        return [fetch_all(data_connection, single["sql"]) for single in _individual_batches(kpis, batch)]
+
+
+async def run_batch_async(data_connection: Dict, kpis: List[Dict], batch: Dict) -> List[List[Dict]]:
+    """Async counterpart of run_batch."""
+    try:
+        return split_batch_rows(batch, await fetch_all_async(data_connection, batch["sql"]))
+    except Exception as e:
+        if "columns" not in batch:
+            raise
+        logger.error(f"Merged KPI query failed, running its KPIs one by one: {e}")
+        return await asyncio.gather(*(
+            fetch_all_async(data_connection, single["sql"]) for single in _individual_batches(kpis, batch)
+        ))
@@ -0,0 +1,318 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+from formula_validator import output_name, split_select
+from warehouse import fetch_all_async
+
+logger = logging.getLogger(__name__)
+
+# Opt-in KPI materialization. A KPI registered with a time column and grain is
+# kept in a local SQLite file as one row of partial aggregates per time bucket
+# (and GROUP BY key). Refreshes only re-read the warehouse from the newest
+# stored bucket onward, and /get-kpi merges the buckets instead of scanning the
+# fact tables. Rows that arrive with a timestamp older than the newest bucket
+# are not picked up until the KPI definition changes. Rows with no timestamp
+# are kept in their own bucket, re-read on every refresh and never used as
+# the watermark.
+KPI_ROLLUP_PATH = os.getenv("KPI_ROLLUP_PATH", "kpi_rollups.sqlite3")
+KPI_ROLLUP_REFRESH_SECONDS = int(os.getenv("KPI_ROLLUP_REFRESH_SECONDS", "300"))
+
+TIME_GRAINS = ("day", "week", "month", "year")
+BUCKET_EXPRESSIONS = {
+    "postgresql": {grain: f"date_trunc('{grain}', {{column}})" for grain in TIME_GRAINS},
+    "mysql": {
+        "day": "DATE({column})",
+        "week": "DATE_SUB(DATE({column}), INTERVAL WEEKDAY({column}) DAY)",
+        "month": "DATE_FORMAT({column}, '%Y-%m-01')",
+        "year": "DATE_FORMAT({column}, '%Y-01-01')",
+    },
+}
+
+# Filters relative to the current time ("last 30 days") move with the clock, but
+# buckets below the watermark are never re-read, so such KPIs can't be rolled up.
+VOLATILE_TIME = re.compile(
+    r"\b(now|current_date|current_time|current_timestamp|localtime|localtimestamp|curdate|curtime|sysdate"
+    r"|utc_date|utc_time|utc_timestamp|transaction_timestamp|statement_timestamp|clock_timestamp|interval)\b",
+    re.IGNORECASE,
+)
+
+# How per-bucket partial aggregates combine into the value over all buckets.
+MERGES = {
+    "SUM": lambda values: sum(values) if values else None,
+    "COUNT": lambda values: sum(values),
+    "MIN": lambda values: min(values) if values else None,
+    "MAX": lambda values: max(values) if values else None,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kpi_rollup (
+    kpi_key TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    dims TEXT NOT NULL,
+    measures TEXT NOT NULL,
+    PRIMARY KEY (kpi_key, bucket, dims)
+);
+CREATE TABLE IF NOT EXISTS kpi_rollup_state (
+    kpi_key TEXT PRIMARY KEY,
+    definition TEXT NOT NULL,
+    watermark TEXT,
+    refreshed_at REAL NOT NULL
+);
+"""
+
+# Bucket key for rows whose time column is NULL; sorts before every date.
+NULL_BUCKET = ""
+
+_schema_ready = False
+_refreshing: Dict[str, asyncio.Task] = {}
+
+
+@lru_cache(maxsize=256)
+def plan_rollup(formula: str, time_column: str, time_grain: str, db_type: str) -> Dict:
+    """
+    Work out how a KPI formula maps onto per-bucket partial aggregates.
+
+    Args:
+        formula: Validated KPI SQL.
+        time_column: Timestamp column used for bucketing and as the refresh watermark.
+        time_grain: One of TIME_GRAINS.
+        db_type: 'postgresql' or 'mysql'.
+
+    Returns:
+        Plan with the rewritten query parts, the output columns and a definition hash.
+
+    Raises:
+        ValueError: If the formula cannot be maintained incrementally.
+    """
+    if db_type not in BUCKET_EXPRESSIONS:
+        raise ValueError(f"Materialization is not supported for {db_type} connections.")
+    if time_grain not in TIME_GRAINS:
+        raise ValueError(f"time_grain must be one of {list(TIME_GRAINS)}.")
+    if not time_column:
+        raise ValueError("Materialized KPIs need a time_column.")
+
+    parts = split_select(formula)
+    if parts is None or parts["distinct"] or parts["having"] or parts["order_by"] or parts["limit"]:
+        raise ValueError(
+            "Only plain SELECT ... FROM ... [WHERE ...] [GROUP BY ...] formulas can be materialized "
+            "(no CTEs, DISTINCT, HAVING, ORDER BY or LIMIT)."
+        )
+
+    if any(VOLATILE_TIME.search(parts[clause] or "") for clause in ("from", "where")):
+        raise ValueError(
+            "Formulas filtered relative to the current time (NOW(), CURRENT_DATE, INTERVAL, ...) "
+            "cannot be materialized; old buckets would never be dropped."
+        )
+
+    select = parts["select"]
+    by_alias = {item["alias"].lower(): item["sql"] for item in select if item["alias"]}
+    dims = []
+    for expression in parts["group_by"] or []:
+        if expression.isdigit() and 0 < int(expression) <= len(select):
+            expression = select[int(expression) - 1]["sql"]
+        dims.append(by_alias.get(expression.lower(), expression))
+
+    measures = []
+    columns = []
+    for item in select:
+        name = output_name(item, db_type)
+        if item["function"] in MERGES and not item["distinct"]:
+            columns.append({"name": name, "merge": item["function"], "measure": len(measures)})
+            measures.append(item["sql"])
+        elif item["sql"] in dims:
+            columns.append({"name": name, "dim": dims.index(item["sql"])})
+        else:
+            raise ValueError(f"'{item['sql']}' is neither a SUM/COUNT/MIN/MAX aggregate nor a GROUP BY expression.")
+
+    plan = {
+        "bucket": BUCKET_EXPRESSIONS[db_type][time_grain].format(column=time_column),
+        "time_column": time_column,
+        "from": parts["from"],
+        "where": parts["where"],
+        "dims": dims,
+        "measures": measures,
+        "columns": columns,
+    }
+    plan["definition"] = hashlib.sha256(json.dumps(plan, sort_keys=True).encode("utf-8")).hexdigest()
+    return plan
+
+
+def refresh_sql(plan: Dict, watermark: Optional[str]) -> str:
+    """Bucketed query over the rows at or after the watermark bucket (all rows when None)."""
+    select = [f"{plan['bucket']} AS kpi_bucket"]
+    select += [f"{dim} AS kpi_dim_{index}" for index, dim in enumerate(plan["dims"])]
+    select += [f"{measure} AS kpi_measure_{index}" for index, measure in enumerate(plan["measures"])]
+    conditions = [f"({plan['where']})"] if plan["where"] else []
+    if watermark is not None:
+        literal = watermark.replace(chr(39), chr(39) * 2)
+        conditions.append(f"({plan['time_column']} >= '{literal}' OR {plan['time_column']} IS NULL)")
+    sql = f"SELECT {', '.join(select)} FROM {plan['from']}"
+    if conditions:
+        sql += f" WHERE {' AND '.join(conditions)}"
+    return sql + f" GROUP BY {', '.join([plan['bucket']] + plan['dims'])}"
+
+
+def rollup_key(user_id: str, db_id: str, kpi_name: str) -> str:
+    return f"{user_id}:{db_id}:{kpi_name}"
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _bucket_text(value) -> str:
+    if value is None:
+        return NULL_BUCKET
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    """A connection to the rollup store, committed on success and always closed."""
+    global _schema_ready
+    connection = sqlite3.connect(KPI_ROLLUP_PATH, timeout=30)
+    try:
+        if not _schema_ready:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            _schema_ready = True
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def _read_state(key: str) -> Optional[tuple]:
+    with _connect() as connection:
+        return connection.execute(
+            "SELECT definition, watermark, refreshed_at FROM kpi_rollup_state WHERE kpi_key = ?", (key,)
+        ).fetchone()
+
+
+def _apply_refresh(key: str, definition: str, watermark: Optional[str], records: List[tuple]) -> None:
+    with _connect() as connection:
+        if watermark is None:
+            connection.execute("DELETE FROM kpi_rollup WHERE kpi_key = ?", (key,))
+        else:
+            connection.execute(
+                "DELETE FROM kpi_rollup WHERE kpi_key = ? AND (bucket >= ? OR bucket = ?)", (key, watermark, NULL_BUCKET)
+            )
+        connection.executemany(
+            "INSERT OR REPLACE INTO kpi_rollup (kpi_key, bucket, dims, measures) VALUES (?, ?, ?, ?)",
+            [(key, *record) for record in records],
+        )
+        (latest,) = connection.execute(
+            "SELECT MAX(bucket) FROM kpi_rollup WHERE kpi_key = ? AND bucket != ?", (key, NULL_BUCKET)
+        ).fetchone()
+        connection.execute(
+            "INSERT OR REPLACE INTO kpi_rollup_state (kpi_key, definition, watermark, refreshed_at) VALUES (?, ?, ?, ?)",
+            (key, definition, latest, time.time()),
+        )
+
+
+def _read_rollup(key: str, plan: Dict) -> List[Dict]:
+    with _connect() as connection:
+        rows = connection.execute(
+            "SELECT dims, measures FROM kpi_rollup WHERE kpi_key = ? ORDER BY bucket", (key,)
+        ).fetchall()
+
+    groups: Dict[str, List[list]] = {}
+    for dims, measures in rows:
+        values = groups.setdefault(dims, [[] for _ in plan["measures"]])
+        for index, value in enumerate(json.loads(measures)):
+            if value is not None:
+                values[index].append(value)
+    if not groups and not plan["dims"]:
+        groups["[]"] = [[] for _ in plan["measures"]]
+
+    results = []
+    for dims, values in groups.items():
+        dim_values = json.loads(dims)
+        row = {}
+        for column in plan["columns"]:
+            if "dim" in column:
+                row[column["name"]] = dim_values[column["dim"]]
+            else:
+                row[column["name"]] = MERGES[column["merge"]](values[column["measure"]])
+        results.append(row)
+    return results
+
+
+async def refresh_rollup(data_connection: Dict, key: str, plan: Dict) -> None:
+    """Re-aggregate the buckets at or after the stored watermark and write them to the rollup."""
+    state = await run_in_threadpool(_read_state, key)
+    watermark = state[1] if state and state[0] == plan["definition"] else None
+    started = time.perf_counter()
+    rows = await fetch_all_async(data_connection, refresh_sql(plan, watermark))
+    records = []
+    for row in rows:
+        dims = [row[f"kpi_dim_{index}"] for index in range(len(plan["dims"]))]
+        measures = [row[f"kpi_measure_{index}"] for index in range(len(plan["measures"]))]
+        records.append((
+            _bucket_text(row["kpi_bucket"]),
+            json.dumps(dims, default=_json_default),
+            json.dumps(measures, default=_json_default),
+        ))
+    await run_in_threadpool(_apply_refresh, key, plan["definition"], watermark, records)
+    logger.info(
+        f"Refreshed KPI rollup {key} from {watermark or 'the beginning'}: "
+        f"{len(records)} buckets in {(time.perf_counter() - started) * 1000:.0f}ms"
+    )
+
+
+def _schedule_refresh(data_connection: Dict, key: str, plan: Dict) -> None:
+    if key in _refreshing:
+        return
+
+    def done(task: asyncio.Task):
+        _refreshing.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Background refresh of KPI rollup {key} failed: {task.exception()}")
+
+    task = asyncio.create_task(refresh_rollup(data_connection, key, plan))
+    _refreshing[key] = task
+    task.add_done_callback(done)
+
+
+async def read_kpi(data_connection: Dict, user_id: str, db_id: str, kpi: Dict) -> List[Dict]:
+    """
+    Answer a materialized KPI from its rollup.
+
+    The first read builds the rollup inline; later reads return the stored
+    buckets immediately and refresh in the background once they are older
+    than KPI_ROLLUP_REFRESH_SECONDS. Falls back to running the formula live
+    if the rollup cannot be used.
+    """
+    try:
+        plan = plan_rollup(kpi["formula"], kpi.get("time_column"), kpi.get("time_grain"), data_connection["db_type"])
+        key = rollup_key(user_id, db_id, kpi["name"])
+        state = await run_in_threadpool(_read_state, key)
+        if state is None or state[0] != plan["definition"]:
+            await refresh_rollup(data_connection, key, plan)
+        elif time.time() - state[2] > KPI_ROLLUP_REFRESH_SECONDS:
+            _schedule_refresh(data_connection, key, plan)
+        return await run_in_threadpool(_read_rollup, key, plan)
+    except (ValueError, sqlite3.Error) as e:
+        logger.error(f"KPI rollup unavailable for '{kpi['name']}', running it live: {e}")
+        return await fetch_all_async(data_connection, kpi["formula"])
@@ -1,29 +1,47 @@
 #lilly@l
-from fastapi import FastAPI, HTTPException,Depends,Body
+from fastapi import FastAPI, HTTPException,Depends,Body,Request,Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from auth import create_access_token,get_current_user_id
-from schemas import UserCreate, UserLogin, Token
-from database import users_collection
+from auth import create_access_token,get_current_user_id,get_current_principal
+from schemas import UserCreate, UserLogin, Token, Principal
 from schemas import ConnectDB,AuthorizedTablesColumnsInfo,UserInput,CreateKPIRequest
 import os
 import json
-from jose import JWTError, jwt
-from bson.objectid import ObjectId
+import secrets
+import time
 from typing import Dict
 from dotenv import load_dotenv
-from models import hash_password, verify_password, create_database_connection,add_extracted_schema,add_generated_semantics,get_extracted_schema,save_authorized_tables_columns_info,get_authorized_tables_columns_info,kpi_executor_on_db,get_databases
+import passwords
+import async_models
+from fastapi.concurrency import run_in_threadpool
 from tables_extractor import get_tables_and_columns
 from visualizations import visualization_generator
 from schema_extraction import schema_extractor
 from semantic_extraction import semantic_extactor
 from insert_data_into_vdb import vectordb_insertion
 from conversationa_business_intelligence import  conversational_agent
-from kpi import kpi_main
-from database import db_visualizations
+from kpi import kpi_main, FormulaValidationError
+from db_indexes import ensure_indexes
+from warehouse import dispose_engines, run_until_disconnected
+import tracing
+import metrics
+from fastapi.responses import Response
+from contextlib import asynccontextmanager
 
 load_dotenv()
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ensure_indexes()
+    passwords.start()
+    yield
+    passwords.shutdown()
+    await dispose_engines()
+    tracing.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 oauth2_scheme=OAuth2PasswordBearer(tokenUrl="token")
 
@@ -36,77 +54,170 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Trace-Id"],
 )
 
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # Sampled requests are traced; send X-Debug-Timing with TRACE_DEBUG_TOKEN to get the per-stage breakdown back.
+    started = time.perf_counter()
+    status = 500
+    debug = tracing.debug_requested(request.headers.get(tracing.TRACE_DEBUG_HEADER))
+    try:
+        with metrics.HTTP_IN_PROGRESS.track_inprogress(), tracing.trace_request(f"{request.method} {request.url.path}", force=debug, **{
+            "http.request.method": request.method,
+            "url.path": request.url.path,
+        }) as trace:
+            response = await call_next(request)
+            status = response.status_code
+            if trace is not None:
+                trace.root.set_attribute("http.response.status_code", response.status_code)
+    finally:
+        # Label by route template (/catalog/tables, not its query or ids) to keep cardinality bounded.
+        route = request.scope.get("route")
+        metrics.HTTP_LATENCY.labels(
+            method=request.method, route=route.path if route is not None else "unmatched", status=status
+        ).observe(time.perf_counter() - started)
+    if trace is not None and debug:
+        response.headers["Server-Timing"] = tracing.server_timing(trace)
+        response.headers["X-Trace-Id"] = trace.trace_id
+    return response
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(request: Request):
+    # Scrapers authenticate with METRICS_TOKEN; without one configured the endpoint doesn't exist.
+    if not metrics.METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token, metrics.METRICS_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
 
 @app.post("/signup")
-def singup(user:UserCreate):
-    existing_user=users_collection.find_one({"email":user.email})
+async def singup(user:UserCreate):
+    existing_user=await async_models.get_user_by_email(user.email)
     if existing_user:
         raise HTTPException(status_code=400,detail="Email already registered")
     user_dict={
         "username":user.user_name, 
         "email":user.email,
-        "hashed_password":hash_password(user.password)
+        "hashed_password":await passwords.hash_password_async(user.password)
     }
-    result=users_collection.insert_one(user_dict)
+    inserted_id=await async_models.create_user(user_dict)
     return {
         "message":"User created successfully",
-        "user_id":str(result.inserted_id)
+        "user_id":inserted_id
     }
 
 @app.post("/login",response_model=Token)
-def login(user:UserLogin):
-    db_user=users_collection.find_one({"email":user.email})
-    if not db_user or not verify_password(user.password,db_user["hashed_password"]):
+async def login(user:UserLogin):
+    db_user=await async_models.get_user_by_email(user.email)
+    if not db_user:
+        raise HTTPException(status_code=401,detail="Invalid email or password")
+    valid,new_hash=await passwords.verify_and_update_async(user.password,db_user["hashed_password"])
+    if not valid:
         raise HTTPException(status_code=401,detail="Invalid email or password")
+    if new_hash:
+        await async_models.update_password_hash(db_user["_id"],new_hash)
     access_token=create_access_token(data={"sub":str(db_user["_id"])})
     return {"access_token":access_token,"token_type":"bearer"}
 
 @app.get("/user")
-def get_current_user(user_id: str = Depends(get_current_user_id)):
-    try:
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
-        raise HTTPException(status_code=401,detail="Invaild token")
-    
-    try:
-        user=users_collection.find_one({"_id":ObjectId(user_id)})
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid user ID format")
-    
-    if not user: 
-        raise HTTPException(status_code=404,detail="User not found")
-    return{
-        "user_id":str(user["_id"]),
-        "username":user["username"],
-        "email":user["email"]
-    }
+async def get_current_user(principal: Principal = Depends(get_current_principal)):
+    return principal.model_dump()
 @app.get("/connected-dbs")
-def connectdbs(user_id:str=Depends(get_current_user_id)):
-    response_databases=get_databases(user_id)
+async def connectdbs(user_id:str=Depends(get_current_user_id)):
+    response_databases=await async_models.get_databases(user_id)
     return response_databases
 
 @app.post("/connect-db")
-def connect_db(db_info:ConnectDB,user_id: str = Depends(get_current_user_id)):
+async def connect_db(db_info:ConnectDB,user_id: str = Depends(get_current_user_id)):
     try:
         # print(*db_info.model_dump())
         # print(db_info)
-        db_tables=get_tables_and_columns(**db_info.model_dump())
+        with metrics.ONBOARDING_JOBS.labels(job="connect_db").track_inprogress():
+            db_tables=await run_in_threadpool(get_tables_and_columns,**db_info.model_dump())
         if db_tables:
-            inserted_id=create_database_connection(db_info,user_id)
+            inserted_id=await async_models.create_database_connection(db_info,user_id)
+            await async_models.save_table_catalog(user_id,inserted_id,db_tables)
             return {"db_tables":db_tables,"db_id":inserted_id}
         
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/db-tables")
+async def db_tables(request:Dict,user_id: str = Depends(get_current_user_id)):
+    # Table listing saved at connect time; {"refresh": true} re-reads the warehouse catalog.
+    db_id=request.get("db_id")
+    if not request.get("refresh"):
+        catalog=await async_models.get_table_catalog(user_id,db_id)
+        if catalog:
+            return {"db_tables":catalog,"db_id":db_id}
+    data_connection=await async_models.get_database_connection(user_id,db_id)
+    try:
+        catalog=await run_in_threadpool(get_tables_and_columns,**data_connection,refresh=True)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+    await async_models.save_table_catalog(user_id,db_id,catalog)
+    return {"db_tables":catalog,"db_id":db_id}
     
 
+async def ensure_table_catalog(user_id,db_id):
+    # Connections onboarded before the catalog existed have no listing yet; read it from the warehouse once.
+    if await async_models.has_table_catalog(user_id,db_id):
+        return
+    data_connection=await async_models.get_database_connection(user_id,db_id)
+    try:
+        catalog=await run_in_threadpool(get_tables_and_columns,**data_connection,refresh=True)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await async_models.save_table_catalog(user_id,db_id,catalog)
+
+@app.get("/catalog/tables")
+async def catalog_tables(
+    db_id: str,
+    q: str = None,
+    match: str = Query("substring", pattern="^(prefix|substring)$"),
+    search_columns: bool = False,
+    cursor: str = None,
+    limit: int = Query(50, ge=1, le=500),
+    user_id: str = Depends(get_current_user_id)
+):
+    await ensure_table_catalog(user_id,db_id)
+    tables,next_cursor=await async_models.search_table_catalog(user_id,db_id,q,match,search_columns,cursor,limit)
+    return {"tables":tables,"next_cursor":next_cursor}
+
+@app.get("/catalog/columns")
+async def catalog_columns(
+    db_id: str,
+    table: str,
+    q: str = None,
+    match: str = Query("substring", pattern="^(prefix|substring)$"),
+    user_id: str = Depends(get_current_user_id)
+):
+    await ensure_table_catalog(user_id,db_id)
+    columns=await async_models.get_table_columns(user_id,db_id,table,q,match)
+    return {"table_name":table,"columns":columns}
+
+@app.post("/connection-settings")
+async def connection_settings(request:Dict,user_id: str = Depends(get_current_user_id)):
+    statement_timeout_ms=request.get("statement_timeout_ms")
+    if statement_timeout_ms is not None and (not isinstance(statement_timeout_ms,int) or isinstance(statement_timeout_ms,bool) or statement_timeout_ms<=0):
+        raise HTTPException(status_code=400, detail="statement_timeout_ms must be a positive integer")
+    await async_models.update_statement_timeout(user_id,request.get("db_id"),statement_timeout_ms)
+    return {"db_id":request.get("db_id"),"statement_timeout_ms":statement_timeout_ms}
+
 @app.post("/extract-schemas")
 async def extract_schemas(
     payload: Dict = Body(...),
@@ -121,61 +232,72 @@ async def extract_schemas(
             raise HTTPException(status_code=400, detail="Missing db_id or selected_tables")
         
         authorized_tables_columns_info = AuthorizedTablesColumnsInfo(root=selected_tables)
-        save_authorized_tables_columns_info(authorized_tables_columns_info.root, user_id, db_id)
+        await async_models.save_authorized_tables_columns_info(authorized_tables_columns_info.root, user_id, db_id)
         # print("db")
-        response_schema = schema_extractor(authorized_tables_columns_info.root, user_id, db_id)
+        with metrics.ONBOARDING_JOBS.labels(job="schema_extraction").track_inprogress():
+            response_schema = await run_in_threadpool(schema_extractor, authorized_tables_columns_info.root, user_id, db_id)
         # print("db")
-        extracted_schema_db_response = add_extracted_schema(response_schema, user_id, db_id)
+        extracted_schema_db_response = await async_models.add_extracted_schema(response_schema, user_id, db_id)
         
         return extracted_schema_db_response
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/get-extracted-schemas")
-def extracted_schemas(request:Dict,user_id: str = Depends(get_current_user_id)):
+async def extracted_schemas(request:Dict,user_id: str = Depends(get_current_user_id)):
     db_id=request.get("db_id")
-    response_check_schemas=get_extracted_schema(user_id,db_id)
+    response_check_schemas=await async_models.get_extracted_schema(user_id,db_id)
     return response_check_schemas
 
 @app.post("/semantic-extraction")
-def semantic_extraction(request:Dict,user_id: str = Depends(get_current_user_id)):
+async def semantic_extraction(request:Dict,user_id: str = Depends(get_current_user_id)):
     # print(authorized_tables_columns_info)
     db_id=request.get("db_id")
-    print(db_id)
-    authorized_tables_columns_info=get_authorized_tables_columns_info(user_id,db_id)
+    # print(db_id)
+    authorized_tables_columns_info=await async_models.get_authorized_tables_columns_info(user_id,db_id)
     # print("get info",authorized_tables_columns_info)
-    semantic_response=semantic_extactor(authorized_tables_columns_info,user_id,db_id)
+    with metrics.ONBOARDING_JOBS.labels(job="semantic_extraction").track_inprogress():
+        semantic_response=await run_in_threadpool(semantic_extactor,authorized_tables_columns_info,user_id,db_id)
 
-    extracted_semantics_db_response=add_generated_semantics(semantic_response,user_id,db_id)
-    visualization_generator(user_id,db_id)
+        extracted_semantics_db_response=await async_models.add_generated_semantics(semantic_response,user_id,db_id)
+        await visualization_generator(user_id,db_id)
     return extracted_semantics_db_response
 
 
 @app.post("/vector-data-insert")
 def vector_data_insert(request:Dict,user_id: str = Depends(get_current_user_id)):
     db_id=request.get("db_id")
-    vectordb_response=vectordb_insertion(user_id,db_id)
+    with metrics.ONBOARDING_JOBS.labels(job="vector_insert").track_inprogress():
+        vectordb_response=vectordb_insertion(user_id,db_id)
     return vectordb_response
 
 @app.post("/conversational-bi")
-def conversational_bi(request:Dict,user_id:str=Depends(get_current_user_id)):
+async def conversational_bi(request:Dict,http_request:Request,user_id:str=Depends(get_current_user_id)):
     # print(data.user_input)
-    
-    return {"message":conversational_agent(request.get("user_input"),user_id,request.get("db_id"))}
+    answer=await run_until_disconnected(http_request,conversational_agent(request.get("user_input"),user_id,request.get("db_id")))
+    return {"message":answer}
 
 
 @app.post("/kpi")
 def create_kpi(request: CreateKPIRequest, user_id: str = Depends(get_current_user_id)):
     # Access the nested kpiData and db_id
-    kpi_main(request.kpiData, user_id, request.db_id)
+    try:
+        kpi_main(request.kpiData, user_id, request.db_id)
+    except FormulaValidationError as e:
+        raise HTTPException(status_code=400, detail={
+            "message": str(e),
+            "diagnostics": [diagnostic.model_dump() for diagnostic in e.diagnostics],
+        })
     return {"status": "success"}
 
 @app.post("/get-kpi")
-def get_user_kpi(request:Dict,user_id: str = Depends(get_current_user_id)):
+async def get_user_kpi(request:Dict,http_request:Request,user_id: str = Depends(get_current_user_id)):
     try:
         db_id=request.get("db_id")
-        kpis_list_response = kpi_executor_on_db(user_id,db_id)
+        kpis_list_response = await run_until_disconnected(http_request,async_models.kpi_executor_on_db_async(user_id,db_id))
         # print("=======================================================")
         # print(kpis_list_response)
         # Return an empty list or dictionary if no KPIs found
@@ -192,36 +314,24 @@ def get_user_kpi(request:Dict,user_id: str = Depends(get_current_user_id)):
             "kpis": kpis_list_response
         }
 
+    except HTTPException:
+        # 499 from run_until_disconnected and the like keep their status.
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.post("/get-visualization")
-def visualization(request:Dict,user_id:str=Depends(get_current_user_id)):
-
-    try:
-        db_id=request.get("db_id")
-        echart_response=db_visualizations.find_one({"user_id":user_id,"db_id":db_id},{'user_id': 0,'db_id':0})
-        if echart_response:
-            echart_response["_id"] = str(echart_response["_id"])
-        return echart_response
-    except Exception as e:
-        raise e()
+async def visualization(request:Dict,user_id:str=Depends(get_current_user_id)):
+    db_id=request.get("db_id")
+    return await async_models.get_visualizations(user_id,db_id)
     
 @app.post("/pin-visualization")
-def pinVisualization(request:Dict,user_id:str=Depends(get_current_user_id)):
+async def pinVisualization(request:Dict,user_id:str=Depends(get_current_user_id)):
     try:
-        result = db_visualizations.update_one(
-            {"user_id": user_id, "db_id": request.get("db_id")},
-            {
-                "$set": {
-                    "charts.$[chart].pinned": True
-                }
-            },
-            array_filters=[{"chart.chart_id": request.get("chart_id")}]
-        )
-
-        if result.modified_count > 0:
+        modified_count = await async_models.pin_visualization(user_id, request.get("db_id"), request.get("chart_id"))
+
+        if modified_count > 0:
             return {"status": "success", "message": "Visualization pinned successfully"}
         else:
             return {"status": "error", "message": "No visualization found to update"}
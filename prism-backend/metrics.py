@@ -0,0 +1,248 @@
+import functools
+import hashlib
+import inspect
+import os
+import time
+from contextlib import contextmanager
+
+from anyio import to_thread
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sniffio import AsyncLibraryNotFoundError
+
+# Prometheus metrics for capacity planning. Histograms are recorded at the call
+# sites; pool, cache and queue figures are read from their owners at scrape time.
+# Metrics are per process: with several workers, scrape each one. Scrapes must
+# send METRICS_TOKEN as a bearer token; /metrics is disabled while it is unset.
+# Warehouse series are labelled by a hash of the connection id, never by the
+# customer's database name.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+RATIO_BUCKETS = (0, 0.1, 0.25, 0.5, 0.75, 0.9, 1)
+
+HTTP_LATENCY = Histogram(
+    "prism_http_request_duration_seconds", "HTTP request latency by route.",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+HTTP_IN_PROGRESS = Gauge("prism_http_requests_in_progress", "HTTP requests being served.")
+LLM_LATENCY = Histogram(
+    "prism_llm_request_duration_seconds", "LLM and embedding call latency.",
+    ["operation", "model"], buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "prism_llm_tokens_total", "Tokens sent to and received from LLMs (cached_input is a subset of input).",
+    ["model", "direction"],
+)
+LLM_PROMPT_CACHE_RATIO = Histogram(
+    "prism_llm_prompt_cache_ratio", "Share of each LLM call's prompt tokens served from the provider's prompt cache.",
+    ["model", "prompt"], buckets=RATIO_BUCKETS,
+)
+LLM_ERRORS = Counter("prism_llm_errors_total", "Failed LLM and embedding calls.", ["operation", "model"])
+TOOL_LATENCY = Histogram(
+    "prism_agent_tool_duration_seconds", "Conversational agent tool latency.",
+    ["tool"], buckets=LATENCY_BUCKETS,
+)
+SQL_LATENCY = Histogram(
+    "prism_sql_query_duration_seconds", "Warehouse query latency per connection.",
+    ["db_type", "connection"], buckets=LATENCY_BUCKETS,
+)
+SQL_ROWS = Histogram(
+    "prism_sql_rows_returned", "Rows returned by warehouse queries per connection.",
+    ["db_type", "connection"], buckets=ROW_BUCKETS,
+)
+SQL_ERRORS = Counter("prism_sql_errors_total", "Failed warehouse queries.", ["db_type", "connection"])
+KPI_LATENCY = Histogram(
+    "prism_kpi_evaluation_duration_seconds", "Time to evaluate all KPIs of a connection.",
+    buckets=LATENCY_BUCKETS,
+)
+KPI_QUERIES = Counter(
+    "prism_kpi_queries_total", "Warehouse queries and rollup reads issued for KPIs.", ["kind"],
+)
+KPI_EVALUATED = Counter("prism_kpis_evaluated_total", "KPIs evaluated.")
+FAST_PATH_TURNS = Counter(
+    "prism_chat_fast_path_turns_total", "Chat turns by fast-path outcome (answered, skipped, declined, fallback).",
+    ["outcome"],
+)
+ANSWER_CACHE_LOOKUPS = Counter("prism_answer_cache_lookups_total", "Semantic answer cache lookups.", ["result"])
+ONBOARDING_JOBS = Gauge("prism_onboarding_jobs_in_progress", "Onboarding jobs currently running.", ["job"])
+
+
+@contextmanager
+def timed(histogram, errors=None, **labels):
+    """Observe the block's duration on `histogram` (and count failures on `errors`)."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if errors is not None:
+            (errors.labels(**labels) if labels else errors).inc()
+        raise
+    finally:
+        (histogram.labels(**labels) if labels else histogram).observe(time.perf_counter() - started)
+
+
+def timed_call(histogram, errors=None, **labels):
+    """Decorator form of timed() for sync and async functions."""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with timed(histogram, errors, **labels):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(histogram, errors, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def usage_value(usage, key):
+    """Field of an OpenAI usage object or of its dict form (LangChain's token_usage)."""
+    if not usage:
+        return None
+    return usage.get(key) if isinstance(usage, dict) else getattr(usage, key, None)
+
+
+def cached_prompt_tokens(usage) -> int:
+    return usage_value(usage_value(usage, "prompt_tokens_details"), "cached_tokens") or 0
+
+
+def record_tokens(model: str, usage, prompt: str = None) -> None:
+    """
+    Count token usage from an OpenAI usage object or dict. With a `prompt`
+    name, also observe the share of prompt tokens that hit the provider's
+    prefix cache.
+    """
+    if not usage:
+        return
+    for direction, key in (("input", "prompt_tokens"), ("output", "completion_tokens")):
+        if usage_value(usage, key):
+            LLM_TOKENS.labels(model=model, direction=direction).inc(usage_value(usage, key))
+    cached = cached_prompt_tokens(usage)
+    if cached:
+        LLM_TOKENS.labels(model=model, direction="cached_input").inc(cached)
+    if prompt is not None and usage_value(usage, "prompt_tokens"):
+        LLM_PROMPT_CACHE_RATIO.labels(model=model, prompt=prompt).observe(cached / usage_value(usage, "prompt_tokens"))
+
+
+def connection_label(db_id) -> str:
+    """Opaque, stable label for a stored connection ("unregistered" before it is saved)."""
+    if not db_id:
+        return "unregistered"
+    return hashlib.sha256(str(db_id).encode("utf-8")).hexdigest()[:12]
+
+
+def record_sql(data_connection, seconds: float, rows: int = None) -> None:
+    labels = {"db_type": data_connection["db_type"], "connection": connection_label(data_connection.get("db_id"))}
+    SQL_LATENCY.labels(**labels).observe(seconds)
+    if rows is None:
+        SQL_ERRORS.labels(**labels).inc()
+    else:
+        SQL_ROWS.labels(**labels).observe(rows)
+
+
+def record_kpi_batches(kpi_count: int, batches, rollups: int = 0) -> None:
+    """Count evaluated KPIs and the queries/rollup reads issued for them."""
+    KPI_EVALUATED.inc(kpi_count)
+    for batch in batches:
+        KPI_QUERIES.labels(kind="merged" if "columns" in batch else "single").inc()
+    if rollups:
+        KPI_QUERIES.labels(kind="rollup").inc(rollups)
+
+
+class LangChainMetrics(BaseCallbackHandler):
+    """Latency and token counters for LangChain chat model calls."""
+
+    run_inline = True
+
+    def __init__(self, model: str, prompt: str = None):
+        self.model = model
+        self.prompt = prompt
+        self._started = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            LLM_LATENCY.labels(operation="chat", model=self.model).observe(time.perf_counter() - started)
+        record_tokens(self.model, (response.llm_output or {}).get("token_usage"), self.prompt)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            LLM_LATENCY.labels(operation="chat", model=self.model).observe(time.perf_counter() - started)
+        LLM_ERRORS.labels(operation="chat", model=self.model).inc()
+
+
+class RuntimeCollector:
+    """Connection pools, in-process caches and work queues, sampled on every scrape."""
+
+    def describe(self):
+        # Skips the trial collect() at registration, which would import warehouse mid-import.
+        return []
+
+    def collect(self):
+        from ttl_cache import CACHES
+        from warehouse import pool_stats
+        import passwords
+
+        checked_out = GaugeMetricFamily(
+            "prism_db_pool_connections_checked_out", "Warehouse connections in use.", labels=["engine", "pool"])
+        pool_size = GaugeMetricFamily(
+            "prism_db_pool_size", "Configured warehouse pool size.", labels=["engine", "pool"])
+        overflow = GaugeMetricFamily(
+            "prism_db_pool_overflow", "Warehouse connections opened beyond the pool size.", labels=["engine", "pool"])
+        for stats in pool_stats():
+            labels = [stats["engine"], stats["pool"]]
+            checked_out.add_metric(labels, stats["checked_out"])
+            pool_size.add_metric(labels, stats["size"])
+            overflow.add_metric(labels, stats["overflow"])
+        yield checked_out
+        yield pool_size
+        yield overflow
+
+        hits = CounterMetricFamily("prism_cache_hits", "In-process cache hits.", labels=["cache"])
+        misses = CounterMetricFamily("prism_cache_misses", "In-process cache misses.", labels=["cache"])
+        entries = GaugeMetricFamily("prism_cache_entries", "In-process cache entries.", labels=["cache"])
+        for name, cache in CACHES.items():
+            hits.add_metric([name], cache.hits)
+            misses.add_metric([name], cache.misses)
+            entries.add_metric([name], len(cache))
+        yield hits
+        yield misses
+        yield entries
+
+        hashing = GaugeMetricFamily("prism_password_hash_pending", "Password hash/verify jobs queued or running.")
+        hashing.add_metric([], passwords.pending())
+        yield hashing
+
+        # The threadpool limiter belongs to the event loop, so it is only readable from a loop thread.
+        try:
+            limiter = to_thread.current_default_thread_limiter()
+        except AsyncLibraryNotFoundError:
+            return
+        threads = GaugeMetricFamily("prism_threadpool_busy", "Worker threads running blocking calls.")
+        threads.add_metric([], limiter.borrowed_tokens)
+        yield threads
+        waiting = GaugeMetricFamily("prism_threadpool_waiting", "Blocking calls queued for a worker thread.")
+        waiting.add_metric([], limiter.statistics().tasks_waiting)
+        yield waiting
+
+
+REGISTRY.register(RuntimeCollector())
+
+
+def render():
+    """(body, content type) for the /metrics endpoint; call it from the event loop."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -1,20 +1,12 @@
-from passlib.context import CryptContext
 from database import database_connections
 from schemas import ConnectDB
 from jose import JWTError, jwt
 from fastapi import  HTTPException
 from bson.objectid import ObjectId
 from database import db_extracted_schema,db_generated_semantics,db_authorized_tables_columns_info,db_kpis
-from sqlalchemy import create_engine, inspect, MetaData, Table,text
 from bson import ObjectId 
-pwd_context=CryptContext(schemes=["bcrypt"],deprecated="auto")
-
-def hash_password(password:str):
-    return pwd_context.hash(password)
-
-def verify_password(plain_password:str,hashed_password:str):
-    return pwd_context.verify(plain_password,hashed_password)
-
+from kpi_batch import plan_kpi_batches, run_batch
+from metrics import KPI_LATENCY, record_kpi_batches, timed_call
 def create_database_connection(database_connection:ConnectDB,user_id:str):
     connection_data=database_connection.model_dump()
     connection_data["user_id"]=user_id
@@ -24,7 +16,7 @@ def create_database_connection(database_connection:ConnectDB,user_id:str):
 
 def get_databases(user_id:str):
     db_connections=database_connections.find({"user_id":user_id})
-    print(db_connections)
+    # print(db_connections)
     dbs_result = [
     {
         "database": conn["database"],
@@ -47,12 +39,13 @@ def get_database_connection(user_id:str,db_id:str):
     
     try:
         data_connection=database_connections.find_one({"user_id":user_id,"_id":ObjectId(db_id)}, {"user_id": 0, "_id": 0})
-        print(data_connection)
+        # print(data_connection)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid user ID format")
     
     if not data_connection: 
         raise HTTPException(status_code=404,detail="Connection not found")
+    data_connection["db_id"]=db_id
     return data_connection
 
 def add_extracted_schema(response_schema,user_id,db_id):
@@ -132,6 +125,7 @@ def get_semantic_data(user_id:str,db_id):
     return semantic_data_extracted
 
 
+@timed_call(KPI_LATENCY)
 def kpi_executor_on_db(user_id: str,db_id:str):
     kpis_list_db_response = db_kpis.find_one({"user_id": user_id,"db_id":db_id}, {"user_id": 0, "_id": 0,"db_id":0})
     if not kpis_list_db_response:
@@ -140,31 +134,13 @@ def kpi_executor_on_db(user_id: str,db_id:str):
     
     
     data_connection=get_database_connection(user_id,db_id)
-    if data_connection["db_type"] == "postgresql":
-        # schema="alpl_prod"
-        # DATABASE_URL = f"postgresql+psycopg2://{data_connection["username"]}:{data_connection["password"]}@{data_connection["host"]}:{data_connection["port"]}/{data_connection["database"]}?connect_timeout=10&options=-csearch_path%3D{schema}"
-        DATABASE_URL = f"postgresql+psycopg2://{data_connection["username"]}:{data_connection["password"]}@{data_connection["host"]}:{data_connection["port"]}/{data_connection["database"]}?connect_timeout=10"
-    elif data_connection["db_type"] == "mysql":
-        DATABASE_URL = f"mysql+pymysql://{data_connection["username"]}:{data_connection["password"]}@{data_connection["host"]}:{data_connection["port"]}/{data_connection["database"]}?connect_timeout=10"
-    else:
-        raise ValueError("Unsupported database type. Use 'postgresql' or 'mysql'.")
-    
-    engine = create_engine(DATABASE_URL)
-    inspector = inspect(engine)
-    metadata = MetaData()
-    metadata.reflect(bind=engine)
-    db_name = engine.url.database
-    list_of_answer_kpis=[]
-    for kpi in kpis_list_db_response["kpis"]:
-        
-        query = kpi["formula"]
-        name=kpi["name"]
-        with engine.connect() as connection:
-            result = connection.execute(text(query))
-            rows = result.fetchall()
-            result_list = [dict(row._mapping) for row in rows]
-            list_of_answer_kpis.append({"name":name,"result":result_list})
-    # print("***************************************************")
-    # print(list_of_answer_kpis)
-
-    return list_of_answer_kpis
\ No newline at end of file
+    kpis=kpis_list_db_response["kpis"]
+    results=[None]*len(kpis)
+    # KPIs over the same rows share one query
+    batches=plan_kpi_batches(kpis,data_connection["db_type"])
+    record_kpi_batches(len(kpis),batches)
+    for batch in batches:
+        for index,result_list in zip(batch["kpis"],run_batch(data_connection,kpis,batch)):
+            results[index]=result_list
+
+    return [{"name":kpi["name"],"result":result} for kpi,result in zip(kpis,results)]
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+# Password hashing runs in a dedicated process pool so a burst of /signup or
+# /login requests burns those worker processes' CPU, not the API's threads.
+# Keep this module free of heavy imports: every pool worker imports it.
+
+logger = logging.getLogger(__name__)
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# When set, the cost factor is measured at startup so one hash takes about this long.
+BCRYPT_TARGET_MS = os.getenv("BCRYPT_TARGET_MS")
+AUTH_HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", "2"))
+AUTH_HASH_MAX_PENDING = int(os.getenv("AUTH_HASH_MAX_PENDING", "64"))
+MIN_ROUNDS, MAX_ROUNDS = 10, 16
+
+
+def build_context(rounds: int) -> CryptContext:
+    # Pinning min == max == rounds makes passlib flag every hash made with a
+    # different cost factor, so verify_and_update rehashes it on the next login.
+    return CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__rounds=rounds,
+        bcrypt__min_rounds=rounds,
+        bcrypt__max_rounds=rounds,
+    )
+
+
+pwd_context = build_context(BCRYPT_ROUNDS)
+
+_executor = None
+_slots = None
+_pending = 0
+
+
+def _init_worker(rounds: int):
+    global pwd_context
+    pwd_context = build_context(rounds)
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed_password: str):
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+def calibrate_rounds(target_ms: float) -> int:
+    """Pick the bcrypt cost whose hash time on this machine is closest to target_ms."""
+    context = build_context(MIN_ROUNDS)
+    context.hash("warm-up")  # first call also loads the bcrypt backend
+    started = time.perf_counter()
+    context.hash("calibration-password")
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    # Each extra round doubles the work.
+    rounds = MIN_ROUNDS + round(math.log2(max(target_ms / elapsed_ms, 1)))
+    rounds = max(MIN_ROUNDS, min(MAX_ROUNDS, rounds))
+    logger.info(f"bcrypt cost {MIN_ROUNDS} took {elapsed_ms:.1f}ms; using cost {rounds} for a {target_ms}ms target")
+    return rounds
+
+
+def start():
+    """Create the hashing pool (and calibrate the cost factor if configured)."""
+    global _executor, _slots, pwd_context
+    if _executor is not None:
+        return
+    rounds = calibrate_rounds(float(BCRYPT_TARGET_MS)) if BCRYPT_TARGET_MS else BCRYPT_ROUNDS
+    pwd_context = build_context(rounds)
+    _executor = ProcessPoolExecutor(max_workers=AUTH_HASH_WORKERS, initializer=_init_worker, initargs=(rounds,))
+    _slots = asyncio.Semaphore(AUTH_HASH_WORKERS)
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def _run(fn, *args):
+    global _pending
+    if _executor is None:
+        start()
+    if _pending >= AUTH_HASH_MAX_PENDING:
+        raise HTTPException(status_code=503, detail="Too many authentication requests, retry shortly")
+    _pending += 1
+    try:
+        async with _slots:
+            return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+    finally:
+        _pending -= 1
+
+
+def pending() -> int:
+    """Hash/verify jobs queued or running in the pool."""
+    return _pending
+
+
+async def hash_password_async(password: str) -> str:
+    return await _run(_hash, password)
+
+
+async def verify_and_update_async(password: str, hashed_password: str):
+    """
+    Returns:
+        (valid, new_hash): new_hash is set when the stored hash used outdated
+        parameters and should replace it.
+    """
+    return await _run(_verify_and_update, password, hashed_password)
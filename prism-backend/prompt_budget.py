@@ -0,0 +1,187 @@
+import logging
+import math
+import os
+import re
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+from schema_digest import column_ddl, foreign_key_targets, value_summary
+
+logger = logging.getLogger(__name__)
+
+# Token budget for one chart-generation prompt (instructions + schema digest).
+CHART_PROMPT_TOKEN_BUDGET = int(os.getenv("CHART_PROMPT_TOKEN_BUDGET", "6000"))
+# Schemas that don't fit one prompt are split over at most this many calls;
+# the lowest-ranked tables are left out beyond that.
+CHART_PROMPT_MAX_CALLS = int(os.getenv("CHART_PROMPT_MAX_CALLS", "4"))
+
+TOKEN_ENCODING = "o200k_base"  # gpt-4o
+DESCRIPTION_CHARS = 160
+
+NUMERIC_TYPES = re.compile(r"INT|NUMERIC|DECIMAL|FLOAT|DOUBLE|REAL|MONEY", re.IGNORECASE)
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    import tiktoken
+
+    try:
+        return tiktoken.get_encoding(TOKEN_ENCODING)
+    except Exception as e:
+        # The BPE file is downloaded on first use; offline hosts fall back to an estimate.
+        logger.warning(f"tiktoken encoding {TOKEN_ENCODING} unavailable, estimating tokens from length: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        return math.ceil(len(text) / 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _is_measure(column_name: str, column_schema: Dict, keys: set) -> bool:
+    if column_name in keys or column_name.lower() == "id" or column_name.lower().endswith("_id"):
+        return False
+    return bool(NUMERIC_TYPES.search(column_schema.get("type", "")))
+
+
+def rank_tables(tables: Dict[str, Dict], relationships: List[Dict], row_estimates: Dict[str, int]) -> List[Tuple[str, bool]]:
+    """
+    Order tables by how much they are likely to matter for business charts.
+
+    Score = FK degree (centrality) + log10(rows) + 2 for fact tables. A table is
+    a fact when it references more tables than reference it and carries at
+    least one numeric, non-key column to aggregate.
+
+    Args:
+        tables: Extracted schema per table (columns, primary_key, foreign_keys).
+        relationships: FK relationships from schema_extractor.
+        row_estimates: Approximate row count per table; missing tables count as empty.
+
+    Returns:
+        (table name, is fact) pairs, most important first.
+    """
+    outgoing = {name: 0 for name in tables}
+    incoming = {name: 0 for name in tables}
+    for rel in relationships:
+        if rel["from_table"] in outgoing:
+            outgoing[rel["from_table"]] += 1
+        if rel["to_table"] in incoming:
+            incoming[rel["to_table"]] += 1
+
+    scored = []
+    for name, table in tables.items():
+        keys = set(table.get("primary_key", [])) | set(table.get("foreign_keys", {}))
+        has_measure = any(_is_measure(col, meta, keys) for col, meta in table.get("columns", {}).items())
+        is_fact = outgoing[name] > incoming[name] and has_measure
+        score = outgoing[name] + incoming[name] + math.log10(max(row_estimates.get(name, 0), 0) + 1)
+        if is_fact:
+            score += 2
+        scored.append((-score, name, is_fact))
+    return [(name, is_fact) for _, name, is_fact in sorted(scored)]
+
+
+def _first_sentence(text: str) -> str:
+    sentence = (text or "").strip().split(". ")[0].rstrip(".")
+    return sentence if len(sentence) <= DESCRIPTION_CHARS else sentence[:DESCRIPTION_CHARS - 1] + "…"
+
+
+def table_digest(name: str, is_fact: bool, semantic_table: Dict, table_schema: Dict,
+                 row_estimate: int = None, max_columns: int = None, detailed: bool = True) -> str:
+    """
+    One compact block per table: a header line (kind, approximate size, what
+    it holds) and its columns in schema_digest's DDL shorthand with a value
+    range or samples, in place of the full column descriptions and stats.
+    """
+    header = f"{name} [{'fact' if is_fact else 'dimension'}"
+    if row_estimate:
+        header += f", ~{row_estimate:,} rows"
+    header += "]"
+    if detailed and semantic_table.get("table_description"):
+        header += f": {_first_sentence(semantic_table['table_description'])}"
+
+    foreign_keys = foreign_key_targets(table_schema)
+    columns = []
+    for column_name, column in semantic_table.get("columns", {}).items():
+        column_schema = table_schema.get("columns", {}).get(column_name, {})
+        entry = column_ddl(column_name, column_schema, foreign_keys.get(column_name), constraints=False)
+        is_key = column_schema.get("primary_key") or column_name in foreign_keys
+        values = value_summary(column.get("column_info")) if detailed and not is_key else ""
+        if values:
+            entry += f" {values}"
+        columns.append(entry)
+
+    if max_columns is not None and len(columns) > max_columns:
+        columns = columns[:max_columns] + [f"… {len(columns) - max_columns} more columns"]
+    return header + "\n  " + "; ".join(columns)
+
+
+def _fit_digest(name: str, is_fact: bool, semantic_table: Dict, table_schema: Dict,
+                row_estimate: int, budget: int) -> Tuple[str, int]:
+    """The most detailed digest of a table that fits `budget` tokens on its own."""
+    digest = table_digest(name, is_fact, semantic_table, table_schema, row_estimate)
+    tokens = count_tokens(digest)
+    if tokens <= budget:
+        return digest, tokens
+    digest = table_digest(name, is_fact, semantic_table, table_schema, row_estimate, detailed=False)
+    tokens = count_tokens(digest)
+    max_columns = len(semantic_table.get("columns", {}))
+    while tokens > budget and max_columns > 1:
+        max_columns //= 2
+        digest = table_digest(name, is_fact, semantic_table, table_schema, row_estimate,
+                              max_columns=max_columns, detailed=False)
+        tokens = count_tokens(digest)
+    return digest, tokens
+
+
+def pack_schema(semantic_tables: Dict[str, Dict], schema: Dict, row_estimates: Dict[str, int],
+                budget: int, max_chunks: int) -> List[str]:
+    """
+    Pack ranked table digests into at most `max_chunks` schema texts of at
+    most `budget` tokens each. A table goes to the first chunk with room that
+    already holds one of its FK neighbours (so joins stay possible), else to
+    the first chunk with room, else to a new chunk.
+
+    Args:
+        semantic_tables: Semantic descriptions per authorized table.
+        schema: Extracted schema ({"tables": ..., "relationships": [...]}).
+        row_estimates: Approximate row count per table.
+        budget: Token budget for the schema text of one prompt.
+        max_chunks: Upper bound on the number of schema texts (LLM calls).
+
+    Returns:
+        Schema texts, most important tables first.
+    """
+    schema_tables = schema.get("tables", {})
+    relationships = schema.get("relationships", [])
+    neighbours = {}
+    for rel in relationships:
+        neighbours.setdefault(rel["from_table"], set()).add(rel["to_table"])
+        neighbours.setdefault(rel["to_table"], set()).add(rel["from_table"])
+
+    ranked = rank_tables(
+        {name: schema_tables.get(name, {}) for name in semantic_tables}, relationships, row_estimates
+    )
+    chunks: List[Dict] = []
+    dropped = []
+    for name, is_fact in ranked:
+        digest, tokens = _fit_digest(name, is_fact, semantic_tables[name], schema_tables.get(name, {}),
+                                     row_estimates.get(name), budget)
+        fitting = [chunk for chunk in chunks if chunk["tokens"] + tokens <= budget]
+        target = next((chunk for chunk in fitting if chunk["tables"] & neighbours.get(name, set())), None)
+        if target is None and fitting:
+            target = fitting[0]
+        if target is None and len(chunks) < max_chunks:
+            target = {"tables": set(), "digests": [], "tokens": 0}
+            chunks.append(target)
+        if target is None:
+            dropped.append(name)
+            continue
+        target["tables"].add(name)
+        target["digests"].append(digest)
+        target["tokens"] += tokens + 1
+
+    if dropped:
+        logger.warning(f"Schema digest over budget; left out {len(dropped)} lowest-ranked tables: {', '.join(dropped)}")
+    return ["\n".join(chunk["digests"]) for chunk in chunks]
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+import sqlparse
+from sqlparse.tokens import Keyword, Whitespace
+
+from database import async_db_query_cache
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Result cache for read-only SQL issued by the conversational agent, keyed on
+# (db_id, normalized SQL). Memory is the first tier; Mongo is an optional second
+# tier shared by every API process.
+SQL_CACHE_TTL_SECONDS = int(os.getenv("SQL_CACHE_TTL_SECONDS", "600"))
+SQL_CACHE_MAX_ENTRIES = int(os.getenv("SQL_CACHE_MAX_ENTRIES", "256"))
+SQL_CACHE_MAX_ROWS = int(os.getenv("SQL_CACHE_MAX_ROWS", "5000"))
+SQL_CACHE_MONGO_SPILLOVER = os.getenv("SQL_CACHE_MONGO_SPILLOVER", "false").lower() in ("1", "true", "yes")
+# Mongo documents are capped at 16MB; keep well clear of it.
+SQL_CACHE_MONGO_MAX_BYTES = 4 * 1024 * 1024
+
+_memory_cache = TTLCache(SQL_CACHE_MAX_ENTRIES, SQL_CACHE_TTL_SECONDS, name="sql_results")
+
+
+# Keywords that make a statement write or lock, wherever they appear (CTEs, SELECT ... INTO).
+WRITE_KEYWORDS = {"INTO", "COPY", "GRANT", "REVOKE", "LOCK", "CALL", "EXECUTE", "VACUUM", "ANALYZE", "REINDEX"}
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    Canonical form of a statement: no comments, upper-case keywords, single spaces
+    between tokens, no trailing ';'. String literals and quoted identifiers are kept verbatim.
+    """
+    formatted = sqlparse.format(sql, strip_comments=True, keyword_case="upper")
+    parts = []
+    for ttype, value in sqlparse.lexer.tokenize(formatted):
+        if ttype in Whitespace:
+            if parts and parts[-1] != " ":
+                parts.append(" ")
+        else:
+            parts.append(value)
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def is_read_only(sql: str) -> bool:
+    """True for a single SELECT (including WITH ... SELECT) statement with no write anywhere in it."""
+    statements = [statement for statement in sqlparse.parse(sql) if statement.token_first(skip_cm=True)]
+    if len(statements) != 1 or statements[0].get_type() != "SELECT":
+        return False
+    for token in statements[0].flatten():
+        if token.ttype in (Keyword.DML, Keyword.DDL) and token.normalized != "SELECT":
+            return False
+        if token.ttype in Keyword and token.normalized in WRITE_KEYWORDS:
+            return False
+    return True
+
+
+def _cache_key(db_id: str, sql: str) -> str:
+    return hashlib.sha256(f"{db_id}\x00{normalize_sql(sql)}".encode("utf-8")).hexdigest()
+
+
+async def get_cached_rows(db_id: str, sql: str) -> Optional[List[Dict]]:
+    """Return cached rows for the statement, or None on a miss."""
+    key = _cache_key(db_id, sql)
+    rows = _memory_cache.get(key)
+    if rows is not None or not SQL_CACHE_MONGO_SPILLOVER:
+        return rows
+
+    try:
+        document = await async_db_query_cache.find_one(
+            {"key": key, "expires_at": {"$gt": datetime.now(timezone.utc)}}, {"rows": 1}
+        )
+    except Exception as e:
+        logger.error(f"SQL cache lookup in Mongo failed: {e}")
+        return None
+    if document is None:
+        return None
+    rows = json.loads(document["rows"])
+    _memory_cache.set(key, rows)
+    return rows
+
+
+async def store_rows(db_id: str, sql: str, rows: List[Dict], encoder=None) -> None:
+    """Cache the rows of a read-only statement. Oversized results are not cached."""
+    if len(rows) > SQL_CACHE_MAX_ROWS or not is_read_only(sql):
+        return
+    key = _cache_key(db_id, sql)
+    _memory_cache.set(key, rows)
+    if not SQL_CACHE_MONGO_SPILLOVER:
+        return
+
+    serialized = json.dumps(rows, cls=encoder)
+    if len(serialized) > SQL_CACHE_MONGO_MAX_BYTES:
+        return
+    try:
+        await async_db_query_cache.update_one(
+            {"key": key},
+            {"$set": {
+                "db_id": db_id,
+                "sql": normalize_sql(sql),
+                "rows": serialized,
+                "expires_at": datetime.now(timezone.utc) + timedelta(seconds=SQL_CACHE_TTL_SECONDS),
+            }},
+            upsert=True
+        )
+    except Exception as e:
+        logger.error(f"SQL cache write to Mongo failed: {e}")
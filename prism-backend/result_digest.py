@@ -0,0 +1,314 @@
+import json
+import math
+import re
+from collections.abc import Hashable
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# Fixed-size statistical digest of a query result, computed locally with
+# pandas/NumPy, so the model reads the same few hundred tokens whether the
+# query returned five rows or five hundred thousand.
+
+TOP_K = 5
+SAMPLE_ROWS = 5
+MAX_COLUMNS = 20
+TOP_VALUES = 3
+OUTLIER_LIMIT = 5
+# Tukey fences: values beyond 1.5 interquartile ranges from the quartiles are outliers.
+IQR_FENCE = 1.5
+# Relative change between the first and last point below which a trend is "flat".
+FLAT_TREND = 0.02
+MAX_TEXT_CHARS = 40
+
+# Integer columns that label a period (year, order_month, week_number, ...) rather than measure
+# something; counts such as delivery_days or avg_orders_per_day stay measures.
+PERIOD_NAME = re.compile(
+    r"^(?:[a-z0-9]+_)?(year|quarter|month|week|day|date|period)(?:_(?:number|num|no|of_year|of_month|of_week))?$",
+    re.IGNORECASE,
+)
+# Values a period column of each kind can hold; date and period labels (20240131, 202401) can be any integer.
+PERIOD_RANGES = {"year": (1900, 2100), "quarter": (1, 4), "month": (1, 12), "week": (0, 53), "day": (0, 366)}
+ID_NAME = re.compile(r"(^|_)id$", re.IGNORECASE)
+# Period labels such as 2024-01, 2024/03 or 2024-Q1 from date_trunc/strftime/to_char.
+PERIOD_LABEL = r"^\d{4}([-/]|$)"
+# pandas.api.types.infer_dtype kinds.
+NUMBER_KINDS = {"integer", "floating", "mixed-integer-float", "decimal"}
+DATE_KINDS = {"date", "datetime", "datetime64"}
+
+
+def _plain(value):
+    """JSON-friendly scalar: rounded floats, ISO dates, shortened text, None for NaN/NaT and infinities."""
+    if value is None or value is pd.NaT:
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (Decimal, np.floating, float)):
+        number = float(value)
+        return round(number, 4) if math.isfinite(number) else None
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, pd.Timestamp) and value == value.normalize():
+        return value.date().isoformat()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, str) and len(value) > MAX_TEXT_CHARS:
+        return value[:MAX_TEXT_CHARS] + "…"
+    return value
+
+
+def _numeric(series: pd.Series) -> Optional[pd.Series]:
+    """The column as float64 if every non-null value is a number (Decimal included), else None. Infinities count as missing."""
+    if pd.api.types.infer_dtype(series, skipna=True) not in NUMBER_KINDS:
+        return None
+    return pd.to_numeric(series, errors="coerce").astype(float).replace([np.inf, -np.inf], np.nan)
+
+
+def _is_period(column, values: pd.Series) -> bool:
+    """True if a numeric column is named like a period and holds whole numbers in that period's range."""
+    match = PERIOD_NAME.match(str(column))
+    if match is None:
+        return False
+    present = values.dropna()
+    if present.empty or not (present % 1 == 0).all():
+        return False
+    low, high = PERIOD_RANGES.get(match.group(1).lower(), (-np.inf, np.inf))
+    return bool(present.between(low, high).all())
+
+
+def _temporal(series: pd.Series) -> Optional[pd.Series]:
+    """Sortable period keys if the column holds dates or period labels, else None."""
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+    if kind in DATE_KINDS:
+        return pd.to_datetime(series, errors="coerce")
+    if kind == "string" and series.dropna().str.match(PERIOD_LABEL).all():
+        return series
+    return None
+
+
+def _label(series: pd.Series) -> pd.Series:
+    """The column with JSON objects and arrays turned into text, so it can be counted and grouped."""
+    if pd.api.types.infer_dtype(series, skipna=True) != "mixed":
+        return series
+    return series.map(
+        lambda value: value if isinstance(value, Hashable) else json.dumps(value, default=str, sort_keys=True)
+    )
+
+
+def _classify(frame: pd.DataFrame):
+    """Split the columns into measures, time columns and labels, each a {name: series} dict."""
+    measures, times, labels = {}, {}, {}
+    for column in frame.columns:
+        series = frame[column]
+        numeric = _numeric(series)
+        if numeric is not None:
+            if _is_period(column, numeric):
+                times[column] = series
+            elif ID_NAME.search(str(column)):
+                labels[column] = _label(series)
+            else:
+                measures[column] = numeric
+            continue
+        temporal = _temporal(series)
+        if temporal is not None:
+            times[column] = temporal
+        else:
+            labels[column] = _label(series)
+    return measures, times, labels
+
+
+def _fences(values: np.ndarray):
+    """Lower and upper outlier fences of the non-null `values`."""
+    q1, q3 = np.percentile(values, [25, 75])
+    spread = q3 - q1
+    return q1 - IQR_FENCE * spread, q3 + IQR_FENCE * spread
+
+
+def _measure_summary(values: np.ndarray) -> Dict:
+    present = values[~np.isnan(values)]
+    nulls = int(len(values) - len(present))
+    if not len(present):
+        return {"kind": "measure", "nulls": nulls}
+    p25, median, p75 = np.percentile(present, [25, 50, 75])
+    low, high = p25 - IQR_FENCE * (p75 - p25), p75 + IQR_FENCE * (p75 - p25)
+    return {
+        "kind": "measure",
+        "nulls": nulls,
+        "sum": _plain(present.sum()),
+        "mean": _plain(present.mean()),
+        "min": _plain(present.min()),
+        "p25": _plain(p25),
+        "median": _plain(median),
+        "p75": _plain(p75),
+        "max": _plain(present.max()),
+        "outliers": int(((present < low) | (present > high)).sum()),
+    }
+
+
+def _time_summary(values: pd.Series) -> Dict:
+    present = values.dropna()
+    return {
+        "kind": "time",
+        "nulls": int(values.isna().sum()),
+        "distinct": int(present.nunique()),
+        "from": _plain(present.min()) if not present.empty else None,
+        "to": _plain(present.max()) if not present.empty else None,
+    }
+
+
+def _label_summary(values: pd.Series) -> Dict:
+    present = values.dropna().astype(str)
+    counts = present.value_counts().head(TOP_VALUES)
+    return {
+        "kind": "label",
+        "nulls": int(values.isna().sum()),
+        "distinct": int(present.nunique()),
+        "top_values": {_plain(value): int(count) for value, count in counts.items()},
+    }
+
+
+def _top_groups(label: pd.Series, measure: pd.Series, label_name: str, measure_name: str, top_k: int) -> Dict:
+    """The largest groups of `measure` summed by `label`, with their share and what the rest adds up to."""
+    totals = measure.dropna().groupby(label, dropna=True).sum()
+    total = totals.sum()
+    top = totals.sort_values(ascending=False, kind="stable").head(top_k)
+
+    def share(value):
+        return round(float(value / total) * 100, 1) if total else None
+
+    return {
+        "by": label_name,
+        "measure": measure_name,
+        "groups": int(len(totals)),
+        "items": [
+            {label_name: _plain(name), measure_name: _plain(value), "share_pct": share(value)}
+            for name, value in top.items()
+        ],
+        "others_share_pct": share(total - top.sum()) if len(totals) > len(top) else None,
+    }
+
+
+def _trend(time: pd.Series, measure: pd.Series, time_name: str, measure_name: str) -> Optional[Dict]:
+    """Period-over-period movement of `measure` summed per `time` value."""
+    series = measure.dropna().groupby(time, dropna=True).sum().sort_index()
+    if len(series) < 3:
+        return None
+    values = series.to_numpy(dtype=float)
+    periods = list(series.index)
+    first, last, previous = values[0], values[-1], values[-2]
+    slope = np.polyfit(np.arange(len(values)), values, 1)[0]
+    change = (last - first) / abs(first) if first else None
+    if change is not None and abs(change) < FLAT_TREND:
+        direction = "flat"
+    else:
+        direction = "up" if slope > 0 else "down" if slope < 0 else "flat"
+    deltas = np.diff(values)
+    return {
+        "over": time_name,
+        "measure": measure_name,
+        "periods": len(values),
+        "from": _plain(periods[0]),
+        "to": _plain(periods[-1]),
+        "first": _plain(first),
+        "last": _plain(last),
+        "change_pct": None if change is None else round(float(change) * 100, 1),
+        "direction": direction,
+        "last_delta": _plain(last - previous),
+        "last_delta_pct": round(float((last - previous) / abs(previous)) * 100, 1) if previous else None,
+        "biggest_rise": {"into": _plain(periods[int(np.argmax(deltas)) + 1]), "delta": _plain(deltas.max())},
+        "biggest_drop": {"into": _plain(periods[int(np.argmin(deltas)) + 1]), "delta": _plain(deltas.min())},
+        "peak": _plain(periods[int(np.argmax(values))]),
+        "low": _plain(periods[int(np.argmin(values))]),
+    }
+
+
+def _outliers(frame: pd.DataFrame, measures: Dict[str, np.ndarray], label_name: Optional[str]) -> List[Dict]:
+    """The rows furthest outside the IQR fences of any measure, most extreme first."""
+    flagged = []
+    for column, values in measures.items():
+        present = values[~np.isnan(values)]
+        if len(present) < 4:
+            continue
+        low, high = _fences(present)
+        spread = (high - low) or 1.0
+        with np.errstate(invalid="ignore"):
+            distance = np.fmax(values - high, low - values) / spread
+        hits = np.flatnonzero(distance > 0)
+        for index in hits[np.argsort(-distance[hits], kind="stable")[:OUTLIER_LIMIT]]:
+            flagged.append((distance[index], int(index), column, values[index], "high" if values[index] > high else "low"))
+    flagged.sort(key=lambda item: -item[0])
+    return [
+        {
+            "measure": column,
+            "value": _plain(value),
+            "side": side,
+            **({label_name: _plain(frame.iat[index, frame.columns.get_loc(label_name)])} if label_name else {"row": index}),
+        }
+        for _, index, column, value, side in flagged[:OUTLIER_LIMIT]
+    ]
+
+
+def digest_rows(rows: List[Dict], top_k: int = TOP_K) -> Dict:
+    """
+    Summarize a result set in a size independent of its row count.
+
+    Args:
+        rows: Result rows as dicts (all with the same keys).
+        top_k: How many of the largest groups to list.
+
+    Returns:
+        {"row_count", "complete", "columns": {column: summary}, "top", "trend",
+        "outliers", "sample"}. Columns are summarized by kind (measure, time or
+        label); `top` sums the first measure by the first label, `trend` by the
+        first time column; `sample` holds the first rows and `complete` says
+        whether they are the whole result.
+    """
+    if not rows:
+        return {"row_count": 0, "complete": True, "columns": {}, "top": None, "trend": None, "outliers": [], "sample": []}
+
+    frame = pd.DataFrame.from_records(rows)
+    omitted = max(len(frame.columns) - MAX_COLUMNS, 0)
+    frame = frame.iloc[:, :MAX_COLUMNS]
+    measures, times, labels = _classify(frame)
+    arrays = {column: values.to_numpy(dtype=float) for column, values in measures.items()}
+
+    columns = {}
+    for column in frame.columns:
+        if column in measures:
+            columns[column] = _measure_summary(arrays[column])
+        elif column in times:
+            columns[column] = _time_summary(times[column])
+        else:
+            columns[column] = _label_summary(labels[column])
+
+    measure_name = next(iter(measures), None)
+    # Group by a descriptive label (product, region) in preference to an id.
+    label_name = next(iter(sorted(labels, key=lambda name: bool(ID_NAME.search(str(name))))), None)
+    time_name = next(iter(times), None)
+    top = trend = None
+    if measure_name is not None:
+        group_name = label_name or time_name
+        if group_name is not None:
+            group = labels[group_name] if group_name in labels else frame[group_name]
+            top = _top_groups(group, measures[measure_name], group_name, measure_name, top_k)
+        if time_name is not None:
+            trend = _trend(times[time_name], measures[measure_name], time_name, measure_name)
+
+    digest = {
+        "row_count": len(frame),
+        "complete": len(frame) <= SAMPLE_ROWS,
+        "columns": columns,
+        "top": top,
+        "trend": trend,
+        "outliers": _outliers(frame, arrays, label_name or time_name),
+        "sample": [
+            {key: _plain(value) for key, value in row.items() if key in columns}
+            for row in rows[:SAMPLE_ROWS]
+        ],
+    }
+    if omitted:
+        digest["columns_omitted"] = omitted
+    return digest
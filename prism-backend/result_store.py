@@ -0,0 +1,151 @@
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.feather as feather
+
+logger = logging.getLogger(__name__)
+
+# Full query results kept on local disk as Arrow IPC (Feather v2) files and
+# referenced by handle, so tools can hand a result to each other without the
+# model copying the rows. Files expire after a TTL and the oldest are evicted
+# once the store grows past its size cap. Eviction walks the whole store, so
+# put() only runs it every RESULT_STORE_EVICT_INTERVAL_SECONDS, or sooner once
+# a tenth of the cap has been written since the last sweep.
+RESULT_STORE_DIR = os.getenv("RESULT_STORE_DIR", os.path.join(tempfile.gettempdir(), "prism-results"))
+RESULT_STORE_TTL_SECONDS = int(os.getenv("RESULT_STORE_TTL_SECONDS", "3600"))
+RESULT_STORE_MAX_BYTES = int(os.getenv("RESULT_STORE_MAX_BYTES", str(512 * 1024 * 1024)))
+RESULT_STORE_EVICT_INTERVAL_SECONDS = int(os.getenv("RESULT_STORE_EVICT_INTERVAL_SECONDS", "60"))
+
+HANDLE = re.compile(r"^[0-9a-f]{32}$")
+SUFFIX = ".arrow"
+PARTIAL_SUFFIX = ".tmp"
+
+_evict_lock = threading.Lock()
+_last_evict = 0.0
+_written_since_evict = 0
+
+
+def _tenant_dir(db_id: str) -> str:
+    return os.path.join(RESULT_STORE_DIR, re.sub(r"[^\w-]", "_", str(db_id)))
+
+
+def _path(db_id: str, handle: str) -> str:
+    return os.path.join(_tenant_dir(db_id), handle + SUFFIX)
+
+
+def _to_table(rows: List[Dict]) -> pa.Table:
+    try:
+        return pa.Table.from_pylist(rows)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Columns mixing Decimal with int/float (e.g. CASE expressions) have no single Arrow type.
+        return pa.Table.from_pylist([
+            {key: float(value) if isinstance(value, Decimal) else value for key, value in row.items()}
+            for row in rows
+        ])
+
+
+def put(db_id: str, rows: List[Dict]) -> str:
+    """
+    Store a result set for a connection.
+
+    Args:
+        db_id: Connection the rows came from; handles only resolve within it.
+        rows: Result rows as dicts (all with the same keys).
+
+    Returns:
+        The handle to pass to get().
+    """
+    handle = uuid.uuid4().hex
+    path = _path(db_id, handle)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f"{path}.{os.getpid()}{PARTIAL_SUFFIX}"
+    try:
+        feather.write_feather(_to_table(rows), partial, compression="uncompressed")
+        size = os.path.getsize(partial)
+        os.replace(partial, path)
+    except BaseException:
+        _remove(partial)
+        raise
+    _maybe_evict(size)
+    return handle
+
+
+def get(db_id: str, handle: str) -> Optional[List[Dict]]:
+    """Rows stored under `handle` for the connection, or None if unknown or expired."""
+    if not HANDLE.match(handle or ""):
+        return None
+    path = _path(db_id, handle)
+    try:
+        if time.time() - os.path.getmtime(path) > RESULT_STORE_TTL_SECONDS:
+            os.remove(path)
+            return None
+        return feather.read_table(path, memory_map=True).to_pylist()
+    except FileNotFoundError:
+        return None
+
+
+def _maybe_evict(size: int) -> None:
+    """Run evict() if the interval has passed or enough has been written since the last sweep."""
+    global _written_since_evict
+    _written_since_evict += size
+    if (
+        time.time() - _last_evict < RESULT_STORE_EVICT_INTERVAL_SECONDS
+        and _written_since_evict < RESULT_STORE_MAX_BYTES // 10
+    ):
+        return
+    evict()
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def evict() -> None:
+    """
+    Remove expired results, then the oldest ones until the store is within RESULT_STORE_MAX_BYTES.
+    Partial files left behind by interrupted writes are removed once they are older than the TTL.
+    """
+    global _last_evict, _written_since_evict
+    if not _evict_lock.acquire(blocking=False):
+        return
+    try:
+        now = time.time()
+        _last_evict, _written_since_evict = now, 0
+        files = []
+        for root, _, names in os.walk(RESULT_STORE_DIR):
+            for name in names:
+                if not name.endswith((SUFFIX, PARTIAL_SUFFIX)):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith(PARTIAL_SUFFIX):
+                    if now - stat.st_mtime > RESULT_STORE_TTL_SECONDS:
+                        _remove(path)
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for modified, size, path in files:
+            if now - modified <= RESULT_STORE_TTL_SECONDS and total <= RESULT_STORE_MAX_BYTES:
+                break
+            _remove(path)
+            total -= size
+    except Exception as e:
+        logger.error(f"Result store eviction failed: {e}")
+    finally:
+        _evict_lock.release()
@@ -0,0 +1,116 @@
+import re
+from typing import Dict, List, Optional
+
+# Compact, deterministic text forms of the extracted schema (schema_extractor
+# output) for LLM prompts, in place of json.dumps of the raw metadata: one
+# DDL-like line per column or table, flags only when set.
+
+SAMPLE_VALUES = 5
+SAMPLE_VALUE_CHARS = 24
+STAT_LABELS = {"min": "min", "max": "max", "mean": "mean", "25%": "p25", "50%": "median"}
+POSTGRES_CAST = re.compile(r"::[\w ]+(\[\])?")
+
+
+def format_number(value) -> str:
+    return f"{value:.2f}".rstrip("0").rstrip(".") if isinstance(value, float) else str(value)
+
+
+def format_stats(column_info) -> str:
+    """Profiling stats as `min 0, max 400, mean 201.5, ...`; sample values pass through as text."""
+    if isinstance(column_info, dict):
+        return ", ".join(
+            f"{label} {format_number(column_info[key])}"
+            for key, label in STAT_LABELS.items() if column_info.get(key) is not None
+        )
+    return column_info or ""
+
+
+def value_summary(column_info) -> str:
+    """Shortest useful hint at a column's values: a `min..max` range or a few samples."""
+    if isinstance(column_info, dict) and column_info.get("min") is not None:
+        return f"{format_number(column_info['min'])}..{format_number(column_info['max'])}"
+    if isinstance(column_info, str) and column_info:
+        samples = [value.strip()[:SAMPLE_VALUE_CHARS] for value in column_info.split(",")[:SAMPLE_VALUES]]
+        return "e.g. " + "|".join(samples)
+    return ""
+
+
+def column_ddl(name: str, column: Dict, foreign_key: Optional[str] = None, constraints: bool = True) -> str:
+    """
+    `name TYPE [PK|UNIQUE] [NOT NULL] [AUTO_INCREMENT] [DEFAULT x] [-> table.column]`.
+
+    Args:
+        name: Column name.
+        column: Column metadata from schema_extractor (type, nullable, default, ...).
+        foreign_key: Referenced `table.column`, if the column is a foreign key.
+        constraints: Include NOT NULL, AUTO_INCREMENT and DEFAULT; keys are always shown.
+    """
+    parts = [name]
+    if column.get("type"):
+        parts.append(column["type"])
+    if column.get("primary_key"):
+        parts.append("PK")
+    elif column.get("unique"):
+        parts.append("UNIQUE")
+    if constraints:
+        default = column.get("default")
+        if column.get("nullable") is False and not column.get("primary_key"):
+            parts.append("NOT NULL")
+        # Postgres serials surface as a nextval() default rather than the autoincrement flag.
+        if column.get("auto_increment") is True or str(default).startswith("nextval("):
+            parts.append("AUTO_INCREMENT")
+        elif default is not None:
+            parts.append(f"DEFAULT {POSTGRES_CAST.sub('', str(default))}")
+    if foreign_key:
+        parts.append(f"-> {foreign_key}")
+    return " ".join(parts)
+
+
+def foreign_key_targets(table: Dict) -> Dict[str, str]:
+    return {column: fk["references"] for column, fk in table.get("foreign_keys", {}).items()}
+
+
+def table_ddl(name: str, table: Dict, indexes: bool = True) -> str:
+    """
+    A table as `name(column, column, ...)` followed by its multi-column unique
+    constraints, check constraints and (optionally) indexes, one per line.
+    """
+    foreign_keys = foreign_key_targets(table)
+    columns = [column_ddl(column, info, foreign_keys.get(column)) for column, info in table.get("columns", {}).items()]
+    lines = [f"{name}({', '.join(columns)})"]
+    for unique in table.get("unique_constraints", []):
+        if len(unique) > 1:
+            lines.append(f"  UNIQUE({', '.join(unique)})")
+    for check in table.get("check_constraints", []):
+        # pg_get_constraintdef() already reads `CHECK (...)`; SQLite yields the bare expression.
+        lines.append(f"  {check}" if check.upper().startswith("CHECK") else f"  CHECK ({check})")
+    if indexes:
+        for index in table.get("indexes", []):
+            kind = "UNIQUE INDEX" if index.get("unique") else "INDEX"
+            lines.append(f"  {kind} {index.get('name')}({', '.join(index.get('columns') or [])})")
+    return "\n".join(lines)
+
+
+def relationship_lines(relationships: List[Dict]) -> List[str]:
+    return [
+        f"{rel['from_table']}({', '.join(rel['from_columns'])}) -> "
+        f"{rel['to_table']}({', '.join(rel['to_columns'])}) {rel.get('type', '')}".rstrip()
+        for rel in relationships
+    ]
+
+
+def schema_digest(schema_data: Dict) -> str:
+    """
+    Database-level digest: one line per table with its primary key and column
+    count, then the foreign-key relationships. Column details, indexes and
+    check constraints are left to the table-level prompts.
+    """
+    lines = ["Tables:"]
+    for name, table in schema_data.get("tables", {}).items():
+        details = f"{len(table.get('columns', {}))} columns"
+        if table.get("primary_key"):
+            details += f"; PK {', '.join(table['primary_key'])}"
+        lines.append(f"- {name} ({details})")
+    lines.append("Relationships:")
+    lines += [f"- {line}" for line in relationship_lines(schema_data.get("relationships", []))] or ["- none"]
+    return "\n".join(lines)
@@ -1,8 +1,9 @@
-from sqlalchemy import create_engine, inspect, MetaData, text
+from sqlalchemy import inspect, MetaData, text
 import json
 import re
 from typing import Dict,List
 from models import get_database_connection
+from warehouse import get_engine
 
 
 # Function to get check constraints for Postgres
@@ -35,17 +36,8 @@ def schema_extractor(authorized_data,user_id:str,db_id:str):
     data_connection=get_database_connection(user_id,db_id)
     # print(data_connection)
     
-    # Build connection string
-    if data_connection["db_type"] == "postgresql":
-        # schema="alpl_prod"
-        # DATABASE_URL = f"postgresql+psycopg2://{data_connection["username"]}:{data_connection["password"]}@{data_connection["host"]}:{data_connection["port"]}/{data_connection["database"]}?connect_timeout=10&options=-csearch_path%3D{schema}"
-        DATABASE_URL = f"postgresql+psycopg2://{data_connection["username"]}:{data_connection["password"]}@{data_connection["host"]}:{data_connection["port"]}/{data_connection["database"]}?connect_timeout=10"
-    elif data_connection.db_type == "mysql":
-        DATABASE_URL = f"mysql+pymysql://{data_connection["username"]}:{data_connection["password"]}@{data_connection["host"]}:{data_connection["port"]}/{data_connection["database"]}?connect_timeout=10"
-    else:
-        raise ValueError("Unsupported database type. Use 'postgresql' or 'mysql'.")
-
-    engine = create_engine(DATABASE_URL)
+    # Shared pooled engine; sessions carry the tenant's statement timeout
+    engine = get_engine(data_connection)
     inspector = inspect(engine)
     metadata = MetaData()
     metadata.reflect(bind=engine)
@@ -11,6 +11,11 @@ class UserLogin(BaseModel):
     email:str 
     password:str 
 
+class Principal(BaseModel):
+    user_id:str
+    username:str
+    email:str
+
 class Token(BaseModel):
     access_token:str 
     token_type:str 
@@ -22,6 +27,7 @@ class ConnectDB(BaseModel):
     password: str
     host: str
     port: int
+    statement_timeout_ms: Optional[int] = None
 
 class AuthorizedTablesColumnsInfo((RootModel[Dict[str, List[str]]])):
     pass
@@ -35,6 +41,9 @@ class KPI(BaseModel):
     formula: str
     formula_type: str = "sql"  # sql or general
     group_by: Optional[List[str]] = None 
+    materialize: bool = False  # keep an incremental rollup instead of re-aggregating on every read
+    time_column: Optional[str] = None  # bucketing / watermark column for materialized KPIs
+    time_grain: Optional[str] = None  # day, week, month or year
  
 class KPIs(BaseModel):
     kpis: List[KPI]
@@ -2,10 +2,14 @@ import json
 import os
 import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine, inspect, MetaData, Table
+from sqlalchemy import inspect, MetaData, Table
 from openai import AzureOpenAI
 from dotenv import load_dotenv
 from models import get_database_connection,get_extracted_schema
+from warehouse import get_engine
+from schema_digest import column_ddl, format_stats, schema_digest, table_ddl
+from metrics import LLM_ERRORS, LLM_LATENCY, record_tokens, timed
+from tracing import set_llm_usage, span
 load_dotenv()
 
 
@@ -18,44 +22,49 @@ client = AzureOpenAI(
 
 
 # ====== PROMPT TEMPLATES ======
+# Instructions first and the per-call content last, so every call of a kind
+# starts with the same text and can be served from the provider's prefix cache.
 column_prompt_template = """
+Using the column info below, generate a short, meaningful description of this column that captures what it likely represents in the dataset. Write it to be used in a vector search context (descriptive and keyword-rich, even if redundant).Keep it as short as possible
+
 Column Name: `{col_name}`
-Data Type: {col_type}
+Definition: {schema_meta}
 Column Stats or Sample Data: {meta}
-Schema Column Metadata: {schema_meta}
-
-Using the above info, generate a short, meaningful description of this column that captures what it likely represents in the dataset. Write it to be used in a vector search context (descriptive and keyword-rich, even if redundant).Keep it as short as possible
 """
 
 table_prompt_template = """
-Table Name: `{table_name}`
-Column Descriptions:
-{column_descriptions}
+Using the table info below, generate a concise summary of what this table represents and how it's likely used in the context of a relational database. Add any useful information that could support better understanding or searchability.keep it as short as possable
 
+Table Name: `{table_name}`
 Schema Table Metadata:
 {schema_meta}
 
-Generate a concise summary of what this table represents and how it's likely used in the context of a relational database. Add any useful information that could support better understanding or searchability.keep it as short as possable
+Column Descriptions:
+{column_descriptions}
 """
 
 db_prompt_template = """
-Database Name: `{db_name}`
-Table Descriptions:
-{table_descriptions}
+Using the database info below, generate an overview of this database's purpose, including any useful metadata or inferred relationships between tables that a developer or data scientist might want to know when exploring it.keep it as short as possable
 
+Database Name: `{db_name}`
 Schema Relationships and Metadata:
 {schema_meta}
 
-Generate an overview of this database's purpose, including any useful metadata or inferred relationships between tables that a developer or data scientist might want to know when exploring it.keep it as short as possable
+Table Descriptions:
+{table_descriptions}
 """
 
 # ====== UTILITY FUNCTIONS ======
-def ask_llm(prompt):
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.4,
-    )
+def ask_llm(prompt, prompt_name="semantic"):
+    with span("llm.chat", "llm", "client", **{"gen_ai.request.model": "gpt-4o"}) as llm_span, \
+            timed(LLM_LATENCY, LLM_ERRORS, operation="chat", model="gpt-4o"):
+        response = client.chat.completions.create(
+            model="gpt-4o",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.4,
+        )
+        set_llm_usage(llm_span, response.usage)
+    record_tokens("gpt-4o", response.usage, prompt_name)
     return response.choices[0].message.content.strip()
 
 def clean_numpy_floats(d):
@@ -68,12 +77,11 @@ def clean_numpy_floats(d):
     else:
         return d
 
-def render_column_prompt(col_name, col_type, meta, schema_meta):
+def render_column_prompt(col_name, col_type, meta, schema_meta, foreign_key=None):
     return column_prompt_template.format(
         col_name=col_name,
-        col_type=col_type,
-        meta=json.dumps(meta, ensure_ascii=False) if isinstance(meta, dict) else meta,
-        schema_meta=json.dumps(schema_meta, ensure_ascii=False)
+        meta=format_stats(meta),
+        schema_meta=column_ddl(col_name, {**schema_meta, "type": col_type}, foreign_key)
     )
 
 def render_table_prompt(table_name, col_descs, schema_meta):
@@ -81,7 +89,7 @@ def render_table_prompt(table_name, col_descs, schema_meta):
     return table_prompt_template.format(
         table_name=table_name,
         column_descriptions=desc_text,
-        schema_meta=json.dumps(schema_meta, ensure_ascii=False)
+        schema_meta=table_ddl(table_name, schema_meta)
     )
 
 def render_db_prompt(db_name, table_descs, schema_meta):
@@ -89,7 +97,7 @@ def render_db_prompt(db_name, table_descs, schema_meta):
     return db_prompt_template.format(
         db_name=db_name,
         table_descriptions=desc_text,
-        schema_meta=json.dumps(schema_meta, ensure_ascii=False)
+        schema_meta=schema_digest(schema_meta)
     )
 
 
@@ -103,16 +111,7 @@ def semantic_extactor(authorized_tables_columns_info,user_id,db_id):
 
     # ====== DATABASE CONFIG ======
     data_connection=get_database_connection(user_id,db_id)
-    if data_connection["db_type"] == "postgresql":
-        # schema="alpl_prod"
-        # DATABASE_URL = f"postgresql+psycopg2://{data_connection["username"]}:{data_connection["password"]}@{data_connection["host"]}:{data_connection["port"]}/{data_connection["database"]}?connect_timeout=10&options=-csearch_path%3D{schema}"
-        DATABASE_URL = f"postgresql+psycopg2://{data_connection["username"]}:{data_connection["password"]}@{data_connection["host"]}:{data_connection["port"]}/{data_connection["database"]}?connect_timeout=10"
-    elif data_connection["db_type"] == "mysql":
-        DATABASE_URL = f"mysql+pymysql://{data_connection["username"]}:{data_connection["password"]}@{data_connection["host"]}:{data_connection["port"]}/{data_connection["database"]}?connect_timeout=10"
-    else:
-        raise ValueError("Unsupported database type. Use 'postgresql' or 'mysql'.")
-    
-    engine = create_engine(DATABASE_URL)
+    engine = get_engine(data_connection)
     inspector = inspect(engine)
     metadata = MetaData()
     metadata.reflect(bind=engine)
@@ -156,15 +155,16 @@ def semantic_extactor(authorized_tables_columns_info,user_id,db_id):
                     }
 
                 schema_meta = schema_data["tables"][table_name]["columns"][col_name]
-                prompt = render_column_prompt(col_name, col_type, meta, schema_meta)
-                col_description = ask_llm(prompt)
+                foreign_key = schema_data["tables"][table_name]["foreign_keys"].get(col_name, {}).get("references")
+                prompt = render_column_prompt(col_name, col_type, meta, schema_meta, foreign_key)
+                col_description = ask_llm(prompt, "semantic_column")
                 column_descriptions[col_name] = {
                     "column_info": meta,
                     "description": col_description
                 }
 
             table_prompt = render_table_prompt(table_name, {k: v["description"] for k, v in column_descriptions.items()}, schema_data["tables"][table_name])
-            table_description = ask_llm(table_prompt)
+            table_description = ask_llm(table_prompt, "semantic_table")
             table_descriptions[table_name] = table_description
 
             semantic_json[db_name][table_name] = {
@@ -174,7 +174,7 @@ def semantic_extactor(authorized_tables_columns_info,user_id,db_id):
 
     # Final Database Level Description
     db_prompt = render_db_prompt(db_name, table_descriptions, schema_data)
-    database_description = ask_llm(db_prompt)
+    database_description = ask_llm(db_prompt, "semantic_database")
     semantic_json[db_name]["database_description"] = database_description
 
     # ====== SAVE TO FILE ======
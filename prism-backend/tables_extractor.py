@@ -1,5 +1,42 @@
-from sqlalchemy import create_engine, inspect
-from typing import Dict
+import hashlib
+import os
+from typing import Dict, Optional
+from ttl_cache import TTLCache
+from warehouse import fetch_all
+
+# One catalog query lists every base table and its columns in the connection's
+# default schema, instead of one inspector round trip per table.
+CATALOG_SCHEMAS = {
+    "postgresql": "current_schema()",
+    "mysql": "DATABASE()",
+}
+CATALOG_QUERY = """
+SELECT c.table_name AS table_name, c.column_name AS column_name
+FROM information_schema.columns c
+JOIN information_schema.tables t
+  ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+WHERE c.table_schema = {schema} AND t.table_type = 'BASE TABLE'
+ORDER BY c.table_name, c.ordinal_position
+"""
+CATALOG_CACHE_SECONDS = int(os.getenv("CATALOG_CACHE_SECONDS", "900"))
+
+_catalog_cache = TTLCache(256, CATALOG_CACHE_SECONDS, name="table_catalogs")
+
+
+def connection_fingerprint(data_connection: Dict) -> str:
+    # Includes the password so a cached listing never validates wrong credentials.
+    parts = [str(data_connection.get(key)) for key in ("db_type", "host", "port", "database", "username", "password")]
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+def load_catalog(data_connection: Dict) -> Dict[str, list]:
+    """Run the catalog query; raises if the connection or the query fails."""
+    sql = CATALOG_QUERY.format(schema=CATALOG_SCHEMAS[data_connection["db_type"]])
+    schema = {}
+    for row in fetch_all(data_connection, sql):
+        schema.setdefault(row["table_name"], []).append(row["column_name"])
+    return schema
+
 
 def get_tables_and_columns(
     db_type: str,
@@ -7,37 +44,41 @@ def get_tables_and_columns(
     username: str,
     password: str,
     host: str,
-    port: int
+    port: int,
+    statement_timeout_ms: Optional[int] = None,
+    refresh: bool = False,
+    db_id: Optional[str] = None
 ) -> Dict[str, list]:
     """
     Returns a dictionary with table names as keys and list of column names as values.
+    Listings are cached per connection for CATALOG_CACHE_SECONDS unless refresh is set.
     
     db_type: 'postgresql' or 'mysql'
+    db_id: Stored connection id, used to label warehouse metrics.
 
     """
-    if db_type == "postgresql":
-        # schema="alpl_prod"
-        # uri = f"postgresql+psycopg2://{username}:{password}@{host}:{port}/{database}?connect_timeout=10&options=-csearch_path%3D{schema}"
-        # print(uri)
-        uri = f"postgresql+psycopg2://{username}:{password}@{host}:{port}/{database}?connect_timeout=10"
-    elif db_type == "mysql":
-        uri = f"mysql+pymysql://{username}:{password}@{host}:{port}/{database}?connect_timeout=10"
-    else:
+    if db_type not in CATALOG_SCHEMAS:
         raise ValueError("Unsupported database type. Use 'postgresql' or 'mysql'.")
 
-    try:
-        engine = create_engine(uri)
-        inspector = inspect(engine)
-
-        schema = {}
-        for table_name in inspector.get_table_names():
-            columns = inspector.get_columns(table_name)
-            schema[table_name] = [col["name"] for col in columns]
-        # print(schema)
-        return schema
-    except Exception as e:
-        # print("❌ Connection failed:", str(e))
-        return {}
+    data_connection = {
+        "db_type": db_type,
+        "database": database,
+        "username": username,
+        "password": password,
+        "host": host,
+        "port": port,
+        "statement_timeout_ms": statement_timeout_ms,
+        "db_id": db_id,
+    }
+    key = connection_fingerprint(data_connection)
+    if not refresh:
+        schema = _catalog_cache.get(key)
+        if schema is not None:
+            return schema
+
+    schema = load_catalog(data_connection)
+    _catalog_cache.set(key, schema)
+    return schema
 # if __name__=="__main__":
     # db_info = {
     #     "db_type": "postgresql",
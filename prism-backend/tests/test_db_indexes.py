@@ -0,0 +1,31 @@
+import os
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+
+def _mongo_reachable() -> bool:
+    probe = MongoClient(os.getenv("MONGO_URI"), serverSelectionTimeoutMS=2000)
+    try:
+        probe.admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+    finally:
+        probe.close()
+
+
+@pytest.mark.skipif(not _mongo_reachable(), reason="MongoDB is not reachable")
+def test_hot_query_shapes_are_index_backed():
+    from db_indexes import audit_query_shapes, ensure_indexes
+
+    assert ensure_indexes() == []
+    assert audit_query_shapes() == []
+
+
+def test_winning_stages_walk_nested_plans():
+    from db_indexes import _winning_stages
+
+    plan = {"stage": "FETCH", "inputStage": {"stage": "OR", "inputStages": [{"stage": "IXSCAN"}, {"stage": "COLLSCAN"}]}}
+    assert _winning_stages(plan) == ["FETCH", "OR", "IXSCAN", "COLLSCAN"]
@@ -0,0 +1,56 @@
+import pytest
+
+from formula_validator import SchemaIndex, split_select, validate_sql
+
+INDEX = SchemaIndex({
+    "orders": ["order_id", "customer_id", "status", "order_value", "created_at"],
+    "customers": ["customer_id", "region"],
+})
+
+
+def codes(formula):
+    return [(diagnostic.code, diagnostic.reference) for diagnostic in validate_sql(formula, INDEX)]
+
+
+@pytest.mark.parametrize("alias", ["month", "year", "date", "week", "mth"])
+def test_group_by_a_select_alias_spelled_like_a_keyword(alias):
+    formula = (
+        f"SELECT date_trunc('month', created_at) AS {alias}, SUM(order_value) AS total "
+        f"FROM orders GROUP BY {alias} ORDER BY {alias}"
+    )
+    assert codes(formula) == []
+
+
+def test_keyword_alias_in_a_group_by_list_still_checks_the_other_columns():
+    select = "SELECT date_trunc('month', created_at) AS month, status, SUM(order_value) AS total FROM orders"
+    assert codes(f"{select} GROUP BY month, status") == []
+    assert codes(f"{select} GROUP BY month") == [("missing_group_by", "status")]
+
+
+def test_split_select_separates_keyword_aliases():
+    parts = split_select("SELECT date_trunc('day', created_at) AS date, SUM(order_value) AS total FROM orders GROUP BY date")
+    assert [(item["sql"], item["alias"]) for item in parts["select"]] == [
+        ("date_trunc('day', created_at)", "date"),
+        ("SUM(order_value)", "total"),
+    ]
+
+
+def test_bare_column_next_to_an_aggregate_needs_group_by():
+    assert codes("SELECT status, SUM(order_value) FROM orders") == [("missing_group_by", "status")]
+    assert codes("SELECT status, SUM(order_value) FROM orders GROUP BY status") == []
+    assert codes("SELECT status, SUM(order_value) FROM orders GROUP BY 1") == []
+
+
+def test_window_functions_and_filter_clauses_are_not_bare_columns():
+    assert codes("SELECT status, SUM(order_value) OVER (PARTITION BY status) AS s FROM orders") == []
+    assert codes("SELECT COUNT(*) FILTER (WHERE status = 'paid') FROM orders") == []
+    assert codes("SELECT COUNT(*) FILTER (WHERE status = 'paid') AS paid FROM orders") == []
+    assert codes("SELECT SUM(order_value) FILTER (WHERE nope = 1) FROM orders") == [("unknown_column", "nope")]
+
+
+def test_unknown_and_ambiguous_columns():
+    assert codes("SELECT SUM(amount) FROM orders") == [("unknown_column", "amount")]
+    assert codes(
+        "SELECT region, COUNT(*) FROM orders JOIN customers ON orders.customer_id = customers.customer_id "
+        "WHERE customer_id > 0 GROUP BY region"
+    ) == [("ambiguous_column", "customer_id")]
@@ -0,0 +1,25 @@
+from kpi_batch import plan_kpi_batches, split_batch_rows
+
+
+def test_kpis_over_the_same_rows_are_merged():
+    kpis = [
+        {"formula": "SELECT SUM(amount) AS revenue FROM orders WHERE status = 'paid'"},
+        {"formula": "select count(*) as orders from orders where status = 'paid'"},
+    ]
+    batches = plan_kpi_batches(kpis, "postgresql")
+    assert len(batches) == 1
+    assert batches[0]["kpis"] == [0, 1]
+
+    rows = [{"kpi_measure_0": 120, "kpi_measure_1": 3}]
+    assert split_batch_rows(batches[0], rows) == [[{"revenue": 120}], [{"orders": 3}]]
+
+
+def test_kpis_differing_only_inside_a_literal_are_not_merged():
+    kpis = [
+        {"formula": "SELECT SUM(amount) AS revenue FROM orders WHERE status = 'paid  x'"},
+        {"formula": "SELECT SUM(amount) AS revenue FROM orders WHERE status = 'paid x'"},
+        {"formula": "SELECT SUM(amount) AS revenue FROM orders WHERE status = 'PAID X'"},
+    ]
+    batches = plan_kpi_batches(kpis, "postgresql")
+    assert sorted(batch["kpis"] for batch in batches) == [[0], [1], [2]]
+    assert [batch["sql"] for batch in sorted(batches, key=lambda batch: batch["kpis"])] == [kpi["formula"] for kpi in kpis]
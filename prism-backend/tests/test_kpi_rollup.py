@@ -0,0 +1,30 @@
+import pytest
+
+from kpi_rollup import plan_rollup, refresh_sql
+
+
+def test_plan_rollup_splits_measures_and_dims():
+    plan = plan_rollup(
+        "SELECT status, SUM(order_value) AS revenue, COUNT(*) AS orders FROM orders WHERE status <> 'void' GROUP BY status",
+        "created_at", "month", "postgresql",
+    )
+    assert plan["dims"] == ["status"]
+    assert plan["measures"] == ["SUM(order_value)", "COUNT(*)"]
+    assert [column.get("merge") for column in plan["columns"]] == [None, "SUM", "COUNT"]
+
+
+@pytest.mark.parametrize("condition", [
+    "created_at >= NOW() - INTERVAL '30 days'",
+    "created_at >= CURRENT_DATE - 7",
+    "created_at > current_timestamp - interval '1 hour'",
+    "created_at >= DATE_SUB(CURDATE(), INTERVAL 30 DAY)",
+])
+def test_time_relative_filters_are_not_materialized(condition):
+    with pytest.raises(ValueError):
+        plan_rollup(f"SELECT SUM(order_value) AS revenue FROM orders WHERE {condition}", "created_at", "day", "postgresql")
+
+
+def test_refresh_keeps_rows_without_a_timestamp():
+    plan = plan_rollup("SELECT SUM(order_value) AS revenue FROM orders", "created_at", "day", "postgresql")
+    assert "created_at IS NULL" in refresh_sql(plan, "2024-01-01 00:00:00")
+    assert "WHERE" not in refresh_sql(plan, None)
@@ -0,0 +1,36 @@
+from query_cache import _cache_key, is_read_only, normalize_sql
+
+
+def test_normalize_sql_collapses_layout_and_comments():
+    assert normalize_sql("select  amount\n  from orders -- latest\n;") == normalize_sql("SELECT amount FROM orders")
+    assert normalize_sql("SELECT /* all */ amount FROM orders") == normalize_sql("SELECT amount FROM orders")
+
+
+def test_normalize_sql_keeps_string_literals_verbatim():
+    assert "'paid  x'" in normalize_sql("SELECT * FROM orders WHERE status = 'paid  x'")
+    assert normalize_sql("SELECT * FROM orders WHERE status = 'paid  x'") != normalize_sql(
+        "SELECT * FROM orders WHERE status = 'paid x'"
+    )
+    assert normalize_sql("SELECT * FROM orders WHERE status = 'Paid'") != normalize_sql(
+        "SELECT * FROM orders WHERE status = 'paid'"
+    )
+
+
+def test_cache_key_separates_connections_and_statements():
+    assert _cache_key("db1", "SELECT 1") == _cache_key("db1", "select   1;")
+    assert _cache_key("db1", "SELECT 1") != _cache_key("db2", "SELECT 1")
+    assert _cache_key("db1", "SELECT 1; SELECT 2") != _cache_key("db1", "SELECT 1")
+
+
+def test_is_read_only_accepts_selects():
+    assert is_read_only("SELECT amount FROM orders")
+    assert is_read_only("WITH paid AS (SELECT * FROM orders WHERE status = 'paid') SELECT COUNT(*) FROM paid")
+    assert is_read_only("SELECT 'DELETE FROM orders' AS note")
+
+
+def test_is_read_only_rejects_writes_anywhere():
+    assert not is_read_only("SELECT 1; DELETE FROM orders")
+    assert not is_read_only("SELECT 1 -- harmless\n; DROP TABLE orders")
+    assert not is_read_only("WITH gone AS (DELETE FROM orders RETURNING *) SELECT * FROM gone")
+    assert not is_read_only("SELECT * INTO backup FROM orders")
+    assert not is_read_only("UPDATE orders SET amount = 0")
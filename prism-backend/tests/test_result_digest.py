@@ -0,0 +1,73 @@
+import json
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from result_digest import digest_rows
+
+
+def kinds(rows):
+    return {name: summary["kind"] for name, summary in digest_rows(rows)["columns"].items()}
+
+
+def test_empty_result():
+    digest = digest_rows([])
+    assert digest["row_count"] == 0 and digest["complete"] and digest["sample"] == []
+
+
+@pytest.mark.parametrize("name, values", [
+    ("year", [2022, 2023, 2024]),
+    ("order_month", [1, 2, 3]),
+    ("week_number", [1, 2, 53]),
+    ("quarter", [1, 2, 4]),
+])
+def test_period_columns_are_time(name, values):
+    rows = [{name: value, "revenue": 10.0 * index} for index, value in enumerate(values, start=1)]
+    assert kinds(rows) == {name: "time", "revenue": "measure"}
+
+
+@pytest.mark.parametrize("name, values", [
+    ("avg_orders_per_day", [1.5, 2.25, 3.0]),
+    ("delivery_days", [2, 5, 9]),
+    ("tenure_months", [3, 14, 40]),
+    ("month", [10, 20, 30]),
+])
+def test_counts_named_after_periods_are_measures(name, values):
+    rows = [{"region": region, name: value} for region, value in zip("ABC", values)]
+    digest = digest_rows(rows)
+    assert digest["columns"][name]["kind"] == "measure"
+    assert digest["top"]["measure"] == name
+    assert digest["columns"][name]["sum"] == pytest.approx(sum(values))
+
+
+def test_top_groups_and_trend():
+    rows = [
+        {"month": date(2024, month, 1), "region": region, "revenue": Decimal(month * (2 if region == "West" else 1))}
+        for month in range(1, 7)
+        for region in ("West", "East")
+    ]
+    digest = digest_rows(rows)
+    assert digest["top"]["items"][0] == {"region": "West", "revenue": 42.0, "share_pct": 66.7}
+    assert digest["trend"]["direction"] == "up"
+    assert digest["trend"]["periods"] == 6
+    assert not digest["complete"]
+
+
+def test_json_and_array_labels_are_grouped():
+    rows = [{"tags": ["a", "b"] if index % 2 else ["c"], "meta": {"k": index % 2}, "amount": index} for index in range(6)]
+    digest = digest_rows(rows)
+    assert digest["columns"]["tags"]["kind"] == "label"
+    assert digest["top"]["groups"] == 2
+
+
+def test_non_finite_numbers_never_reach_json():
+    rows = [
+        {"amount": Decimal("NaN"), "ratio": float("inf")},
+        {"amount": Decimal("2.5"), "ratio": 1.0},
+        {"amount": Decimal("Infinity"), "ratio": float("-inf")},
+    ]
+    digest = digest_rows(rows)
+    json.dumps(digest, allow_nan=False)
+    assert digest["columns"]["amount"]["sum"] == 2.5
+    assert digest["sample"][0] == {"amount": None, "ratio": None}
@@ -0,0 +1,61 @@
+import os
+import time
+
+import pytest
+
+import result_store
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_store, "RESULT_STORE_DIR", str(tmp_path))
+    monkeypatch.setattr(result_store, "_last_evict", time.time())
+    monkeypatch.setattr(result_store, "_written_since_evict", 0)
+    return tmp_path
+
+
+def files(root, suffix):
+    return [name for _, _, names in os.walk(root) for name in names if name.endswith(suffix)]
+
+
+def test_put_and_get_round_trip(store):
+    rows = [{"region": "West", "revenue": 10.5}, {"region": "East", "revenue": 4.0}]
+    handle = result_store.put("db1", rows)
+    assert result_store.get("db1", handle) == rows
+    assert result_store.get("db2", handle) is None
+
+
+def test_failed_write_leaves_no_partial_file(store, monkeypatch):
+    def fail(table, path, **kwargs):
+        open(path, "wb").write(b"partial")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(result_store.feather, "write_feather", fail)
+    with pytest.raises(OSError):
+        result_store.put("db1", [{"a": 1}])
+    assert files(store, "") == []
+
+
+def test_put_only_sweeps_after_the_interval(store, monkeypatch):
+    sweeps = []
+    monkeypatch.setattr(result_store, "evict", lambda: sweeps.append(1))
+    result_store.put("db1", [{"a": 1}])
+    assert sweeps == []
+    monkeypatch.setattr(result_store, "_last_evict", time.time() - result_store.RESULT_STORE_EVICT_INTERVAL_SECONDS - 1)
+    result_store.put("db1", [{"a": 1}])
+    assert sweeps == [1]
+
+
+def test_evict_removes_expired_results_and_stale_partials(store):
+    fresh = result_store.put("db1", [{"a": 1}])
+    old = result_store.put("db1", [{"a": 2}])
+    tenant = store / "db1"
+    (tenant / "stale.arrow.1.tmp").write_bytes(b"x")
+    (tenant / "writing.arrow.2.tmp").write_bytes(b"x")
+    expired = time.time() - result_store.RESULT_STORE_TTL_SECONDS - 10
+    for name in (old + ".arrow", "stale.arrow.1.tmp"):
+        os.utime(tenant / name, (expired, expired))
+
+    result_store.evict()
+    assert sorted(files(store, "")) == sorted([fresh + ".arrow", "writing.arrow.2.tmp"])
+    assert result_store.get("db1", fresh) == [{"a": 1}]
@@ -0,0 +1,383 @@
+import functools
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from pymongo import monitoring
+
+from metrics import cached_prompt_tokens, usage_value
+
+logger = logging.getLogger(__name__)
+
+# Opt-in request tracing. Spans follow the OpenTelemetry data model (trace
+# and span ids, parent links, kind, attributes, status) and a sampled share of
+# finished requests is appended to TRACE_EXPORT_PATH as one OTLP/JSON line, the
+# format the OpenTelemetry Collector's file receiver reads. The file is rotated
+# once it reaches TRACE_EXPORT_MAX_BYTES, keeping TRACE_EXPORT_BACKUPS old
+# files. SQL text is only recorded with TRACE_STATEMENTS. Every span also
+# carries a coarse "stage" (llm, tool, sql, mongo, embedding, vector) used for
+# the per-request Server-Timing breakdown, returned when a request sends
+# TRACE_DEBUG_HEADER set to TRACE_DEBUG_TOKEN.
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() in ("1", "true", "yes")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_STATEMENTS = os.getenv("TRACE_STATEMENTS", "false").lower() in ("1", "true", "yes")
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "traces.jsonl")
+TRACE_EXPORT_MAX_BYTES = int(os.getenv("TRACE_EXPORT_MAX_BYTES", str(50 * 1024 * 1024)))
+TRACE_EXPORT_BACKUPS = int(os.getenv("TRACE_EXPORT_BACKUPS", "3"))
+TRACE_DEBUG_HEADER = "X-Debug-Timing"
+# Debug timing headers are only returned to requests that present this token; unset disables them.
+TRACE_DEBUG_TOKEN = os.getenv("TRACE_DEBUG_TOKEN", "")
+SERVICE_NAME = "prism-backend"
+MAX_ATTRIBUTE_LENGTH = 2000
+
+SPAN_KINDS = {
+    "internal": "SPAN_KIND_INTERNAL",
+    "server": "SPAN_KIND_SERVER",
+    "client": "SPAN_KIND_CLIENT",
+}
+
+_current_trace = ContextVar("current_trace", default=None)
+_current_span = ContextVar("current_span", default=None)
+
+
+def _otlp_value(value) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)[:MAX_ATTRIBUTE_LENGTH]}
+
+
+class Span:
+    def __init__(self, trace: "Trace", name: str, stage: str, kind: str, parent_span_id: Optional[str], attributes: Dict):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.stage = stage
+        self.kind = kind
+        self.attributes = {key: value for key, value in attributes.items() if value is not None}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+        self._started = time.perf_counter()
+        self.duration_ms = None
+
+    def set_attribute(self, key: str, value) -> None:
+        if value is not None:
+            self.attributes[key] = value
+
+    def end(self, error: Optional[str] = None) -> None:
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        self.duration_ms = (time.perf_counter() - self._started) * 1000
+        self.error = error
+        self.trace.add(self)
+
+    def to_otlp(self) -> Dict:
+        status = {"code": "STATUS_CODE_ERROR", "message": self.error} if self.error else {"code": "STATUS_CODE_OK"}
+        return {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_span_id or "",
+            "name": self.name,
+            "kind": SPAN_KINDS[self.kind],
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in {**self.attributes, "prism.stage": self.stage}.items()
+            ],
+            "status": status,
+        }
+
+
+class Trace:
+    """Finished spans of one request."""
+
+    def __init__(self):
+        self.trace_id = secrets.token_hex(16)
+        self.spans: List[Span] = []
+        self.root: Optional[Span] = None
+        self.sampled = True
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def stage_totals(self) -> Dict[str, tuple]:
+        """stage -> (span count, summed milliseconds), excluding the request span itself."""
+        totals: Dict[str, list] = {}
+        with self._lock:
+            for span in self.spans:
+                if span is self.root:
+                    continue
+                entry = totals.setdefault(span.stage, [0, 0.0])
+                entry[0] += 1
+                entry[1] += span.duration_ms
+        return {stage: (count, ms) for stage, (count, ms) in totals.items()}
+
+    def to_otlp(self) -> Dict:
+        with self._lock:
+            spans = [span.to_otlp() for span in self.spans]
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "prism.tracing"}, "spans": spans}],
+        }]}
+
+
+class JsonlExporter:
+    """Appends traces to a size-capped, rotated file from a background thread so requests never wait on disk."""
+
+    def __init__(self, path: str, max_bytes: int = TRACE_EXPORT_MAX_BYTES, backups: int = TRACE_EXPORT_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue = queue.Queue(maxsize=1000)
+        self._thread = None
+
+    def export(self, trace: Trace) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            logger.warning("Trace export queue is full; dropping a trace")
+
+    def _run(self) -> None:
+        while True:
+            trace = self._queue.get()
+            if trace is None:
+                return
+            batch = [trace]
+            while not self._queue.empty() and len(batch) < 100:
+                next_trace = self._queue.get_nowait()
+                if next_trace is None:
+                    self._write(batch)
+                    return
+                batch.append(next_trace)
+            self._write(batch)
+
+    def _rotate(self) -> None:
+        """traces.jsonl -> traces.jsonl.1 -> ... -> traces.jsonl.N, dropping the oldest."""
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def _write(self, traces: List[Trace]) -> None:
+        try:
+            lines = [json.dumps(trace.to_otlp(), default=str) + "\n" for trace in traces]
+            for line in lines:
+                if self.max_bytes > 0 and os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+                    self._rotate()
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+        except OSError as e:
+            logger.error(f"Failed to write traces to {self.path}: {e}")
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+
+exporter = JsonlExporter(TRACE_EXPORT_PATH)
+
+
+def start_span(name: str, stage: str, kind: str = "internal", parent: Optional[Span] = None, **attributes) -> Optional[Span]:
+    """Start a span in the current request's trace; returns None outside a traced request."""
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    parent = parent or _current_span.get()
+    return Span(trace, name, stage, kind, parent.span_id if parent else None, attributes)
+
+
+@contextmanager
+def span(name: str, stage: str, kind: str = "internal", **attributes):
+    """Time a block as a child of the current span. Yields the Span, or None when not tracing."""
+    current = start_span(name, stage, kind, **attributes)
+    if current is None:
+        yield None
+        return
+    token = _current_span.set(current)
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end(error)
+
+
+def traced(name: str, stage: str, kind: str = "internal"):
+    """Decorator form of span() for sync and async functions."""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, stage, kind):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, stage, kind):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def debug_requested(header_value: Optional[str]) -> bool:
+    """True if a TRACE_DEBUG_HEADER value carries the configured TRACE_DEBUG_TOKEN."""
+    return bool(TRACE_DEBUG_TOKEN and header_value) and secrets.compare_digest(header_value, TRACE_DEBUG_TOKEN)
+
+
+@contextmanager
+def trace_request(name: str, force: bool = False, **attributes):
+    """
+    Root a new trace for one request and export it when the block exits, if sampled.
+
+    Args:
+        name: Name of the request span.
+        force: Trace the request even if it is not sampled (for the debug timing headers);
+            such traces are not exported.
+        attributes: Attributes of the request span.
+
+    Yields:
+        The Trace, or None when the request is not traced.
+    """
+    sampled = TRACING_ENABLED and random.random() < TRACE_SAMPLE_RATE
+    if not sampled and not force:
+        yield None
+        return
+    trace = Trace()
+    trace.sampled = sampled
+    trace_token = _current_trace.set(trace)
+    trace.root = Span(trace, name, "request", "server", None, attributes)
+    span_token = _current_span.set(trace.root)
+    error = None
+    try:
+        yield trace
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        trace.root.end(error)
+        if trace.sampled:
+            exporter.export(trace)
+
+
+def server_timing(trace: Trace) -> str:
+    """Server-Timing header value: total request time plus per-stage totals."""
+    entries = [f"total;dur={trace.root.duration_ms:.1f}"]
+    for stage, (count, ms) in sorted(trace.stage_totals().items()):
+        entries.append(f'{stage};dur={ms:.1f};desc="{count} span{"s" if count != 1 else ""}"')
+    return ", ".join(entries)
+
+
+def set_llm_usage(current: Optional[Span], usage) -> None:
+    """Record token usage (an OpenAI usage object or dict) on an LLM span."""
+    if current is None or not usage:
+        return
+    current.set_attribute("gen_ai.usage.input_tokens", usage_value(usage, "prompt_tokens"))
+    current.set_attribute("gen_ai.usage.output_tokens", usage_value(usage, "completion_tokens"))
+    current.set_attribute("gen_ai.usage.cache_read.input_tokens", cached_prompt_tokens(usage))
+
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """Spans for every Mongo command, sync or async client, issued inside a traced request."""
+
+    def __init__(self):
+        self._spans: Dict[tuple, Span] = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        current = start_span(
+            f"mongo.{event.command_name}", "mongo", "client",
+            **{
+                "db.system": "mongodb",
+                "db.name": event.database_name,
+                "db.operation": event.command_name,
+                "db.mongodb.collection": collection if isinstance(collection, str) else None,
+            },
+        )
+        if current is not None:
+            self._spans[(event.request_id, event.connection_id)] = current
+
+    def succeeded(self, event):
+        current = self._spans.pop((event.request_id, event.connection_id), None)
+        if current is not None:
+            current.end()
+
+    def failed(self, event):
+        current = self._spans.pop((event.request_id, event.connection_id), None)
+        if current is not None:
+            current.end(str(event.failure))
+
+
+class LangChainTracer(BaseCallbackHandler):
+    """Spans for LangChain chat model calls, parented to whatever span is current when they start."""
+
+    run_inline = True
+
+    def __init__(self):
+        self._spans: Dict = {}
+
+    def _start(self, run_id, serialized, kwargs):
+        params = kwargs.get("invocation_params") or {}
+        current = start_span(
+            "llm.chat", "llm", "client",
+            **{
+                "gen_ai.system": "openai",
+                "gen_ai.request.model": params.get("model_name") or params.get("model") or (serialized or {}).get("name"),
+            },
+        )
+        if current is not None:
+            self._spans[run_id] = current
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, serialized, kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id, serialized, kwargs)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        current = self._spans.pop(run_id, None)
+        if current is not None:
+            set_llm_usage(current, (response.llm_output or {}).get("token_usage"))
+            current.end()
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        current = self._spans.pop(run_id, None)
+        if current is not None:
+            current.end(f"{type(error).__name__}: {error}")
+
+
+def shutdown() -> None:
+    exporter.shutdown()
@@ -1,25 +1,32 @@
 from openai import AzureOpenAI
-from models import get_semantic_data, get_database_connection
+from models import get_semantic_data, get_database_connection, get_extracted_schema
+import asyncio
+import logging
+import async_models
 import json
 import uuid
-from sqlalchemy import create_engine, text
 from decimal import Decimal
 from datetime import datetime, date
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.engine import RowMapping
-from database import db_visualizations
+from database import async_db_visualizations
+from warehouse import fetch_all, fetch_all_async, table_row_estimates
+from prompt_budget import CHART_PROMPT_MAX_CALLS, CHART_PROMPT_TOKEN_BUDGET, count_tokens, pack_schema
+from metrics import LLM_ERRORS, LLM_LATENCY, record_tokens, timed
+from tracing import set_llm_usage, span
 
+logger = logging.getLogger(__name__)
 
-def get_sql_queries(user_id, db_id):
-    """Generate SQL queries for visualization based on database semantics."""
-    semantics = get_semantic_data(user_id, db_id)
-    
-    prompt = f"""
-You are a data analyst assistant. I will provide you with a database semantics.
 
-semantics:
-{semantics}
+# Static instructions go in the system message and the schema digest in the user
+# message, so every chart call shares one cacheable prefix.
+CHART_PROMPT_INSTRUCTIONS = """
+You are a data analyst assistant. I will provide you with a compact digest of a database schema.
+Each table is listed as `name [fact|dimension, ~rows]: what it holds`, followed by its columns as
+`column TYPE`, `PK` for primary keys, `-> table.column` for foreign keys, and a value range or sample values.
 
 Based on this, generate a list of SQL queries that return data suitable for visualizing common business metrics using Apache ECharts.
+Only use the tables and columns listed in the digest.
 don't include id(s) in the chart that don't make any sense.
 Each item should be a valid JSON object with:
 - "chart_type": chart type (e.g., Line, Bar, Pie, Scatter, Radar)
@@ -33,33 +40,77 @@ Don't add ```json or ``` in the response.
 
 Output format:
 [
-  {{
+  {
     "chart_type": "Line",
     "description": "Revenue trends over time by month",
     "sql": "SELECT DATE_TRUNC('month', order_date) AS month, SUM(revenue) AS total_revenue FROM orders GROUP BY month ORDER BY month"
-  }},
-  {{
+  },
+  {
     "chart_type": "Bar",
     "description": "Number of products in each category",
     "sql": "SELECT category, COUNT(*) AS product_count FROM products GROUP BY category"
-  }}
+  }
 ]
 """
 
+
+def build_chart_prompts(user_id, db_id):
+    """
+    Schema digests for the chart-generation calls, each keeping the prompt
+    within CHART_PROMPT_TOKEN_BUDGET: the most important tables, split over
+    several calls (at most CHART_PROMPT_MAX_CALLS) when the schema is too large for one.
+    """
+    semantics = get_semantic_data(user_id, db_id)
+    db_name = next(iter(semantics))
+    semantic_tables = {
+        name: table for name, table in semantics[db_name].items() if name != "database_description"
+    }
+    schema = get_extracted_schema(user_id, db_id)
+    row_estimates = table_row_estimates(get_database_connection(user_id, db_id))
+
+    budget = CHART_PROMPT_TOKEN_BUDGET - count_tokens(CHART_PROMPT_INSTRUCTIONS)
+    schema_texts = pack_schema(semantic_tables, schema, row_estimates, budget, CHART_PROMPT_MAX_CALLS)
+    logger.info(f"Chart prompts for {db_id}: {len(semantic_tables)} tables in {len(schema_texts)} call(s)")
+    return [f"semantics:\n{schema_text}" for schema_text in schema_texts]
+
+
+def ask_chart_queries(prompt):
+    """One chart-generation call; returns the parsed list of chart definitions."""
     client = AzureOpenAI(
     azure_deployment="gpt-4o",
     api_version="2024-12-01-preview",
     )
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.4
-    )
+    with span("llm.chat", "llm", "client", **{"gen_ai.request.model": "gpt-4o"}) as llm_span, \
+            timed(LLM_LATENCY, LLM_ERRORS, operation="chat", model="gpt-4o"):
+        response = client.chat.completions.create(
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": CHART_PROMPT_INSTRUCTIONS},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.4
+        )
+        set_llm_usage(llm_span, response.usage)
+    record_tokens("gpt-4o", response.usage, "charts")
     
     sql_queries_response = response.choices[0].message.content
     return json.loads(sql_queries_response)
 
 
+async def get_sql_queries(user_id, db_id):
+    """Generate SQL queries for visualization based on database semantics, one LLM call per prompt in parallel."""
+    prompts = await run_in_threadpool(build_chart_prompts, user_id, db_id)
+    batches = await asyncio.gather(
+        *(run_in_threadpool(ask_chart_queries, prompt) for prompt in prompts), return_exceptions=True
+    )
+    failures = [batch for batch in batches if isinstance(batch, BaseException)]
+    if failures and len(failures) == len(batches):
+        raise failures[0]
+    for failure in failures:
+        logger.error(f"Chart generation call failed for {db_id}: {failure}")
+    return [item for batch in batches if not isinstance(batch, BaseException) for item in batch]
+
+
 class CustomJSONEncoder(json.JSONEncoder):
     """Custom JSON encoder for handling special data types."""
     def default(self, obj):
@@ -72,63 +123,45 @@ class CustomJSONEncoder(json.JSONEncoder):
         return super().default(obj)
 
 
+def _chart_result(item, rows=None, error=None):
+    result = {
+        "chart_type": item.get("chart_type"),
+        "description": item.get("description"),
+        "sql": item.get("sql"),
+        "data": rows if rows is not None else []
+    }
+    if error is not None:
+        result["error"] = str(error)
+    return result
+
+
 def execute_sql_queries(queries, user_id, db_id):
     """Execute SQL queries and return results with proper error handling."""
     database_info = get_database_connection(user_id, db_id)
-    
-    # Construct DB connection URL
-    db_type = database_info.get("db_type")
-    if db_type == "postgresql":
-        # schema = "alpl_prod"
-        # db_url = f"postgresql+psycopg2://{database_info['username']}:{database_info['password']}@{database_info['host']}:{database_info['port']}/{database_info['database']}?connect_timeout=10&options=-csearch_path%3D{schema}"
-        db_url = f"postgresql+psycopg2://{database_info['username']}:{database_info['password']}@{database_info['host']}:{database_info['port']}/{database_info['database']}?connect_timeout=10"
-    elif db_type == "mysql":
-        db_url = f"mysql+pymysql://{database_info['username']}:{database_info['password']}@{database_info['host']}:{database_info['port']}/{database_info['database']}"
-    else:
-        raise ValueError("Unsupported database type. Only 'postgresql' and 'mysql' are supported.")
 
     results = []
-    engine = create_engine(db_url)
-
     for item in queries:
-        chart_type = item.get("chart_type")
-        description = item.get("description")
-        sql = item.get("sql")
-
-        # Create a new connection for each query
         try:
-            with engine.connect() as connection:
-                # Start a new transaction
-                with connection.begin():
-                    try:
-                        result = connection.execute(text(sql))
-                        rows = result.mappings().all()
-                        results.append({
-                            "chart_type": chart_type,
-                            "description": description,
-                            "sql": sql,
-                            "data": rows
-                        })
-                    except Exception as query_error:
-                        results.append({
-                            "chart_type": chart_type,
-                            "description": description,
-                            "sql": sql,
-                            "error": str(query_error),
-                            "data": []
-                        })
-        except Exception as conn_error:
-            results.append({
-                "chart_type": chart_type,
-                "description": description,
-                "sql": sql,
-                "error": str(conn_error),
-                "data": []
-            })
+            results.append(_chart_result(item, rows=fetch_all(database_info, item.get("sql"))))
+        except Exception as query_error:
+            results.append(_chart_result(item, error=query_error))
 
     return results
 
 
+async def execute_sql_queries_async(queries, user_id, db_id):
+    """Execute the chart queries concurrently on the async engine; one failing query doesn't affect the others."""
+    database_info = await async_models.get_database_connection(user_id, db_id)
+
+    async def run(item):
+        try:
+            return _chart_result(item, rows=await fetch_all_async(database_info, item.get("sql")))
+        except Exception as query_error:
+            return _chart_result(item, error=query_error)
+
+    return await asyncio.gather(*(run(item) for item in queries))
+
+
 def generate_echarts_from_data(chart_definitions):
     """Generate ECharts configuration from query results."""
     def convert(val):
@@ -256,27 +289,27 @@ def generate_echarts_from_data(chart_definitions):
     return [get_option(chart) for chart in chart_definitions]
 
 
-def visualization_generator(user_id, db_id):
+async def visualization_generator(user_id, db_id):
     """Main function to generate and store visualizations."""
     try:
         # Step 1: Generate SQL queries
-        sql_query_response = get_sql_queries(user_id, db_id)
-        print("--------------------------------------")
-        print(sql_query_response)
+        sql_query_response = await get_sql_queries(user_id, db_id)
+        # print("--------------------------------------")
+        # print(sql_query_response)
         # Step 2: Execute queries
-        sql_query_executer_response = execute_sql_queries(sql_query_response, user_id, db_id)
-        print("======================================")
-        print(sql_query_executer_response)
+        sql_query_executer_response = await execute_sql_queries_async(sql_query_response, user_id, db_id)
+        # print("======================================")
+        # print(sql_query_executer_response)
         # Step 3: Generate ECharts configurations
         gen_chat_response = generate_echarts_from_data(sql_query_executer_response)
-        print("**************************************")
-        print(gen_chat_response)
+        # print("**************************************")
+        # print(gen_chat_response)
         # Step 4: Add metadata and store in database
         for viz_obj in gen_chat_response:
             viz_obj["pinned"] = False
             viz_obj["chart_id"] = str(uuid.uuid4())[:8]
         
-        db_visualizations.insert_one({
+        await async_db_visualizations.insert_one({
             "charts": gen_chat_response,
             "user_id": user_id,
             "db_id": db_id,
@@ -0,0 +1,329 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Dict, List
+
+from fastapi import HTTPException
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import URL
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from metrics import record_sql
+from tracing import TRACE_STATEMENTS, span
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT_SECONDS = 10
+POOL_SIZE = int(os.getenv("WAREHOUSE_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("WAREHOUSE_MAX_OVERFLOW", "10"))
+DISCONNECT_POLL_SECONDS = 0.5
+# Applied to every warehouse session unless the connection sets statement_timeout_ms.
+DEFAULT_STATEMENT_TIMEOUT_MS = int(os.getenv("DEFAULT_STATEMENT_TIMEOUT_MS", "120000"))
+# Pools nobody has asked for in this long, with nothing checked out, are closed when another pool is created.
+POOL_IDLE_SECONDS = int(os.getenv("WAREHOUSE_POOL_IDLE_SECONDS", "900"))
+
+SYNC_DRIVERS = {"postgresql": "postgresql+psycopg2", "mysql": "mysql+pymysql"}
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "mysql": "mysql+aiomysql"}
+
+# asyncpg names its connect timeout differently from the other three drivers.
+CONNECT_ARGS = {
+    "postgresql+psycopg2": {"connect_timeout": CONNECT_TIMEOUT_SECONDS},
+    "mysql+pymysql": {"connect_timeout": CONNECT_TIMEOUT_SECONDS},
+    "postgresql+asyncpg": {"timeout": CONNECT_TIMEOUT_SECONDS},
+    "mysql+aiomysql": {"connect_timeout": CONNECT_TIMEOUT_SECONDS},
+}
+
+# Per-session setup (statement timeout, server-side id of the session) and the
+# statement used from a second session to abort a running query.
+SESSION_SETUP = {
+    "postgresql": ("SET statement_timeout = {timeout_ms}", "SELECT pg_backend_pid()"),
+    "mysql": ("SET SESSION MAX_EXECUTION_TIME = {timeout_ms}", "SELECT CONNECTION_ID()"),
+}
+CANCEL_STATEMENTS = {
+    "postgresql": "SELECT pg_cancel_backend(:backend_id)",
+    "mysql": "KILL QUERY :backend_id",
+}
+
+# Cheap probes whose value changes whenever table contents change; used to
+# invalidate answers cached against an older state of the warehouse.
+DATA_VERSION_QUERIES = {
+    "postgresql": "SELECT COALESCE(SUM(n_tup_ins + n_tup_upd + n_tup_del), 0) FROM pg_stat_user_tables",
+    "mysql": (
+        "SELECT CONCAT(COALESCE(MAX(UPDATE_TIME), ''), ':', COALESCE(SUM(TABLE_ROWS), 0)) "
+        "FROM information_schema.tables WHERE table_schema = DATABASE()"
+    ),
+}
+# Planner statistics, not COUNT(*): approximate rows per table in the default schema.
+TABLE_ROW_ESTIMATE_QUERIES = {
+    "postgresql": (
+        "SELECT c.relname AS table_name, GREATEST(c.reltuples, 0)::bigint AS row_count "
+        "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = current_schema() AND c.relkind IN ('r', 'p')"
+    ),
+    "mysql": (
+        "SELECT TABLE_NAME AS table_name, TABLE_ROWS AS row_count "
+        "FROM information_schema.tables WHERE table_schema = DATABASE()"
+    ),
+}
+
+_engines = {}
+_async_engines = {}
+# When each pooled engine was last handed out, by ("sync"|"async", engine key).
+_last_used = {}
+_engines_lock = threading.Lock()
+_disposals = set()
+
+
+def build_database_url(data_connection: Dict, drivers: Dict[str, str] = SYNC_DRIVERS) -> URL:
+    """
+    Build a SQLAlchemy URL for a stored customer connection.
+
+    Raises:
+        ValueError: If the connection's db_type is not supported.
+    """
+    drivername = drivers.get(data_connection["db_type"])
+    if drivername is None:
+        raise ValueError("Unsupported database type. Use 'postgresql' or 'mysql'.")
+    return URL.create(
+        drivername,
+        username=data_connection["username"],
+        password=data_connection["password"],
+        host=data_connection["host"],
+        port=data_connection["port"],
+        database=data_connection["database"],
+    )
+
+
+def statement_timeout_ms(data_connection: Dict) -> int:
+    return int(data_connection.get("statement_timeout_ms") or DEFAULT_STATEMENT_TIMEOUT_MS)
+
+
+def _engine_key(data_connection: Dict):
+    # Sessions are set up with one statement timeout per pool, so connections differing only in it don't share one.
+    credentials = tuple(data_connection.get(key) for key in ("db_type", "host", "port", "database", "username", "password"))
+    return credentials + (statement_timeout_ms(data_connection),)
+
+
+def _take_idle_engines(engines: Dict, kind: str, now: float) -> List:
+    """Remove and return the engines of `kind` unused for POOL_IDLE_SECONDS with no connection checked out."""
+    idle = []
+    for key, engine in list(engines.items()):
+        pool = engine.pool if kind == "sync" else engine.sync_engine.pool
+        if now - _last_used.get((kind, key), now) > POOL_IDLE_SECONDS and pool.checkedout() == 0:
+            idle.append(engines.pop(key))
+            _last_used.pop((kind, key), None)
+    return idle
+
+
+def _dispose_async_engine(engine) -> None:
+    """Close an idle asyncio engine's connections in the background."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # No loop to close them on: drop the pool and let its connections be collected.
+        engine.sync_engine.dispose(close=False)
+        return
+    task = loop.create_task(engine.dispose())
+    _disposals.add(task)
+    task.add_done_callback(_disposals.discard)
+
+
+def _install_session_setup(sync_engine, data_connection: Dict):
+    timeout_sql, backend_id_sql = SESSION_SETUP[data_connection["db_type"]]
+    timeout_sql = timeout_sql.format(timeout_ms=statement_timeout_ms(data_connection))
+
+    @event.listens_for(sync_engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(timeout_sql)
+            cursor.execute(backend_id_sql)
+            connection_record.info["backend_id"] = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+        # Postgres discards a SET made inside a transaction that is later rolled back.
+        dbapi_connection.commit()
+
+
+def get_engine(data_connection: Dict):
+    """Return the shared, pooled sync engine for a customer connection."""
+    key = _engine_key(data_connection)
+    now = time.monotonic()
+    idle = []
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            idle = _take_idle_engines(_engines, "sync", now)
+            url = build_database_url(data_connection)
+            engine = create_engine(
+                url,
+                connect_args=CONNECT_ARGS[url.drivername],
+                pool_size=POOL_SIZE,
+                max_overflow=MAX_OVERFLOW,
+                pool_pre_ping=True,
+            )
+            _install_session_setup(engine, data_connection)
+            _engines[key] = engine
+        _last_used[("sync", key)] = now
+    for stale in idle:
+        stale.dispose()
+    return engine
+
+
+def get_async_engine(data_connection: Dict):
+    """Return the shared, pooled asyncio engine for a customer connection."""
+    key = _engine_key(data_connection)
+    now = time.monotonic()
+    idle = []
+    with _engines_lock:
+        engine = _async_engines.get(key)
+        if engine is None:
+            idle = _take_idle_engines(_async_engines, "async", now)
+            url = build_database_url(data_connection, ASYNC_DRIVERS)
+            engine = create_async_engine(
+                url,
+                connect_args=CONNECT_ARGS[url.drivername],
+                pool_size=POOL_SIZE,
+                max_overflow=MAX_OVERFLOW,
+                pool_pre_ping=True,
+            )
+            _install_session_setup(engine.sync_engine, data_connection)
+            _async_engines[key] = engine
+        _last_used[("async", key)] = now
+    for stale in idle:
+        _dispose_async_engine(stale)
+    return engine
+
+
+def _sql_span(data_connection: Dict, sql: str):
+    return span("sql.query", "sql", "client", **{
+        "db.system": data_connection["db_type"],
+        "db.name": data_connection["database"],
+        "db.statement": sql if TRACE_STATEMENTS else None,
+    })
+
+
+def fetch_all(data_connection: Dict, sql: str) -> List[Dict]:
+    """Run a query on the pooled sync engine and return the rows as dicts."""
+    started = time.perf_counter()
+    rows = None
+    try:
+        with _sql_span(data_connection, sql) as sql_span:
+            with get_engine(data_connection).connect() as connection:
+                result = connection.execute(text(sql))
+                rows = [dict(row) for row in result.mappings().all()]
+            if sql_span is not None:
+                sql_span.set_attribute("db.response.returned_rows", len(rows))
+            return rows
+    finally:
+        record_sql(data_connection, time.perf_counter() - started, None if rows is None else len(rows))
+
+
+async def cancel_backend(data_connection: Dict, backend_id) -> None:
+    """Abort whatever the given warehouse session is running, from a separate session."""
+    try:
+        async with get_async_engine(data_connection).connect() as connection:
+            await connection.execute(
+                text(CANCEL_STATEMENTS[data_connection["db_type"]]), {"backend_id": int(backend_id)}
+            )
+        logger.info(f"Cancelled query on backend {backend_id} ({data_connection['database']})")
+    except Exception as e:
+        logger.error(f"Failed to cancel query on backend {backend_id}: {e}")
+
+
+async def fetch_all_async(data_connection: Dict, sql: str) -> List[Dict]:
+    """
+    Run a query on the pooled asyncio engine and return the rows as dicts.
+    If the awaiting task is cancelled, the query is killed on the server too.
+    """
+    started = time.perf_counter()
+    rows = None
+    try:
+        with _sql_span(data_connection, sql) as sql_span:
+            async with get_async_engine(data_connection).connect() as connection:
+                backend_id = connection.info.get("backend_id")
+                try:
+                    result = await connection.execute(text(sql))
+                except asyncio.CancelledError:
+                    if backend_id is not None:
+                        await asyncio.shield(cancel_backend(data_connection, backend_id))
+                    raise
+                rows = [dict(row) for row in result.mappings().all()]
+            if sql_span is not None:
+                sql_span.set_attribute("db.response.returned_rows", len(rows))
+            return rows
+    finally:
+        record_sql(data_connection, time.perf_counter() - started, None if rows is None else len(rows))
+
+
+async def data_version_async(data_connection: Dict) -> str:
+    """Fingerprint of the warehouse's current data, from catalog statistics only."""
+    async with get_async_engine(data_connection).connect() as connection:
+        result = await connection.execute(text(DATA_VERSION_QUERIES[data_connection["db_type"]]))
+        return str(result.scalar())
+
+
+def table_row_estimates(data_connection: Dict) -> Dict[str, int]:
+    """Approximate row count per table from catalog statistics; empty if they can't be read."""
+    try:
+        rows = fetch_all(data_connection, TABLE_ROW_ESTIMATE_QUERIES[data_connection["db_type"]])
+    except Exception as e:
+        logger.warning(f"Could not read table row estimates for {data_connection['database']}: {e}")
+        return {}
+    return {row["table_name"]: int(row["row_count"] or 0) for row in rows}
+
+
+async def run_until_disconnected(request, awaitable):
+    """
+    Await `awaitable`, cancelling it if the HTTP client disconnects first.
+
+    Raises:
+        HTTPException: 499 when the client went away before the result was ready.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                logger.info(f"Client disconnected from {request.url.path}; cancelling in-flight work.")
+                task.cancel()
+                raise HTTPException(status_code=499, detail="Client closed request")
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+
+
+def pool_stats() -> List[Dict]:
+    """Checked-out, size and overflow figures of every pooled engine, identified by an opaque pool id."""
+    with _engines_lock:
+        engines = [("sync", key, engine.pool) for key, engine in _engines.items()]
+        engines += [("async", key, engine.sync_engine.pool) for key, engine in _async_engines.items()]
+    return [
+        {
+            "engine": kind,
+            "pool": hashlib.sha256(repr(key).encode("utf-8")).hexdigest()[:12],
+            "checked_out": pool.checkedout(),
+            "size": pool.size(),
+            "overflow": max(pool.overflow(), 0),
+        }
+        for kind, key, pool in engines
+    ]
+
+
+async def dispose_engines():
+    """Close every pooled connection; called on application shutdown."""
+    with _engines_lock:
+        engines = list(_engines.values())
+        async_engines = list(_async_engines.values())
+        _engines.clear()
+        _async_engines.clear()
+        _last_used.clear()
+    for engine in engines:
+        engine.dispose()
+    for engine in async_engines:
+        await engine.dispose()